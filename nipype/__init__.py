@@ -1,6 +1,7 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 import os
+import sys
 
 from info import (LONG_DESCRIPTION as __doc__,
                   URL as __url__,
@@ -11,36 +12,55 @@ config = NipypeConfig()
 from utils.logger import Logging
 logging = Logging(config)
 
-# We require numpy 1.2 for our test suite.  If Tester fails to import,
-# check the version of numpy the user has and inform them they need to
-# upgrade.
-import numpy as np
-from distutils.version import LooseVersion
-if LooseVersion(np.__version__) >= '1.2':
-    from numpy.testing import Tester
-else:
-    from testing.numpytesting import Tester
-
-
-class NipypeTester(Tester):
-    def test(self, label='fast', verbose=1, extra_argv=None,
-             doctests=False, coverage=False):
-        # setuptools does a chmod +x on ALL python modules when it
-        # installs.  By default, as a security measure, nose refuses to
-        # import executable files.  To forse nose to execute our tests, we
-        # must supply the '--exe' flag.  List thread on this:
-        # http://www.mail-archive.com/distutils-sig@python.org/msg05009.html
-        if not extra_argv:
-            extra_argv = ['--exe']
-        else:
-            extra_argv.append('--exe')
-        super(NipypeTester, self).test(label, verbose, extra_argv,
-                                       doctests, coverage)
-    # Grab the docstring from numpy
-    #test.__doc__ = Tester.test.__doc__
-
-test = NipypeTester().test
-bench = NipypeTester().bench
+
+def _get_tester():
+    """Return the nose based tester of nipype
+
+    numpy.testing is only imported when the tests are run.
+    """
+    # We require numpy 1.2 for our test suite.  If Tester fails to import,
+    # check the version of numpy the user has and inform them they need to
+    # upgrade.
+    import numpy as np
+    from distutils.version import LooseVersion
+    if LooseVersion(np.__version__) >= '1.2':
+        from numpy.testing import Tester
+    else:
+        from testing.numpytesting import Tester
+
+    class NipypeTester(Tester):
+        def test(self, label='fast', verbose=1, extra_argv=None,
+                 doctests=False, coverage=False):
+            # setuptools does a chmod +x on ALL python modules when it
+            # installs.  By default, as a security measure, nose refuses to
+            # import executable files.  To forse nose to execute our tests, we
+            # must supply the '--exe' flag.  List thread on this:
+            # http://www.mail-archive.com/distutils-sig@python.org/msg05009.html
+            if not extra_argv:
+                extra_argv = ['--exe']
+            else:
+                extra_argv.append('--exe')
+            super(NipypeTester, self).test(label, verbose, extra_argv,
+                                           doctests, coverage)
+        # Grab the docstring from numpy
+        #test.__doc__ = Tester.test.__doc__
+
+    return NipypeTester(package=sys.modules[__name__])
+
+
+def test(*args, **kwargs):
+    """Run the tests of nipype (see numpy.testing.Tester.test)"""
+    return _get_tester().test(*args, **kwargs)
+
+
+def bench(*args, **kwargs):
+    """Run the benchmarks of nipype (see numpy.testing.Tester.bench)"""
+    return _get_tester().bench(*args, **kwargs)
+
+# not tests themselves, nose would otherwise collect them and run the whole
+# suite from within itself
+test.__test__ = False
+bench.__test__ = False
 
 
 def _test_local_install():
@@ -55,20 +75,15 @@ def _test_local_install():
 
 _test_local_install()
 
+
 # Set up package information function
-from pkg_info import get_pkg_info as _get_pkg_info
-get_info = lambda: _get_pkg_info(os.path.dirname(__file__))
+def get_info():
+    from pkg_info import get_pkg_info
+    return get_pkg_info(os.path.dirname(__file__))
 
 # Cleanup namespace
 del _test_local_install
 
-# If this file is exec after being imported, the following lines will
-# fail
-try:
-    del Tester
-except:
-    pass
-
 
 def check_for_updates():
     from urllib import urlopen
@@ -1,5 +1,4 @@
-from numpy import ones, kron, mean, eye, hstack, dot, tile
-from scipy.linalg import pinv
+from numpy import mean
 from ..interfaces.base import BaseInterfaceInputSpec, TraitedSpec, \
     BaseInterface, traits, File
 import nibabel as nb
@@ -12,10 +11,14 @@ class ICCInputSpec(BaseInterfaceInputSpec):
                            desc="n subjects m sessions 3D stat files",
                            mandatory=True)
     mask = File(exists=True, mandatory=True)
+    block_size = traits.Int(100000, usedefault=True, nohash=True,
+                            desc="number of voxels processed at once")
 
 
 class ICCOutputSpec(TraitedSpec):
     icc_map = File(exists=True)
+    sessions_F_map = File(exists=True, desc="F statistics of the session "
+                          "effect")
     session_var_map = File(exists=True, desc="variance between sessions")
     subject_var_map = File(exists=True, desc="variance between subjects")
 
@@ -34,33 +37,28 @@ class ICC(BaseInterface):
         maskdata = nb.load(self.inputs.mask).get_data()
         maskdata = np.logical_not(np.logical_or(maskdata == 0, np.isnan(maskdata)))
 
-        session_datas = [[nb.load(fname).get_data()[maskdata].reshape(-1, 1) for fname in sessions] for sessions in self.inputs.subjects_sessions]
-        list_of_sessions = [np.dstack(session_data) for session_data in session_datas]
-        all_data = np.hstack(list_of_sessions)
-        icc = np.zeros(session_datas[0][0].shape)
-        session_F = np.zeros(session_datas[0][0].shape)
-        session_var = np.zeros(session_datas[0][0].shape)
-        subject_var = np.zeros(session_datas[0][0].shape)
-
-        for x in range(icc.shape[0]):
-            Y = all_data[x, :, :]
-            icc[x], subject_var[x], session_var[x],  session_F[x], _, _ = ICC_rep_anova(Y)
+        # subjects x sessions values of each voxel of the mask
+        sessions = self.inputs.subjects_sessions
+        all_data = np.zeros((maskdata.sum(), len(sessions), len(sessions[0])))
+        for i, subject_sessions in enumerate(sessions):
+            for j, fname in enumerate(subject_sessions):
+                all_data[:, i, j] = nb.load(fname).get_data()[maskdata]
+
+        maps = dict([(name, np.zeros(all_data.shape[0])) for name in
+                     ['icc', 'subject_var', 'session_var', 'sessions_F']])
+        for start in range(0, all_data.shape[0], self.inputs.block_size):
+            block = slice(start, start + self.inputs.block_size)
+            (maps['icc'][block], maps['subject_var'][block],
+             maps['session_var'][block], maps['sessions_F'][block], _, _) = \
+                ICC_rep_anova(all_data[block])
 
         nim = nb.load(self.inputs.subjects_sessions[0][0])
-        new_data = np.zeros(nim.get_shape())
-        new_data[maskdata] = icc.reshape(-1,)
-        new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
-        nb.save(new_img, 'icc_map.nii')
-        
-        new_data = np.zeros(nim.get_shape())
-        new_data[maskdata] = session_var.reshape(-1,)
-        new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
-        nb.save(new_img, 'session_var_map.nii')
-        
-        new_data = np.zeros(nim.get_shape())
-        new_data[maskdata] = subject_var.reshape(-1,)
-        new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
-        nb.save(new_img, 'subject_var_map.nii')
+        for name, values in maps.items():
+            new_data = np.zeros(nim.get_shape())
+            new_data[maskdata] = values
+            new_img = nb.Nifti1Image(new_data, nim.get_affine(),
+                                     nim.get_header())
+            nb.save(new_img, '%s_map.nii' % name)
 
         return runtime
 
@@ -76,7 +74,9 @@ class ICC(BaseInterface):
 def ICC_rep_anova(Y):
     '''
     the data Y are entered as a 'table' ie subjects are in rows and repeated
-    measures in columns
+    measures in columns. Several tables (e.g., one per voxel) can be given
+    as an array of shape (..., subjects, repeated measures), the statistics
+    then being arrays of shape (...).
 
     --------------------------------------------------------------------------
                        One Sample Repeated measure ANOVA
@@ -84,7 +84,8 @@ def ICC_rep_anova(Y):
     --------------------------------------------------------------------------
     '''
 
-    [nb_subjects, nb_conditions] = Y.shape
+    Y = np.asarray(Y, dtype=float)
+    nb_subjects, nb_conditions = Y.shape[-2:]
     dfc = nb_conditions - 1
     dfe = (nb_subjects - 1) * dfc
     dfr = nb_subjects - 1
@@ -93,25 +94,20 @@ def ICC_rep_anova(Y):
     # ------------------------------------
 
     # Sum Square Total
-    mean_Y = mean(Y)
-    SST = ((Y - mean_Y) ** 2).sum()
-
-    # create the design matrix for the different levels
-    x = kron(eye(nb_conditions), ones((nb_subjects, 1)))  # sessions
-    x0 = tile(eye(nb_subjects), (nb_conditions, 1))  # subjects
-    X = hstack([x, x0])
-
-    # Sum Square Error
-    predicted_Y = dot(dot(dot(X, pinv(dot(X.T, X))), X.T), Y.flatten('F'))
-    residuals = Y.flatten('F') - predicted_Y
-    SSE = (residuals ** 2).sum()
+    mean_Y = Y.mean(axis=-1).mean(axis=-1)[..., None, None]
+    SST = ((Y - mean_Y) ** 2).sum(axis=-1).sum(axis=-1)
 
-    residuals.shape = Y.shape
+    # Sum Square Error, in closed form from the row (subject) and column
+    # (session) means of the table, as the design is balanced
+    mean_rows = mean(Y, -1)[..., :, None]
+    mean_cols = mean(Y, -2)[..., None, :]
+    residuals = Y - mean_rows - mean_cols + mean_Y
+    SSE = (residuals ** 2).sum(axis=-1).sum(axis=-1)
 
     MSE = SSE / dfe
 
     # Sum square session effect - between colums/sessions
-    SSC = ((mean(Y, 0) - mean_Y) ** 2).sum() * nb_subjects
+    SSC = ((mean_cols - mean_Y) ** 2).sum(axis=-1).sum(axis=-1) * nb_subjects
     MSC = SSC / dfc / nb_subjects
 
     session_effect_F = MSC / MSE
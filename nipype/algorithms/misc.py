@@ -18,11 +18,13 @@ import numpy as np
 from math import floor, ceil
 from scipy.ndimage.morphology import grey_dilation
 from scipy.ndimage.morphology import binary_erosion
-from scipy.spatial.distance import cdist, euclidean, dice, jaccard
-from scipy.ndimage.measurements import center_of_mass, label
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist, euclidean
+from scipy.ndimage.measurements import center_of_mass, find_objects, label
 from scipy.special import legendre
 import scipy.io as sio
 import itertools
+import csv
 
 from .. import logging
 
@@ -30,6 +32,7 @@ from ..interfaces.base import (BaseInterface, traits, TraitedSpec, File,
                                InputMultiPath, OutputMultiPath,
                                BaseInterfaceInputSpec, isdefined)
 from ..utils.filemanip import fname_presuffix, split_filename
+from ..utils.imagedata import VolumeReader
 iflogger = logging.getLogger('interface')
 
 
@@ -190,6 +193,10 @@ class DistanceInputSpec(BaseInterfaceInputSpec):
     "eucl_max": maximum over minimum Euclidian distances of all volume2 voxels to volume1 (also known as the Hausdorff distance)',
     usedefault=True)
     mask_volume = File(exists=True, desc="calculate overlap only within this mask.")
+    save_histogram = traits.Bool(True, usedefault=True,
+                                 desc=("save the histogram of the distances of "
+                                       "eucl_mean and eucl_wmean (requires "
+                                       "matplotlib)"))
 
 
 class DistanceOutputSpec(TraitedSpec):
@@ -202,6 +209,10 @@ class DistanceOutputSpec(TraitedSpec):
 class Distance(BaseInterface):
     '''
     Calculates distance between two volumes.
+
+    Nearest points are searched with k-d trees, in O(N log M) time and
+    linear memory. See label_distances to compute the distances between
+    many pairs of regions of a label image.
     '''
     input_spec = DistanceInputSpec
     output_spec = DistanceOutputSpec
@@ -221,28 +232,32 @@ class Distance(BaseInterface):
         coordinates = np.dot(affine, indices)
         return coordinates[:3, :]
 
-    def _eucl_min(self, nii1, nii2):
-        origdata1 = nii1.get_data().astype(np.bool)
-        border1 = self._find_border(origdata1)
-
-        origdata2 = nii2.get_data().astype(np.bool)
-        border2 = self._find_border(origdata2)
-
-        set1_coordinates = self._get_coordinates(border1, nii1.get_affine())
-
-        set2_coordinates = self._get_coordinates(border2, nii2.get_affine())
-
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        (point1, point2) = np.unravel_index(np.argmin(dist_matrix), dist_matrix.shape)
+    def _nearest(self, set1_coordinates, set2_coordinates, tree1=None):
+        """Returns the distance of each point of set2 to the nearest point
+        of set1, and the index of that point. tree1 is the k-d tree of set1,
+        built if not given."""
+        if tree1 is None:
+            tree1 = cKDTree(set1_coordinates.T)
+        return tree1.query(set2_coordinates.T)
+
+    def _min_distance(self, set1_coordinates, set2_coordinates, tree2=None):
+        distances, nearest = self._nearest(set2_coordinates, set1_coordinates,
+                                           tree2)
+        point1 = np.argmin(distances)
+        point2 = nearest[point1]
         return (euclidean(set1_coordinates.T[point1, :], set2_coordinates.T[point2, :]), set1_coordinates.T[point1, :], set2_coordinates.T[point2, :])
 
-    def _eucl_cog(self, nii1, nii2):
-        origdata1 = nii1.get_data().astype(np.bool)
+    def _max_distance(self, set1_coordinates, set2_coordinates, tree1=None,
+                      tree2=None):
+        mins = np.concatenate((self._nearest(set1_coordinates, set2_coordinates, tree1)[0],
+                               self._nearest(set2_coordinates, set1_coordinates, tree2)[0]))
+        return np.max(mins)
+
+    def _cog_distance(self, origdata1, affine1, origdata2, affine2):
         cog_t = np.array(center_of_mass(origdata1)).reshape(-1, 1)
         cog_t = np.vstack((cog_t, np.array([1])))
-        cog_t_coor = np.dot(nii1.get_affine(), cog_t)[:3, :]
+        cog_t_coor = np.dot(affine1, cog_t)[:3, :]
 
-        origdata2 = nii2.get_data().astype(np.bool)
         (labeled_data, n_labels) = label(origdata2)
 
         cogs = np.ones((4, n_labels))
@@ -250,12 +265,31 @@ class Distance(BaseInterface):
         for i in range(n_labels):
             cogs[:3, i] = np.array(center_of_mass(origdata2, labeled_data, i + 1))
 
-        cogs_coor = np.dot(nii2.get_affine(), cogs)[:3, :]
+        cogs_coor = np.dot(affine2, cogs)[:3, :]
 
         dist_matrix = cdist(cog_t_coor.T, cogs_coor.T)
 
         return np.mean(dist_matrix)
 
+    def _eucl_min(self, nii1, nii2):
+        origdata1 = nii1.get_data().astype(np.bool)
+        border1 = self._find_border(origdata1)
+
+        origdata2 = nii2.get_data().astype(np.bool)
+        border2 = self._find_border(origdata2)
+
+        set1_coordinates = self._get_coordinates(border1, nii1.get_affine())
+
+        set2_coordinates = self._get_coordinates(border2, nii2.get_affine())
+
+        return self._min_distance(set1_coordinates, set2_coordinates)
+
+    def _eucl_cog(self, nii1, nii2):
+        origdata1 = nii1.get_data().astype(np.bool)
+        origdata2 = nii2.get_data().astype(np.bool)
+        return self._cog_distance(origdata1, nii1.get_affine(),
+                                  origdata2, nii2.get_affine())
+
     def _eucl_mean(self, nii1, nii2, weighted=False):
         origdata1 = nii1.get_data().astype(np.bool)
         border1 = self._find_border(origdata1)
@@ -265,14 +299,9 @@ class Distance(BaseInterface):
         set1_coordinates = self._get_coordinates(border1, nii1.get_affine())
         set2_coordinates = self._get_coordinates(origdata2, nii2.get_affine())
 
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        min_dist_matrix = np.amin(dist_matrix, axis=0)
-        import matplotlib.pyplot as plt
-        plt.figure()
-        plt.hist(min_dist_matrix, 50, normed=1, facecolor='green')
-        plt.savefig(self._hist_filename)
-        plt.clf()
-        plt.close()
+        min_dist_matrix = self._nearest(set1_coordinates, set2_coordinates)[0]
+        if self.inputs.save_histogram:
+            self._save_histogram(min_dist_matrix)
 
         if weighted:
             return np.average(min_dist_matrix, weights=nii2.get_data()[origdata2].flat)
@@ -299,14 +328,27 @@ class Distance(BaseInterface):
 
         set1_coordinates = self._get_coordinates(border1, nii1.get_affine())
         set2_coordinates = self._get_coordinates(border2, nii2.get_affine())
-        distances = cdist(set1_coordinates.T, set2_coordinates.T)
-        mins = np.concatenate((np.amin(distances, axis=0), np.amin(distances, axis=1)))
 
-        return np.max(mins)
+        return self._max_distance(set1_coordinates, set2_coordinates)
+
+    def _save_histogram(self, distances):
+        try:
+            import matplotlib.pyplot as plt
+        except ImportError:
+            iflogger.warn('matplotlib is not available, the histogram of the '
+                          'distances is not saved')
+            return
+        plt.figure()
+        plt.hist(distances, 50, normed=1, facecolor='green')
+        plt.savefig(self._hist_filename)
+        plt.clf()
+        plt.close()
+        self._histogram = os.path.abspath(self._hist_filename)
 
     def _run_interface(self, runtime):
         nii1 = nb.load(self.inputs.volume1)
         nii2 = nb.load(self.inputs.volume2)
+        self._histogram = None
 
         if self.inputs.method == "eucl_min":
             self._distance, self._point1, self._point2 = self._eucl_min(nii1, nii2)
@@ -330,16 +372,129 @@ class Distance(BaseInterface):
         if self.inputs.method == "eucl_min":
             outputs['point1'] = self._point1
             outputs['point2'] = self._point2
-        elif self.inputs.method in ["eucl_mean", "eucl_wmean"]:
-            outputs['histogram'] = os.path.abspath(self._hist_filename)
+        elif self.inputs.method in ["eucl_mean", "eucl_wmean"] and \
+                self._histogram:
+            outputs['histogram'] = self._histogram
         return outputs
 
 
+def label_distances(label_file, pairs=None, method='eucl_min'):
+    '''Distances between the regions of a label image
+
+    The borders, coordinates and k-d trees of each region are computed once
+    for all the pairs of regions.
+
+    Parameters
+    ----------
+    label_file : str
+        image of integer labels, 0 being the background
+    pairs : list of (int, int)
+        pairs of labels, all the pairs of labels of the image by default
+    method : str
+        eucl_min, eucl_cog, eucl_mean or eucl_max, as for Distance, with
+        label1 as volume1 and label2 as volume2
+
+    Returns
+    -------
+    dict mapping (label1, label2) to the distance between the regions
+    '''
+    if method not in ['eucl_min', 'eucl_cog', 'eucl_mean', 'eucl_max']:
+        raise ValueError('Unknown distance method %s' % method)
+    nii = nb.load(label_file)
+    data = np.round(nii.get_data()).astype(int)
+    if len(data.shape) == 4:
+        data = data[:, :, :, 0]
+    affine = nii.get_affine()
+    if pairs is None:
+        labels = [value for value in np.unique(data) if value != 0]
+        pairs = list(itertools.combinations(labels, 2))
+    distance = Distance()
+    # bounding boxes of the labels, from a single pass over the image
+    if data.max() > 0:
+        boxes = find_objects(np.maximum(data, 0))
+    else:
+        boxes = []
+    # per region: (bounding box, affine of the box) or None if empty
+    regions = {}
+    borders = {}
+    trees = {}
+    coordinates = {}
+    for label1, label2 in pairs:
+        for value in [label1, label2]:
+            if value in regions:
+                continue
+            region = _label_box(data, boxes, value, affine)
+            regions[value] = region
+            if region is None:
+                continue
+            # the mask of the region only exists while its border is found
+            mask = data[region[0]] == value
+            border = distance._find_border(mask)
+            borders[value] = distance._get_coordinates(border, region[1])
+            trees[value] = cKDTree(borders[value].T)
+        if method == 'eucl_mean' and regions[label2] is not None and \
+                label2 not in coordinates:
+            box, box_affine = regions[label2]
+            coordinates[label2] = distance._get_coordinates(
+                data[box] == label2, box_affine)
+    results = {}
+    for label1, label2 in pairs:
+        if regions[label1] is None or regions[label2] is None:
+            results[(label1, label2)] = np.NaN
+        elif method == 'eucl_min':
+            results[(label1, label2)] = \
+                distance._min_distance(borders[label1], borders[label2],
+                                       trees[label2])[0]
+        elif method == 'eucl_cog':
+            (box1, affine1), (box2, affine2) = regions[label1], regions[label2]
+            results[(label1, label2)] = \
+                distance._cog_distance(data[box1] == label1, affine1,
+                                       data[box2] == label2, affine2)
+        elif method == 'eucl_mean':
+            results[(label1, label2)] = np.mean(
+                distance._nearest(borders[label1], coordinates[label2],
+                                  trees[label1])[0])
+        else:
+            results[(label1, label2)] = \
+                distance._max_distance(borders[label1], borders[label2],
+                                       trees[label1], trees[label2])
+    return results
+
+
+def _label_box(data, boxes, value, affine):
+    """Returns the bounding box of a label, grown by a voxel so that its
+    border is found as in the whole image, and the affine of the box, or
+    None if the label is not in the image"""
+    if 0 < value <= len(boxes):
+        box = boxes[value - 1]
+    elif value > 0:
+        box = None
+    else:
+        # find_objects only handles positive labels
+        indices = np.nonzero(data == value)
+        box = None
+        if len(indices[0]):
+            box = tuple([slice(idx.min(), idx.max() + 1)
+                         for idx in indices])
+    if box is None:
+        return None
+    box = tuple([slice(max(s.start - 1, 0), s.stop + 1) for s in box])
+    shift = np.eye(4)
+    shift[:3, 3] = [s.start for s in box]
+    return box, np.dot(affine, shift)
+
+
 class OverlapInputSpec(BaseInterfaceInputSpec):
     volume1 = File(exists=True, mandatory=True, desc="Has to have the same dimensions as volume2.")
     volume2 = File(exists=True, mandatory=True, desc="Has to have the same dimensions as volume1.")
     mask_volume = File(exists=True, desc="calculate overlap only within this mask.")
     out_file = File("diff.nii", usedefault=True)
+    multi_label = traits.Bool(False, usedefault=True,
+                              desc=("also compute the overlap of each label "
+                                    "of the volumes"))
+    labels = traits.List(traits.Int, desc=("labels compared in multi_label "
+                                           "mode (default: all the nonzero "
+                                           "labels of the volumes)"))
 
 
 class OverlapOutputSpec(TraitedSpec):
@@ -347,12 +502,21 @@ class OverlapOutputSpec(TraitedSpec):
     dice = traits.Float()
     volume_difference = traits.Int()
     diff_file = File(exists=True)
+    label_values = traits.List(traits.Int, desc="labels compared")
+    label_dice = traits.List(traits.Float, desc="dice of each label")
+    label_jaccard = traits.List(traits.Float, desc="jaccard of each label")
+    label_volume_difference = traits.List(traits.Int,
+                                          desc="volume difference of each label")
 
 
 class Overlap(BaseInterface):
     """
     Calculates various overlap measures between two maps.
 
+    In multi_label mode, the overlap of each label of the maps is computed
+    as well, from the joint histogram of the labels of the two maps. See
+    overlap_table to compare the labels of many pairs of maps.
+
     Example
     -------
 
@@ -365,28 +529,35 @@ class Overlap(BaseInterface):
     input_spec = OverlapInputSpec
     output_spec = OverlapOutputSpec
 
-    def _bool_vec_dissimilarity(self, booldata1, booldata2, method):
-        methods = {"dice": dice, "jaccard": jaccard}
-        if not (np.any(booldata1) or np.any(booldata2)):
-            return 0
-        return 1 - methods[method](booldata1.flat, booldata2.flat)
-
     def _run_interface(self, runtime):
         nii1 = nb.load(self.inputs.volume1)
         nii2 = nb.load(self.inputs.volume2)
-
-        origdata1 = np.logical_not(np.logical_or(nii1.get_data() == 0, np.isnan(nii1.get_data())))
-        origdata2 = np.logical_not(np.logical_or(nii2.get_data() == 0, np.isnan(nii2.get_data())))
-
+        maskdata = None
         if isdefined(self.inputs.mask_volume):
             maskdata = nb.load(self.inputs.mask_volume).get_data()
-            maskdata = np.logical_not(np.logical_or(maskdata == 0, np.isnan(maskdata)))
-            origdata1 = np.logical_and(maskdata, origdata1)
-            origdata2 = np.logical_and(maskdata, origdata2)
-
-        for method in ("dice", "jaccard"):
-            setattr(self, '_' + method, self._bool_vec_dissimilarity(origdata1, origdata2, method=method))
 
+        # the overall overlap is that of the nonzero voxels, before the
+        # labels are rounded
+        origdata1, origdata2 = _load_labels(nii1.get_data(), nii2.get_data(),
+                                            maskdata, binary=True)
+        origdata1 = origdata1 != 0
+        origdata2 = origdata2 != 0
+        if self.inputs.multi_label:
+            data1, data2 = _load_labels(nii1.get_data(), nii2.get_data(),
+                                        maskdata)
+            labels = None
+            if isdefined(self.inputs.labels):
+                labels = self.inputs.labels
+            values, counts1, counts2, intersections = \
+                _label_overlaps(data1, data2, labels)
+            self._labels = values.tolist()
+            self._label_dice, self._label_jaccard = \
+                _overlap_measures(counts1, counts2, intersections)
+            self._label_volume = (counts1 - counts2).tolist()
+
+        self._dice, self._jaccard = _overlap_measures(
+            origdata1.sum(), origdata2.sum(),
+            np.logical_and(origdata1, origdata2).sum())
         self._volume = int(origdata1.sum() - origdata2.sum())
 
         both_data = np.zeros(origdata1.shape)
@@ -403,9 +574,131 @@ class Overlap(BaseInterface):
             outputs[method] = getattr(self, '_' + method)
         outputs['volume_difference'] = self._volume
         outputs['diff_file'] = os.path.abspath(self.inputs.out_file)
+        if self.inputs.multi_label:
+            outputs['label_values'] = self._labels
+            outputs['label_dice'] = self._label_dice
+            outputs['label_jaccard'] = self._label_jaccard
+            outputs['label_volume_difference'] = self._label_volume
         return outputs
 
 
+def _load_labels(data1, data2, maskdata=None, binary=False):
+    """Returns the integer labels of two volumes, voxels that are nan or
+    outside of the mask being 0. With binary, all the other nonzero voxels
+    are labelled 1."""
+    labels = []
+    for data in [data1, data2]:
+        data = np.asarray(data)
+        background = np.isnan(data)
+        if maskdata is not None:
+            background |= np.logical_or(maskdata == 0, np.isnan(maskdata))
+        if binary:
+            data = np.logical_and(data != 0, ~background).astype(np.int64)
+        else:
+            data = np.round(np.where(background, 0, data)).astype(np.int64)
+        labels.append(data)
+    return labels
+
+
+def _label_overlaps(data1, data2, labels=None):
+    """Returns the labels compared, the number of voxels of each label in
+    data1 and data2 and the number of voxels of each label in both
+
+    The counts are read from the joint histogram of the labels of the two
+    volumes, computed with a single bincount.
+    """
+    values, inverse = np.unique(np.concatenate((np.ravel(data1),
+                                                np.ravel(data2))),
+                                return_inverse=True)
+    nvalues = len(values)
+    nvoxels = inverse.shape[0] // 2
+    joint = np.bincount(inverse[:nvoxels] * nvalues + inverse[nvoxels:],
+                        minlength=nvalues ** 2).reshape((nvalues, nvalues))
+    if labels is None:
+        labels = values[values != 0]
+    labels = np.asarray(labels, dtype=np.int64)
+    counts1 = np.zeros(len(labels), dtype=np.int64)
+    counts2 = np.zeros(len(labels), dtype=np.int64)
+    intersections = np.zeros(len(labels), dtype=np.int64)
+    index = np.searchsorted(values, labels)
+    present = index < nvalues
+    present[present] = values[index[present]] == labels[present]
+    index = index[present]
+    counts1[present] = joint.sum(axis=1)[index]
+    counts2[present] = joint.sum(axis=0)[index]
+    intersections[present] = joint[index, index]
+    return labels, counts1, counts2, intersections
+
+
+def _overlap_measures(counts1, counts2, intersections):
+    """Returns the dice and jaccard of regions given their volumes and the
+    volume of their intersection (0 for empty regions)"""
+    counts1 = np.asarray(counts1, dtype=float)
+    counts2 = np.asarray(counts2, dtype=float)
+    union = counts1 + counts2 - intersections
+    nonempty = union > 0
+    dice = np.where(nonempty, 2 * intersections /
+                    np.maximum(counts1 + counts2, 1), 0)
+    jaccard = np.where(nonempty, intersections / np.maximum(union, 1), 0)
+    if dice.ndim == 0:
+        return float(dice), float(jaccard)
+    return dice.tolist(), jaccard.tolist()
+
+
+def overlap_table(volumes1, volumes2, out_file, labels=None,
+                  mask_volumes=None, names=None):
+    '''Writes the overlap of each label of many pairs of volumes in a table
+
+    Each pair of volumes (e.g., the automatic and manual segmentations of a
+    subject) is read once, all the labels being compared in a single pass.
+
+    Parameters
+    ----------
+    volumes1, volumes2 : list of str
+        label images compared pairwise
+    out_file : str
+        comma separated table with one row per pair of volumes and label
+    labels : list of int
+        labels compared, all the nonzero labels of each pair by default
+    mask_volumes : list of str
+        images masking each pair of volumes
+    names : list of str
+        names of the pairs (e.g., subject ids) written in the first column,
+        volumes1 by default
+
+    Returns
+    -------
+    out_file : absolute path of the table
+    '''
+    if len(volumes1) != len(volumes2):
+        raise ValueError('volumes1 and volumes2 must have the same length')
+    if names is None:
+        names = volumes1
+    fp = open(out_file, 'wb')
+    try:
+        writer = csv.writer(fp)
+        writer.writerow(['name', 'label', 'volume1', 'volume2', 'dice',
+                         'jaccard', 'volume_difference'])
+        for i, (volume1, volume2) in enumerate(zip(volumes1, volumes2)):
+            maskdata = None
+            if mask_volumes:
+                maskdata = nb.load(mask_volumes[i]).get_data()
+            data1, data2 = _load_labels(nb.load(volume1).get_data(),
+                                        nb.load(volume2).get_data(), maskdata)
+            values, counts1, counts2, intersections = \
+                _label_overlaps(data1, data2, labels)
+            dices, jaccards = _overlap_measures(counts1, counts2,
+                                                intersections)
+            for value, count1, count2, dice, jaccard in \
+                    zip(values, counts1, counts2, dices, jaccards):
+                writer.writerow([names[i], value, count1, count2,
+                                 '%.6f' % dice, '%.6f' % jaccard,
+                                 count1 - count2])
+    finally:
+        fp.close()
+    return os.path.abspath(out_file)
+
+
 class CreateNiftiInputSpec(BaseInterfaceInputSpec):
     data_file = File(exists=True, mandatory=True, desc="ANALYZE img file")
     header_file = File(exists=True, mandatory=True, desc="corresponding ANALYZE hdr file")
@@ -448,6 +741,11 @@ class TSNRInputSpec(BaseInterfaceInputSpec):
     in_file = InputMultiPath(File(exists=True), mandatory=True,
                    desc='realigned 4D file or a list of 3D files')
     regress_poly = traits.Int(min=1, desc='Remove polynomials')
+    output_dtype = traits.Enum('float32', 'float64', usedefault=True,
+                               desc='data type of the output images')
+    chunk_size_mb = traits.Float(256, usedefault=True, nohash=True,
+                                 desc=('size (in MB) of the blocks of volumes '
+                                       'read at once'))
 
 
 class TSNROutputSpec(TraitedSpec):
@@ -482,33 +780,108 @@ class TSNR(BaseInterface):
         else:
             return os.path.abspath(base + "_tsnr" + ext)
 
+    def _volume_blocks(self, reader):
+        """Yields the volumes of the images as float64 (voxels x volumes)
+        blocks"""
+        for block in reader.blocks():
+            yield block.astype(np.float64)
+
     def _run_interface(self, runtime):
         img = nb.load(self.inputs.in_file[0])
         vollist = [nb.load(filename) for filename in self.inputs.in_file]
-        data = np.concatenate([vol.get_data().reshape(vol.get_shape()[:3] + (-1,)) for vol in vollist], axis=3)
+        shape = img.get_shape()[:3]
+        timepoints = sum([int(np.prod(vol.get_shape()[3:]))
+                          for vol in vollist])
+        # regressors of the detrending, the constant being kept
+        X = np.ones((timepoints, 1))
         if isdefined(self.inputs.regress_poly):
-            timepoints = img.get_shape()[-1]
-            X = np.ones((timepoints, 1))
             for i in range(self.inputs.regress_poly):
                 X = np.hstack((X, legendre(i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
-            betas = np.dot(np.linalg.pinv(X), np.rollaxis(data, 3, 2))
-            datahat = np.rollaxis(np.dot(X[:, 1:],
-                                         np.rollaxis(betas[1:, :, :, :], 0, 3)),
-                                  0, 4)
-            data = data - datahat
-            img = nb.Nifti1Image(data, img.get_affine(), img.get_header())
-            nb.save(img, self._gen_output_file_name('detrended'))
-        meanimg = np.mean(data, axis=3)
-        stddevimg = np.std(data, axis=3)
-        tsnr = meanimg / stddevimg
-        img = nb.Nifti1Image(tsnr, img.get_affine(), img.get_header())
-        nb.save(img, self._gen_output_file_name())
-        img = nb.Nifti1Image(meanimg, img.get_affine(), img.get_header())
-        nb.save(img, self._gen_output_file_name('mean'))
-        img = nb.Nifti1Image(stddevimg, img.get_affine(), img.get_header())
-        nb.save(img, self._gen_output_file_name('stddev'))
+        # the betas and the products of the data with the polynomials are
+        # accumulated with the sums of the data and of its squares in a
+        # single pass. The data are taken relative to the first volume for
+        # numerical stability, which does not change the betas of the
+        # polynomials.
+        regressors = X[:, 1:]
+        projection = np.hstack((np.linalg.pinv(X)[1:].T, regressors))
+        npoly = regressors.shape[1]
+        # compressed images are decompressed once, for both passes
+        reader = VolumeReader(vollist, self.inputs.chunk_size_mb * 1e6,
+                              tmpdir=os.getcwd())
+        try:
+            first = None
+            t0 = 0
+            for data in self._volume_blocks(reader):
+                if first is None:
+                    first = data[:, :1].copy()
+                    sums = np.zeros(first.shape[0])
+                    squares = np.zeros(first.shape[0])
+                    products = np.zeros((first.shape[0], 2 * npoly))
+                data -= first
+                sums += data.sum(axis=1)
+                squares += (data ** 2).sum(axis=1)
+                if npoly:
+                    products += np.dot(data,
+                                       projection[t0:t0 + data.shape[1]])
+                t0 += data.shape[1]
+            meanimg = first[:, 0] + sums / timepoints
+            variance = squares / timepoints - (sums / timepoints) ** 2
+            if npoly:
+                # sums of the residuals of the fit of the polynomials
+                betas = products[:, :npoly]
+                cross = products[:, npoly:]
+                residual_sums = sums - np.dot(betas, regressors.sum(axis=0))
+                residual_squares = (squares -
+                                    2 * (betas * cross).sum(axis=1) +
+                                    (np.dot(betas, np.dot(regressors.T,
+                                                          regressors)) *
+                                     betas).sum(axis=1))
+                meanimg = first[:, 0] + residual_sums / timepoints
+                variance = residual_squares / timepoints - \
+                    (residual_sums / timepoints) ** 2
+            stddevimg = np.sqrt(np.maximum(variance, 0))
+            tsnr = meanimg / stddevimg
+
+            dtype = np.dtype(self.inputs.output_dtype)
+            header = img.get_header().copy()
+            header.set_data_dtype(dtype)
+            if isdefined(self.inputs.regress_poly):
+                self._save_detrended(reader, betas, regressors,
+                                     img.get_affine(), header,
+                                     shape + (timepoints,))
+        finally:
+            reader.close()
+        header.set_data_shape(shape)
+        for suffix, values in [(None, tsnr), ('mean', meanimg),
+                               ('stddev', stddevimg)]:
+            out_img = nb.Nifti1Image(values.reshape(shape, order='F').astype(dtype),
+                                     img.get_affine(), header)
+            nb.save(out_img, self._gen_output_file_name(suffix))
         return runtime
 
+    def _save_detrended(self, reader, betas, regressors, affine, header,
+                        shape):
+        """Writes the detrended data block by block through a memory map"""
+        filename = self._gen_output_file_name('detrended')
+        mapfile = filename + '.dat'
+        dtype = header.get_data_dtype()
+        detrended = np.memmap(mapfile, dtype=dtype, mode='w+', shape=shape,
+                              order='F')
+        try:
+            t0 = 0
+            for data in self._volume_blocks(reader):
+                nvols = data.shape[1]
+                data -= np.dot(betas, regressors[t0:t0 + nvols].T)
+                detrended[..., t0:t0 + nvols] = \
+                    data.reshape(shape[:3] + (nvols,), order='F')
+                t0 += nvols
+            header = header.copy()
+            header.set_data_shape(shape)
+            nb.save(nb.Nifti1Image(detrended, affine, header), filename)
+        finally:
+            del detrended
+            os.remove(mapfile)
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['tsnr_file'] = self._gen_output_file_name()
@@ -21,7 +21,6 @@ These functions include:
 from copy import deepcopy
 import os
 
-from nibabel import load
 import numpy as np
 from scipy.special import gammaln
 
@@ -29,6 +28,7 @@ from nipype.interfaces.base import (BaseInterface, TraitedSpec, InputMultiPath,
                                     traits, File, Bunch, BaseInterfaceInputSpec,
                                     isdefined)
 from nipype.utils.filemanip import filename_to_list
+from nipype.utils.imageheader import image_shape
 from .. import config, logging
 iflogger = logging.getLogger('interface')
 
@@ -324,7 +324,7 @@ class SpecifyModel(BaseInterface):
             for i, out in enumerate(outliers):
                 numscans = 0
                 for f in filename_to_list(sessinfo[i]['scans']):
-                    numscans += load(f).get_shape()[3]
+                    numscans += image_shape(f)[3]
                 for j, scanno in enumerate(out):
                     colidx = len(sessinfo[i]['regress'])
                     sessinfo[i]['regress'].insert(colidx, dict(name='', val=[]))
@@ -418,8 +418,7 @@ class SpecifySPMModel(SpecifyModel):
             if isinstance(f, list):
                 numscans = len(f)
             elif isinstance(f, str):
-                img = load(f)
-                numscans = img.get_shape()[3]
+                numscans = image_shape(f)[3]
             else:
                 raise Exception('Functional input not specified correctly')
             nscans.insert(i, numscans)
@@ -706,8 +705,7 @@ class SpecifySparseModel(SpecifyModel):
             infoout[i].onsets = None
             infoout[i].durations = None
             if info.conditions:
-                img = load(self.inputs.functional_runs[i])
-                nscans = img.get_shape()[3]
+                nscans = image_shape(self.inputs.functional_runs[i])[3]
                 reg, regnames = self._cond_to_regress(info, nscans)
                 if hasattr(infoout[i], 'regressors') and infoout[i].regressors:
                     if not infoout[i].regressor_names:
@@ -20,8 +20,9 @@ These functions include:
 
 import os
 from copy import deepcopy
+import threading
 
-from nibabel import load, funcs
+from nibabel import load
 import numpy as np
 from scipy import signal
 import scipy.io as sio
@@ -30,8 +31,18 @@ from nipype.interfaces.base import (BaseInterface, traits, InputMultiPath,
                                     OutputMultiPath, TraitedSpec, File,
                                     BaseInterfaceInputSpec, isdefined)
 from nipype.utils.filemanip import filename_to_list, save_json
+from nipype.utils.imagedata import VolumeReader
 from nipype.utils.misc import find_indices
 
+# pyplot is not thread safe
+_plot_lock = threading.Lock()
+
+
+def _stack_dot(a, b):
+    """Matrix products of two stacks of matrices (n x i x j, n x j x k)"""
+    return (a[:, :, :, None] * b[:, None, :, :]).sum(axis=2)
+
+
 class ArtifactDetectInputSpec(BaseInterfaceInputSpec):
     realigned_files = InputMultiPath(File(exists=True),
                                      desc="Names of realigned functional data files",
@@ -71,6 +82,11 @@ class ArtifactDetectInputSpec(BaseInterfaceInputSpec):
                             usedefault=True)
     plot_type = traits.Enum('png', 'svg', 'eps', 'pdf', desc="file type of the outlier plot",
                             usedefault=True)
+    chunk_size_mb = traits.Float(256, usedefault=True, nohash=True,
+            desc="Size (in MB) of the blocks of volumes read at once from " \
+            "the functional data, bounding the memory used for each run")
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc="Number of runs processed in parallel")
 
 
 class ArtifactDetectOutputSpec(TraitedSpec):
@@ -95,6 +111,10 @@ class ArtifactDetect(BaseInterface):
     True, it computes the movement of the center of each face a cuboid centered
     around the head and returns the maximal movement across the centers.
 
+    The functional data are read in blocks of volumes of at most
+    `chunk_size_mb` MB (memory mapped when the images are not compressed),
+    and runs are processed `num_threads` at a time.
+
 
     Examples
     --------
@@ -199,6 +219,45 @@ class ArtifactDetect(BaseInterface):
 
         return np.dot(T, np.dot(Rx, np.dot(Ry, np.dot(Rz, np.dot(S, Sh)))))
 
+    def _get_affine_matrices(self, params):
+        """Returns the affine matrices of several sets of parameters
+
+        params : np.array (n x upto 12)
+        one set of parameters per row, as in _get_affine_matrix
+
+        """
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        n = params.shape[0]
+        q = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0])
+        if params.shape[1] < 12:
+            params = np.hstack((params,
+                                np.tile(q[params.shape[1]:], (n, 1))))
+        eye = lambda: np.tile(np.eye(4), (n, 1, 1))
+        cos = np.cos(params[:, 3:6])
+        sin = np.sin(params[:, 3:6])
+        # Translation
+        T = eye()
+        T[:, 0:3, 3] = params[:, 0:3]
+        # Rotation
+        Rx = eye()
+        Rx[:, (1, 1, 2, 2), (1, 2, 1, 2)] = np.column_stack(
+            (cos[:, 0], sin[:, 0], -sin[:, 0], cos[:, 0]))
+        Ry = eye()
+        Ry[:, (0, 0, 2, 2), (0, 2, 0, 2)] = np.column_stack(
+            (cos[:, 1], sin[:, 1], -sin[:, 1], cos[:, 1]))
+        Rz = eye()
+        Rz[:, (0, 0, 1, 1), (0, 1, 0, 1)] = np.column_stack(
+            (cos[:, 2], sin[:, 2], -sin[:, 2], cos[:, 2]))
+        # Scaling
+        S = eye()
+        S[:, (0, 1, 2), (0, 1, 2)] = params[:, 6:9]
+        # Shear
+        Sh = eye()
+        Sh[:, (0, 0, 1), (1, 2, 2)] = params[:, 9:12]
+
+        return _stack_dot(T, _stack_dot(Rx, _stack_dot(Ry, _stack_dot(Rz,
+                                                       _stack_dot(S, Sh)))))
+
     def _calc_norm(self, mc, use_differences):
         """Calculates the maximum overall displacement of the midpoints
         of the faces of a cube due to translation and rotation.
@@ -220,14 +279,12 @@ class ArtifactDetect(BaseInterface):
         # respos=np.diag([50, 50, 50]);resneg=np.diag([-50,-50,-50]);
         # XXX - SG why not the above box
         cube_pts = np.vstack((np.hstack((respos, resneg)), np.ones((1, 6))))
-        newpos = np.zeros((mc.shape[0], 18))
-        for i in range(mc.shape[0]):
-            newpos[i, :] = np.dot(self._get_affine_matrix(mc[i, :]), cube_pts)[0:3, :].ravel()
-        normdata = np.zeros(mc.shape[0])
+        newpos = _stack_dot(self._get_affine_matrices(mc), cube_pts[None])
+        newpos = newpos[:, 0:3, :].reshape((mc.shape[0], 18))
         if use_differences:
             newpos = np.concatenate((np.zeros((1, 18)), np.diff(newpos, n=1, axis=0)), axis=0)
-            for i in range(newpos.shape[0]):
-                normdata[i] = np.max(np.sqrt(np.sum(np.reshape(np.power(np.abs(newpos[i, :]), 2), (3, 6)), axis=0)))
+            normdata = np.max(np.sqrt(np.sum(np.power(newpos.reshape((-1, 3, 6)), 2),
+                                             axis=1)), axis=1)
         else:
             #if not registered to mean we may want to use this
             #mc_sum = np.sum(np.abs(mc), axis=1)
@@ -244,6 +301,76 @@ class ArtifactDetect(BaseInterface):
         else:
             return np.nansum(a) / np.sum(1 - np.isnan(a))
 
+    def _masked_means(self, data, volmask):
+        """Returns the mean of each volume (column) of data over volmask,
+        a mask of the voxels of each volume or a mask of voxels common to
+        all the volumes, computing on the stored data type"""
+        if volmask.ndim == 1:
+            return self._means(data[volmask])
+        if data.dtype.kind == 'f':
+            # nans are never in the masks
+            sums = np.where(volmask, data, 0).sum(axis=0, dtype=np.float64)
+        else:
+            sums = (data * volmask).sum(axis=0, dtype=np.int64)
+        return sums / volmask.sum(axis=0).astype(np.float64)
+
+    def _means(self, data):
+        """Returns the mean of each volume (column) of data, ignoring nans"""
+        if data.dtype.kind == 'f':
+            return np.nansum(data, axis=0, dtype=np.float64) / \
+                (~np.isnan(data)).sum(axis=0)
+        return data.sum(axis=0, dtype=np.float64) / data.shape[0]
+
+    def _above(self, data, thresholds):
+        """Returns the mask of the values of data above thresholds,
+        comparing integers to integers"""
+        if data.dtype.kind in 'iu':
+            info = np.iinfo(data.dtype)
+            floors = np.floor(thresholds)
+            if np.all(floors >= info.min) and np.all(floors <= info.max):
+                thresholds = floors.astype(data.dtype)
+        return data > thresholds
+
+    def _global_signal(self, images):
+        """Returns the masked mean intensity of each volume"""
+        reader = VolumeReader(images, self.inputs.chunk_size_mb * 1e6)
+        try:
+            g = self._reader_global_signal(reader)
+        finally:
+            reader.close()
+        return np.concatenate(g)[:, None]
+
+    def _reader_global_signal(self, reader):
+        """Returns the list of the global signals of the blocks"""
+        nvoxels = reader.nvoxels
+        masktype = self.inputs.mask_type
+        g = []
+        if masktype == 'spm_global':  # spm_global like calculation
+            intersect_mask = self.inputs.intersect_mask
+            mask = np.ones(nvoxels, dtype=bool)
+            for data in reader.blocks():
+                volmask = self._above(data, self._means(data) / 8)
+                g.append(self._masked_means(data, volmask))
+                if intersect_mask:
+                    mask &= volmask.all(axis=1)
+            if intersect_mask and mask.sum() >= nvoxels / 10:
+                g = [self._masked_means(data, mask)
+                     for data in reader.blocks()]
+        elif masktype == 'file':  # uses a mask image to determine intensity
+            mask = load(self.inputs.mask_file).get_data().reshape(nvoxels,
+                                                                  order='F')
+            mask = mask > 0.5
+            for data in reader.blocks():
+                g.append(self._masked_means(data, mask))
+        elif masktype == 'thresh':  # uses a fixed signal threshold
+            for data in reader.blocks():
+                volmask = self._above(data, self.inputs.mask_threshold)
+                g.append(self._masked_means(data, volmask))
+        else:
+            for data in reader.blocks():
+                g.append(self._means(data))
+        return g
+
     def _plot_outliers_with_wave(self, wave, outliers, name):
         import matplotlib.pyplot as plt
         plt.plot(wave)
@@ -287,54 +414,9 @@ class ArtifactDetect(BaseInterface):
             tidx = find_indices(np.sum(abs(traval) > self.inputs.translation_threshold, 1) > 0)
             ridx = find_indices(np.sum(abs(rotval) > self.inputs.rotation_threshold, 1) > 0)
 
-        # read in functional image
-        if isinstance(imgfile, str):
-            nim = load(imgfile)
-        elif isinstance(imgfile, list):
-            if len(imgfile) == 1:
-                nim = load(imgfile[0])
-            else:
-                images = [load(f) for f in imgfile]
-                nim = funcs.concat_images(images)
-
-        # compute global intensity signal
-        (x, y, z, timepoints) = nim.get_shape()
-
-        data = nim.get_data()
-        g = np.zeros((timepoints, 1))
-        masktype = self.inputs.mask_type
-        if  masktype == 'spm_global':  # spm_global like calculation
-            intersect_mask = self.inputs.intersect_mask
-            if intersect_mask:
-                mask = np.ones((x, y, z), dtype=bool)
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    mask = mask * (vol > (self._nanmean(vol) / 8))
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    g[t0] = self._nanmean(vol[mask])
-                if len(find_indices(mask)) < (np.prod((x, y, z)) / 10):
-                    intersect_mask = False
-                    g = np.zeros((timepoints, 1))
-            if not intersect_mask:
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    mask = vol > (self._nanmean(vol) / 8)
-                    g[t0] = self._nanmean(vol[mask])
-        elif masktype == 'file':  # uses a mask image to determine intensity
-            mask = load(self.inputs.mask_file).get_data()
-            mask = mask > 0.5
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
-                g[t0] = self._nanmean(vol[mask])
-        elif masktype == 'thresh':  # uses a fixed signal threshold
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
-                mask = vol > self.inputs.mask_threshold
-                g[t0] = self._nanmean(vol[mask])
-        else:
-            mask = np.ones((x, y, z))
-            g = self._nanmean(data[mask > 0, :], 1)
+        # compute global intensity signal of the functional images
+        images = [load(f) for f in filename_to_list(imgfile)]
+        g = self._global_signal(images)
 
         # compute normalized intensity values
         gz = signal.detrend(g, axis=0)       # detrend the signal
@@ -354,25 +436,26 @@ class ArtifactDetect(BaseInterface):
 
         if isdefined(self.inputs.save_plot) and self.inputs.save_plot:
             import matplotlib.pyplot as plt
-            fig = plt.figure()
-            if isdefined(self.inputs.use_norm) and self.inputs.use_norm:
-                plt.subplot(211)
-            else:
-                plt.subplot(311)
-            self._plot_outliers_with_wave(gz, iidx, 'Intensity')
-            if isdefined(self.inputs.use_norm) and self.inputs.use_norm:
-                plt.subplot(212)
-                self._plot_outliers_with_wave(normval, np.union1d(tidx, ridx), 'Norm (mm)')
-            else:
-                diff = ''
-                if self.inputs.use_differences[0]:
-                    diff = 'diff'
-                plt.subplot(312)
-                self._plot_outliers_with_wave(traval, tidx, 'Translation (mm)' + diff)
-                plt.subplot(313)
-                self._plot_outliers_with_wave(rotval, ridx, 'Rotation (rad)' + diff)
-            plt.savefig(plotfile)
-            plt.close(fig)
+            with _plot_lock:
+                fig = plt.figure()
+                if isdefined(self.inputs.use_norm) and self.inputs.use_norm:
+                    plt.subplot(211)
+                else:
+                    plt.subplot(311)
+                self._plot_outliers_with_wave(gz, iidx, 'Intensity')
+                if isdefined(self.inputs.use_norm) and self.inputs.use_norm:
+                    plt.subplot(212)
+                    self._plot_outliers_with_wave(normval, np.union1d(tidx, ridx), 'Norm (mm)')
+                else:
+                    diff = ''
+                    if self.inputs.use_differences[0]:
+                        diff = 'diff'
+                    plt.subplot(312)
+                    self._plot_outliers_with_wave(traval, tidx, 'Translation (mm)' + diff)
+                    plt.subplot(313)
+                    self._plot_outliers_with_wave(rotval, ridx, 'Rotation (rad)' + diff)
+                plt.savefig(plotfile)
+                plt.close(fig)
 
         motion_outliers = np.union1d(tidx, ridx)
         stats = [{'motion_file': motionfile,
@@ -407,8 +490,21 @@ class ArtifactDetect(BaseInterface):
         """
         funcfilelist = filename_to_list(self.inputs.realigned_files)
         motparamlist = filename_to_list(self.inputs.realignment_parameters)
-        for i, imgf in enumerate(funcfilelist):
-            self._detect_outliers_core(imgf, motparamlist[i], i, os.getcwd())
+        cwd = os.getcwd()
+        detect = lambda i: self._detect_outliers_core(funcfilelist[i],
+                                                      motparamlist[i], i, cwd)
+        num_threads = min(self.inputs.num_threads, len(funcfilelist))
+        if num_threads < 2:
+            map(detect, range(len(funcfilelist)))
+        else:
+            # numpy and reading the images release the GIL
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(num_threads)
+            try:
+                pool.map(detect, range(len(funcfilelist)))
+            finally:
+                pool.close()
+                pool.join()
         return runtime
 
 
@@ -1,6 +1,11 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+import nibabel as nb
 import numpy as np
-from nipype.testing import assert_equal
-from nipype.algorithms.icc import ICC_rep_anova
+from nipype.testing import assert_equal, assert_almost_equal
+from nipype.algorithms.icc import ICC_rep_anova, ICC
 
 
 def test_ICC_rep_anova():
@@ -19,3 +24,60 @@ def test_ICC_rep_anova():
     yield assert_equal, dfc, 3
     yield assert_equal, dfe, 15
     yield assert_equal, r_var/(r_var + e_var), icc
+
+
+def ICC_rep_anova_pinv(Y):
+    """reference: residuals of the least squares fit of the design"""
+    nb_subjects, nb_conditions = Y.shape
+    x = np.kron(np.eye(nb_conditions), np.ones((nb_subjects, 1)))
+    x0 = np.tile(np.eye(nb_subjects), (nb_conditions, 1))
+    X = np.hstack([x, x0])
+    predicted_Y = np.dot(np.dot(np.dot(X, np.linalg.pinv(np.dot(X.T, X))),
+                                X.T), Y.flatten('F'))
+    SSE = ((Y.flatten('F') - predicted_Y) ** 2).sum()
+    return SSE / ((nb_subjects - 1) * (nb_conditions - 1))
+
+
+def test_ICC_rep_anova_batch():
+    Y = np.random.RandomState(0).randn(20, 6, 3)
+    icc, r_var, e_var, session_F, _, _ = ICC_rep_anova(Y)
+    yield assert_equal, icc.shape, (20,)
+    for i in [0, 7, 19]:
+        single = ICC_rep_anova(Y[i])
+        for batch, value in zip([icc, r_var, e_var, session_F], single):
+            yield assert_almost_equal, batch[i], value
+        yield assert_almost_equal, e_var[i], ICC_rep_anova_pinv(Y[i])
+
+
+def test_ICC():
+    tmpdir = mkdtemp()
+    cwd = os.getcwd()
+    rng = np.random.RandomState(0)
+    subject_effect = rng.randn(4, 5, 6, 5)
+    sessions = []
+    for subject in range(5):
+        sessions.append([])
+        for session in range(2):
+            data = subject_effect[..., subject] + rng.randn(4, 5, 6) * 0.5
+            sessions[-1].append(os.path.join(tmpdir, 's%d_%d.nii' %
+                                             (subject, session)))
+            nb.save(nb.Nifti1Image(data, np.eye(4)), sessions[-1][-1])
+    mask = np.zeros((4, 5, 6))
+    mask[1:3, 1:4, 1:5] = 1
+    nb.save(nb.Nifti1Image(mask, np.eye(4)), os.path.join(tmpdir, 'mask.nii'))
+    os.chdir(tmpdir)
+    try:
+        outputs = ICC(subjects_sessions=sessions, mask='mask.nii',
+                      block_size=7).run().outputs
+        Y = np.array([[nb.load(f).get_data()[1, 2, 3] for f in subject]
+                      for subject in sessions])
+        expected = ICC_rep_anova(Y)
+        for name, value in zip(['icc_map', 'subject_var_map',
+                                'session_var_map', 'sessions_F_map'],
+                               expected):
+            data = nb.load(getattr(outputs, name)).get_data()
+            yield assert_almost_equal, data[1, 2, 3], value
+            yield assert_equal, data[0, 0, 0], 0
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
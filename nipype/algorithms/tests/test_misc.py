@@ -0,0 +1,232 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import csv
+import os
+import shutil
+from tempfile import mkdtemp
+
+import nibabel as nb
+import numpy as np
+from scipy.spatial.distance import cdist, euclidean
+from scipy.special import legendre
+
+from nipype.testing import assert_equal, assert_true, assert_almost_equal
+import nipype.algorithms.misc as misc
+from nipype.interfaces.base import Undefined
+
+
+def tsnr_reference(data, regress_poly=None):
+    """detrending of the whole time series at once"""
+    if regress_poly:
+        timepoints = data.shape[-1]
+        X = np.ones((timepoints, 1))
+        for i in range(regress_poly):
+            X = np.hstack((X, legendre(i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
+        betas = np.dot(np.linalg.pinv(X), np.rollaxis(data, 3, 2))
+        datahat = np.rollaxis(np.dot(X[:, 1:],
+                                     np.rollaxis(betas[1:, :, :, :], 0, 3)),
+                              0, 4)
+        data = data - datahat
+    return data, np.mean(data, axis=3), np.std(data, axis=3)
+
+
+def test_tsnr():
+    tmpdir = mkdtemp()
+    cwd = os.getcwd()
+    rng = np.random.RandomState(0)
+    data = 1000 + rng.randn(5, 6, 7, 30) * 10
+    data += np.linspace(0, 50, 30) ** 2 / 50
+    for ext in ['.nii', '.nii.gz']:
+        nb.save(nb.Nifti1Image(data.astype(np.float32), np.eye(4)),
+                os.path.join(tmpdir, 'func' + ext))
+    for i in range(30):
+        nb.save(nb.Nifti1Image(data[..., i].astype(np.float32), np.eye(4)),
+                os.path.join(tmpdir, 'vol%02d.nii' % i))
+    data = data.astype(np.float32).astype(np.float64)
+    os.chdir(tmpdir)
+    try:
+        # blocks of 4 volumes
+        tsnr = misc.TSNR(in_file='func.nii',
+                         chunk_size_mb=5 * 6 * 7 * 4 * 4 / 1e6)
+        outputs = tsnr.run().outputs
+        detrended, mean, std = tsnr_reference(data)
+        yield (assert_almost_equal, nb.load(outputs.mean_file).get_data(),
+               mean, 3)
+        yield (assert_almost_equal, nb.load(outputs.stddev_file).get_data(),
+               std, 3)
+        yield (assert_almost_equal, nb.load(outputs.tsnr_file).get_data(),
+               mean / std, 3)
+        yield (assert_equal, nb.load(outputs.tsnr_file).get_data_dtype(),
+               np.float32)
+        # detrending, with a list of 3D files
+        tsnr.inputs.in_file = ['vol%02d.nii' % i for i in range(30)]
+        tsnr.inputs.regress_poly = 2
+        tsnr.inputs.output_dtype = 'float64'
+        outputs = tsnr.run().outputs
+        detrended, mean, std = tsnr_reference(data, 2)
+        yield (assert_almost_equal, nb.load(outputs.mean_file).get_data(),
+               mean)
+        yield (assert_almost_equal, nb.load(outputs.stddev_file).get_data(),
+               std)
+        yield (assert_almost_equal,
+               nb.load(outputs.detrended_file).get_data(), detrended)
+        yield (assert_equal, nb.load(outputs.tsnr_file).get_data_dtype(),
+               np.float64)
+        # compressed image, decompressed to a temporary file
+        tsnr.inputs.in_file = 'func.nii.gz'
+        outputs = tsnr.run().outputs
+        yield (assert_almost_equal,
+               nb.load(outputs.detrended_file).get_data(), detrended)
+        yield (assert_almost_equal, nb.load(outputs.tsnr_file).get_data(),
+               mean / std)
+        # the memory map of the detrended data and the temporary files are
+        # removed
+        yield assert_equal, [f for f in os.listdir(tmpdir)
+                             if f.endswith('.dat') or f.endswith('.raw')], []
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def make_labels(tmpdir):
+    data = np.zeros((20, 20, 20), dtype=np.int16)
+    data[2:8, 3:9, 4:10] = 1
+    data[12:18, 10:17, 6:12] = 2
+    data[5:9, 14:18, 14:18] = 3
+    affine = np.diag([2., 2.5, 3., 1.])
+    affine[:3, 3] = [-10, 5, 7]
+    files = {}
+    for name, values in [('labels', data), ('one', data == 1),
+                         ('two', data == 2)]:
+        files[name] = os.path.join(tmpdir, name + '.nii')
+        nb.save(nb.Nifti1Image(values.astype(np.int16), affine),
+                files[name])
+    return files, data, affine
+
+
+def test_distance():
+    tmpdir = mkdtemp()
+    cwd = os.getcwd()
+    files, data, affine = make_labels(tmpdir)
+    distance = misc.Distance()
+    borders = []
+    for value in [1, 2]:
+        border = distance._find_border(data == value)
+        borders.append(distance._get_coordinates(border, affine).T)
+    region2 = distance._get_coordinates(data == 2, affine).T
+    matrix = cdist(borders[0], borders[1])
+    os.chdir(tmpdir)
+    try:
+        distance = misc.Distance(volume1=files['one'], volume2=files['two'],
+                                 save_histogram=False)
+        outputs = distance.run().outputs
+        yield assert_almost_equal, outputs.distance, matrix.min()
+        yield (assert_almost_equal,
+               euclidean(outputs.point1, outputs.point2), matrix.min())
+        distance.inputs.method = 'eucl_mean'
+        outputs = distance.run().outputs
+        yield (assert_almost_equal, outputs.distance,
+               cdist(borders[0], region2).min(axis=0).mean())
+        yield assert_equal, outputs.histogram, Undefined
+        distance.inputs.method = 'eucl_max'
+        outputs = distance.run().outputs
+        yield (assert_almost_equal, outputs.distance,
+               max(matrix.min(axis=0).max(), matrix.min(axis=1).max()))
+        # distances between the pairs of labels
+        distances = misc.label_distances(files['labels'], method='eucl_max')
+        yield assert_equal, sorted(distances), [(1, 2), (1, 3), (2, 3)]
+        yield assert_almost_equal, distances[(1, 2)], outputs.distance
+        distances = misc.label_distances(files['labels'], [(1, 2), (1, 4)])
+        yield assert_almost_equal, distances[(1, 2)], matrix.min()
+        yield assert_true, np.isnan(distances[(1, 4)])
+        for method in ['eucl_min', 'eucl_cog', 'eucl_mean', 'eucl_max']:
+            distance.inputs.method = method
+            distances = misc.label_distances(files['labels'], [(1, 2)],
+                                             method=method)
+            yield (assert_almost_equal, distances[(1, 2)],
+                   distance.run().outputs.distance)
+        # labels touching the edges of the image, negative labels
+        edges = np.zeros((20, 20, 20), dtype=np.int16)
+        edges[:5, :20, 15:] = 5
+        edges[10:14, 0:3, 0:4] = -1
+        edges[18:, 12:16, 3:] = 7
+        nb.save(nb.Nifti1Image(edges, affine), 'edges.nii')
+        for method in ['eucl_min', 'eucl_cog', 'eucl_mean', 'eucl_max']:
+            distance.inputs.method = method
+            distances = misc.label_distances('edges.nii', method=method)
+            for label1, label2 in [(-1, 5), (-1, 7), (5, 7)]:
+                for value, name in [(label1, 'one.nii'), (label2, 'two.nii')]:
+                    nb.save(nb.Nifti1Image((edges == value).astype(np.int16),
+                                           affine), name)
+                distance.inputs.volume1 = 'one.nii'
+                distance.inputs.volume2 = 'two.nii'
+                yield (assert_almost_equal, distances[(label1, label2)],
+                       distance.run().outputs.distance)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def test_overlap():
+    tmpdir = mkdtemp()
+    cwd = os.getcwd()
+    files, data, affine = make_labels(tmpdir)
+    shifted = np.roll(data, 2, axis=0)
+    shifted[shifted == 3] = 0
+    files['shifted'] = os.path.join(tmpdir, 'shifted.nii')
+    nb.save(nb.Nifti1Image(shifted, affine), files['shifted'])
+    os.chdir(tmpdir)
+    try:
+        overlap = misc.Overlap(volume1=files['labels'],
+                               volume2=files['shifted'])
+        outputs = overlap.run().outputs
+        both = np.logical_and(data > 0, shifted > 0).sum()
+        yield (assert_almost_equal, outputs.dice,
+               2. * both / ((data > 0).sum() + (shifted > 0).sum()))
+        yield assert_equal, outputs.label_dice, Undefined
+        overlap.inputs.multi_label = True
+        outputs = overlap.run().outputs
+        yield assert_equal, outputs.label_values, [1, 2, 3]
+        for i, value in enumerate(outputs.label_values):
+            region1 = data == value
+            region2 = shifted == value
+            both = np.logical_and(region1, region2).sum()
+            yield (assert_almost_equal, outputs.label_dice[i],
+                   2. * both / (region1.sum() + region2.sum()))
+            yield (assert_almost_equal, outputs.label_jaccard[i],
+                   float(both) / np.logical_or(region1, region2).sum())
+            yield (assert_equal, outputs.label_volume_difference[i],
+                   region1.sum() - region2.sum())
+        yield assert_equal, outputs.label_dice[2], 0
+        # one table for many pairs of volumes
+        table = misc.overlap_table([files['labels'], files['one']],
+                                   [files['shifted'], files['one']],
+                                   'overlap.csv', labels=[1, 2],
+                                   names=['s1', 's2, retest'])
+        rows = list(csv.reader(open(table, 'rb')))
+        yield assert_equal, len(rows), 5
+        yield assert_equal, rows[1][:2], ['s1', '1']
+        yield (assert_almost_equal, float(rows[1][4]),
+               outputs.label_dice[0], 5)
+        yield assert_equal, rows[3][:5], ['s2, retest', '1', '216', '216',
+                                          '1.000000']
+        yield assert_equal, rows[4][2:6], ['0', '0', '0.000000', '0.000000']
+        # the overall overlap is that of the nonzero voxels, also for
+        # values rounded to 0 in multi_label mode
+        fractions = data.astype(np.float32)
+        fractions[fractions == 1] = 0.3
+        nb.save(nb.Nifti1Image(fractions, affine), 'fractions.nii')
+        overlap.inputs.volume1 = 'fractions.nii'
+        overlap.inputs.multi_label = False
+        binary = overlap.run().outputs
+        overlap.inputs.multi_label = True
+        outputs = overlap.run().outputs
+        yield assert_equal, outputs.label_values, [1, 2, 3]
+        for measure in ['dice', 'jaccard', 'volume_difference']:
+            yield (assert_equal, getattr(outputs, measure),
+                   getattr(binary, measure))
+        yield assert_equal, outputs.volume_difference, \
+            (data > 0).sum() - (shifted > 0).sum()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
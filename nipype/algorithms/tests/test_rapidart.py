@@ -1,5 +1,11 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+import shutil
+from tempfile import mkdtemp
+
+import nibabel as nb
+
 from nipype.testing import (assert_equal, assert_false, assert_true,
                             assert_almost_equal)
 import nipype.algorithms.rapidart as ra
@@ -116,3 +122,130 @@ def test_sc_output_filenames():
     f = 'motion.nii'
     corrfile = sc._get_output_filenames(f, outputdir)
     yield assert_equal, corrfile, '/tmp/qa.motion_stimcorr.txt'
+
+
+def test_ad_get_affine_matrices():
+    ad = ra.ArtifactDetect()
+    params = np.random.RandomState(0).randn(5, 12)
+    for nparams in [3, 6, 12]:
+        matrices = ad._get_affine_matrices(params[:, :nparams])
+        for i in range(5):
+            yield (assert_almost_equal, matrices[i],
+                   ad._get_affine_matrix(params[i, :nparams].copy()))
+
+
+def make_run(tmpdir, name, nvols=12):
+    rng = np.random.RandomState(len(name))
+    data = rng.rand(8, 9, 10, nvols).astype(np.float32) * 10
+    data[2:6, 2:7, 2:8] += 100
+    data[3, 3, 3, 5] = np.nan
+    data[..., 7] += 50
+    imgfile = os.path.join(tmpdir, name + '.nii')
+    nb.save(nb.Nifti1Image(data, np.eye(4)), imgfile)
+    parfile = os.path.join(tmpdir, name + '.par')
+    np.savetxt(parfile, rng.randn(nvols, 6) * 0.1)
+    return imgfile, parfile, data.astype(np.float64)
+
+
+def global_signal(data, masktype, mask=None, threshold=None):
+    """per volume reference implementation"""
+    nanmean = lambda a: np.nansum(a) / np.sum(~np.isnan(a))
+    g = []
+    for t0 in range(data.shape[3]):
+        vol = data[:, :, :, t0]
+        if masktype == 'spm_global':
+            volmask = vol > nanmean(vol) / 8
+        elif masktype == 'thresh':
+            volmask = vol > threshold
+        else:
+            volmask = mask
+        g.append(nanmean(vol[volmask]))
+    return np.array(g)[:, None]
+
+
+def test_ad_global_signal():
+    tmpdir = mkdtemp()
+    imgfile, _, data = make_run(tmpdir, 'run1')
+    maskfile = os.path.join(tmpdir, 'mask.nii')
+    mask = np.zeros(data.shape[:3])
+    mask[1:7, 1:8, 1:9] = 1
+    nb.save(nb.Nifti1Image(mask, np.eye(4)), maskfile)
+    images = [nb.load(imgfile)]
+    # blocks of 5 volumes
+    ad = ra.ArtifactDetect(chunk_size_mb=8 * 9 * 10 * 8 * 5 / 1e6)
+    ad.inputs.mask_type = 'spm_global'
+    ad.inputs.intersect_mask = False
+    yield (assert_almost_equal, ad._global_signal(images),
+           global_signal(data, 'spm_global'))
+    ad.inputs.intersect_mask = True
+    intersect = np.all(data > np.nanmean(data.reshape((-1, 12)), 0) / 8, 3)
+    yield (assert_almost_equal, ad._global_signal(images),
+           global_signal(data, 'file', mask=intersect))
+    ad.inputs.mask_type = 'thresh'
+    ad.inputs.mask_threshold = 50
+    yield (assert_almost_equal, ad._global_signal(images),
+           global_signal(data, 'thresh', threshold=50))
+    ad.inputs.mask_type = 'file'
+    ad.inputs.mask_file = maskfile
+    yield (assert_almost_equal, ad._global_signal(images),
+           global_signal(data, 'file', mask=mask > 0.5))
+    # runs of 3D images
+    files = []
+    for t0 in range(data.shape[3]):
+        files.append(os.path.join(tmpdir, 'vol%d.nii' % t0))
+        nb.save(nb.Nifti1Image(data[..., t0], np.eye(4)), files[-1])
+    yield (assert_almost_equal,
+           ad._global_signal([nb.load(f) for f in files]),
+           global_signal(data, 'file', mask=mask > 0.5))
+    shutil.rmtree(tmpdir)
+
+
+def test_ad_parallel_runs():
+    tmpdir = mkdtemp()
+    cwd = os.getcwd()
+    runs = [make_run(tmpdir, name) for name in ['run1', 'run02']]
+    os.chdir(tmpdir)
+    try:
+        ad = ra.ArtifactDetect(num_threads=2, save_plot=False,
+                               parameter_source='FSL', norm_threshold=1,
+                               zintensity_threshold=3,
+                               mask_type='spm_global')
+        ad.inputs.realigned_files = [run[0] for run in runs]
+        ad.inputs.realignment_parameters = [run[1] for run in runs]
+        outputs = ad.run().outputs
+        for i, run in enumerate(runs):
+            yield (assert_almost_equal,
+                   np.loadtxt(outputs.intensity_files[i])[:, None],
+                   global_signal(run[2], 'spm_global'), 2)
+            yield assert_true, 7 in np.loadtxt(outputs.outlier_files[i])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def test_ad_global_signal_int16():
+    tmpdir = mkdtemp()
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 50, (8, 9, 10, 12)).astype(np.int16)
+    data[2:6, 2:7, 2:8] += 1000
+    data[..., 7] += 500
+    expected = global_signal(data.astype(np.float64), 'spm_global')
+    for ext in ['.nii', '.nii.gz']:
+        imgfile = os.path.join(tmpdir, 'run' + ext)
+        nb.save(nb.Nifti1Image(data, np.eye(4)), imgfile)
+        images = [nb.load(imgfile)]
+        # all the data in one block, then blocks of 5 volumes
+        for chunk_size_mb in [1, 8 * 9 * 10 * 2 * 5 / 1e6]:
+            ad = ra.ArtifactDetect(chunk_size_mb=chunk_size_mb,
+                                   mask_type='spm_global',
+                                   intersect_mask=False)
+            yield (assert_almost_equal, ad._global_signal(images), expected)
+    # scaled data
+    img = nb.Nifti1Image(data, np.eye(4))
+    img.get_header().set_slope_inter(0.5, 10)
+    nb.save(img, imgfile)
+    ad = ra.ArtifactDetect(chunk_size_mb=8 * 9 * 10 * 2 * 5 / 1e6,
+                           mask_type='spm_global', intersect_mask=False)
+    yield (assert_almost_equal, ad._global_signal([nb.load(imgfile)]),
+           global_signal(data * 0.5 + 10., 'spm_global'))
+    shutil.rmtree(tmpdir)
@@ -7,6 +7,7 @@ import os
 import warnings
 
 from ...utils.filemanip import fname_presuffix
+from ...utils.probecache import memoize_probe
 from ..base import (CommandLine, traits, CommandLineInputSpec, isdefined)
 
 warn = warnings.warn
@@ -27,6 +28,7 @@ class Info(object):
               'NIFTI_GZ': '.nii.gz'}
 
     @staticmethod
+    @memoize_probe('afni_version', ['PATH'])
     def version():
         """Check for afni version on system
 
@@ -40,7 +42,8 @@ class Info(object):
            Version number as string or None if AFNI not found
 
         """
-        clout = CommandLine(command='afni_vcheck').run()
+        clout = CommandLine(command='afni_vcheck',
+                            terminal_output='full').run()
         out = clout.runtime.stdout
         return out.split('\n')[1]
 
@@ -86,7 +89,7 @@ class Info(object):
         '''Grab an image from the standard location.
 
         Could be made more fancy to allow for more relocatability'''
-        clout = CommandLine('which afni').run()
+        clout = CommandLine('which afni', terminal_output='full').run()
         if clout.runtime.returncode is not 0:
             return None
 
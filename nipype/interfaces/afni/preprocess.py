@@ -1384,6 +1384,7 @@ class BrickStat(AFNICommand):
 
     """
     _cmd = '3dBrickStat'
+    _terminal_output = 'full'
     input_spec = BrickStatInputSpec
     output_spec = BrickStatOutputSpec
 
@@ -1462,6 +1463,7 @@ class ROIStats(AFNICommand):
 
     """
     _cmd = '3dROIstats'
+    _terminal_output = 'full'
     input_spec = ROIStatsInputSpec
     output_spec = ROIStatsOutputSpec
 
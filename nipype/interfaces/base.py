@@ -8,6 +8,7 @@ Exaples  FSL, matlab/SPM , afni
 Requires Packages to be installed
 """
 
+from collections import deque
 from ConfigParser import NoOptionError
 from copy import deepcopy
 import datetime
@@ -26,12 +27,17 @@ from .traits_extension import (traits, Undefined, TraitDictObject,
                                isdefined, File, Directory,
                                has_metadata)
 from ..utils.filemanip import (md5, hash_infile, FileNotFoundError,
-                               hash_timestamp)
+                               hash_timestamp, hash_file, get_hash_object)
+from ..utils import filemanip
 from ..utils.misc import is_container, trim
+from ..utils.probecache import memoize_probe
 from .. import config, logging
 
 iflogger = logging.getLogger('interface')
 
+# ways of capturing the output of command line programs
+COMMAND_OUTPUT_MODES = ['full', 'tail', 'file', 'none']
+
 
 __docformat__ = 'restructuredtext'
 
@@ -369,12 +375,7 @@ class BaseTraitedSpec(traits.HasTraits):
                 hashlist = self._hash_infile({'infiles': afile}, 'infiles')
                 hash = [val[1] for val in hashlist]
             else:
-                if config.get('execution', 'hash_method').lower() == 'timestamp':
-                    hash = hash_timestamp(afile)
-                elif config.get('execution', 'hash_method').lower() == 'content':
-                    hash = hash_infile(afile)
-                else:
-                    raise Exception("Unknown hash method: %s" % config.get('execution', 'hash_method'))
+                hash = hash_file(afile)
             file_list.append((afile, hash))
         return file_list
 
@@ -431,50 +432,85 @@ class BaseTraitedSpec(traits.HasTraits):
                     out = undefinedval
         return out
 
-    def get_hashval(self, hash_method=None):
+    def get_hashval(self, hash_method=None, hash_algorithm=None):
         """Return a dictionary of our items with hashes for each file.
 
         Searches through dictionary items and if an item is a file, it
-        calculates the md5 hash of the file contents and stores the
+        calculates the hash of the file contents and stores the
         file name and hash value as the new key value.
 
         However, the overall bunch hash is calculated only on the hash
         value of a file. The path and name of the file are not used in
         the overall hash calculation.
 
+        Parameters
+        ----------
+        hash_method : str
+            timestamp, content or sampled (default: hash_method option)
+        hash_algorithm : str
+            hash algorithm, e.g., md5 or sha1 (default: hash_algorithm
+            option)
+
         Returns
         -------
         dict_withhash : dict
             Copy of our dictionary with the new file hashes included
             with each file.
         hashvalue : str
-            The md5 hash value of the traited spec
+            The hash value of the traited spec
 
         """
-
-        dict_withhash = {}
-        dict_nofilename = {}
+        if hash_method is None:
+            hash_method = config.get('execution', 'hash_method')
+        if hash_algorithm is None:
+            hash_algorithm = config.get('execution', 'hash_algorithm')
+        hashed_traits = []
         for name, val in sorted(self.get().items()):
             if isdefined(val):
                 trait = self.trait(name)
                 if has_metadata(trait.trait_type, "nohash", True):
                     continue
                 hash_files = not has_metadata(trait.trait_type, "hash_files", False)
-                dict_nofilename[name] = self._get_sorteddict(val, hash_method=hash_method, hash_files=hash_files)
-                dict_withhash[name] = self._get_sorteddict(val, True, hash_method=hash_method, hash_files=hash_files)
-        return (dict_withhash, md5(str(dict_nofilename)).hexdigest())
+                hashed_traits.append((name, val, hash_files))
+        # hash all files at once (in parallel), each one only once although
+        # it appears in both dictionaries
+        infiles = []
+        for _, val, hash_files in hashed_traits:
+            if hash_files:
+                self._list_files(val, infiles)
+        hashed_files = filemanip.hash_files(infiles, hash_method,
+                                            hash_algorithm)
+        dict_withhash = {}
+        dict_nofilename = {}
+        for name, val, hash_files in hashed_traits:
+            dict_nofilename[name] = self._get_sorteddict(val, hash_method=hash_method, hash_files=hash_files, hashed_files=hashed_files)
+            dict_withhash[name] = self._get_sorteddict(val, True, hash_method=hash_method, hash_files=hash_files, hashed_files=hashed_files)
+        hashobject = get_hash_object(hash_algorithm)
+        hashobject.update(str(dict_nofilename))
+        return (dict_withhash, hashobject.hexdigest())
+
+    def _list_files(self, object, files):
+        """Append the existing files referenced by object to files"""
+        if isinstance(object, dict):
+            for val in object.values():
+                self._list_files(val, files)
+        elif isinstance(object, (list, tuple)):
+            for val in object:
+                self._list_files(val, files)
+        elif isinstance(object, str) and os.path.isfile(object):
+            files.append(object)
 
-    def _get_sorteddict(self, object, dictwithhash=False, hash_method=None, hash_files=True):
+    def _get_sorteddict(self, object, dictwithhash=False, hash_method=None, hash_files=True, hashed_files=None):
         if isinstance(object, dict):
             out = {}
             for key, val in sorted(object.items()):
                 if isdefined(val):
-                    out[key] = self._get_sorteddict(val, dictwithhash, hash_method=hash_method, hash_files=hash_files)
+                    out[key] = self._get_sorteddict(val, dictwithhash, hash_method=hash_method, hash_files=hash_files, hashed_files=hashed_files)
         elif isinstance(object, (list, tuple)):
             out = []
             for val in object:
                 if isdefined(val):
-                    out.append(self._get_sorteddict(val, dictwithhash, hash_method=hash_method, hash_files=hash_files))
+                    out.append(self._get_sorteddict(val, dictwithhash, hash_method=hash_method, hash_files=hash_files, hashed_files=hashed_files))
             if isinstance(object, tuple):
                 out = tuple(out)
         else:
@@ -483,12 +519,12 @@ class BaseTraitedSpec(traits.HasTraits):
                     if hash_method == None:
                         hash_method = config.get('execution', 'hash_method')
 
-                    if hash_method.lower() == 'timestamp':
-                        hash = hash_timestamp(object)
-                    elif hash_method.lower() == 'content':
-                        hash = hash_infile(object)
+                    if hashed_files is not None and object in hashed_files:
+                        hash = hashed_files[object]
                     else:
-                        raise Exception("Unknown hash method: %s" % hash_method)
+                        hash = hash_file(object, hash_method)
+                    if hashed_files is not None:
+                        hashed_files[object] = hash
                     if dictwithhash:
                         out = (object, hash)
                     else:
@@ -888,22 +924,32 @@ class BaseInterface(Interface):
 class Stream(object):
     """Function to capture stdout and stderr streams with timestamps
 
+    Complete lines are timestamped and kept in memory (all of them, or only
+    the last `tail` ones when `tail` is not None), written to `logfile` and
+    sent to the interface logger if `echo` is set.
+
     http://stackoverflow.com/questions/4984549/merge-and-sync-stdout-and-stderr/5188359#5188359
     """
 
-    def __init__(self, name, impl):
+    def __init__(self, name, impl, tail=None, logfile=None, echo=True):
         self._name = name
         self._impl = impl
         self._buf = ''
-        self._rows = []
-        self._lastidx = 0
+        if tail is None:
+            self._rows = []
+        else:
+            self._rows = deque(maxlen=tail)
+        self._logfile = logfile
+        self._echo = echo
+        self.closed = False
 
     def fileno(self):
         "Pass-through for file descriptor."
         return self._impl.fileno()
 
     def read(self, drain=0):
-        "Read from the file descriptor. If 'drain' set, read until EOF."
+        """Read available data from the file descriptor. If 'drain' set, read
+        until EOF."""
         while self._read(drain) is not None:
             if not drain:
                 break
@@ -911,73 +957,125 @@ class Stream(object):
     def _read(self, drain):
         "Read from the file descriptor"
         fd = self.fileno()
-        buf = os.read(fd, 4096)
-        if not buf and not self._buf:
+        buf = os.read(fd, 65536)
+        if not buf:
+            # EOF: flush any incomplete last line
+            self.closed = True
+            if self._buf:
+                self._add_rows([self._buf])
+                self._buf = ''
             return None
+        buf = self._buf + buf
         if '\n' not in buf:
-            if not drain:
-                self._buf += buf
-                return []
+            self._buf = buf
+            return []
+        tmp, self._buf = buf.rsplit('\n', 1)
+        self._add_rows(tmp.split('\n'))
+        return []
 
-        # prepend any data previously read, then split into lines and format
-        buf = self._buf + buf
-        if '\n' in buf:
-            tmp, rest = buf.rsplit('\n', 1)
-        else:
-            tmp = buf
-            rest = None
-        self._buf = rest
+    def _add_rows(self, lines):
         now = datetime.datetime.now().isoformat()
-        rows = tmp.split('\n')
-        self._rows += [(now, '%s %s:%s' % (self._name, now, r), r) for r in rows]
-        for idx in range(self._lastidx, len(self._rows)):
-            iflogger.info(self._rows[idx][1])
-        self._lastidx = len(self._rows)
+        rows = [(now, '%s %s:%s' % (self._name, now, r), r) for r in lines]
+        self._rows.extend(rows)
+        if self._logfile is not None:
+            self._logfile.write('\n'.join([row[1] for row in rows]) + '\n')
+        if self._echo:
+            for row in rows:
+                iflogger.info(row[1])
 
 
-def run_command(runtime, timeout=0.01):
+def run_command(runtime, output=None, tail=None, logname=None):
     """
     Run a command, read stdout and stderr, prefix with timestamp. The returned
     runtime contains a merged stdout+stderr log with timestamps
 
+    The process is waited for with blocking calls. The `output` mode controls
+    what is kept of the output of the command:
+
+    - full : all lines are logged and kept in memory
+    - tail : all lines are logged and written to a log file in the working
+      directory, only the last `tail` lines of each stream are kept in memory
+    - file : all lines are written to the log file only
+    - none : the output is discarded
+
+    The last `tail` lines of stderr are kept in memory in all modes, since
+    interfaces detect failures from them.
+
+    The defaults are the ``command_output``, ``command_output_tail`` and
+    ``command_output_file`` options of the execution section of the
+    configuration. The path to the log file, if any, is stored in
+    `runtime.output_log`.
+
     http://stackoverflow.com/questions/4984549/merge-and-sync-stdout-and-stderr/5188359#5188359
     """
+    if output is None:
+        output = config.get('execution', 'command_output')
+    output = output.lower()
+    if output not in COMMAND_OUTPUT_MODES:
+        raise ValueError('Unknown command output mode %s, use one of %s' %
+                         (output, ', '.join(COMMAND_OUTPUT_MODES)))
+    if output == 'full':
+        tail = None
+    elif tail is None:
+        tail = int(config.get('execution', 'command_output_tail'))
+    if logname is None:
+        logname = config.get('execution', 'command_output_file')
+    runtime.output_log = None
+
+    logfile = None
+    if output in ['tail', 'file']:
+        runtime.output_log = os.path.join(runtime.cwd, logname)
+        logfile = open(runtime.output_log, 'w')
+    stdout_tail = tail
+    if output in ['file', 'none']:
+        stdout_tail = 0
+
     PIPE = subprocess.PIPE
-    proc = subprocess.Popen(runtime.cmdline,
-                             stdout=PIPE,
-                             stderr=PIPE,
-                             shell=True,
-                             cwd=runtime.cwd,
-                             env=runtime.environ)
-    streams = [
-        Stream('stdout', proc.stdout),
-        Stream('stderr', proc.stderr)
-        ]
-
-    def _process(drain=0):
-        try:
-            res = select.select(streams, [], [], timeout)
-        except select.error, e:
-            iflogger.info(str(e))
-            if e[0] == errno.EINTR:
-                return
-            else:
+    devnull = None
+    stdout = PIPE
+    if output == 'none':
+        devnull = open(os.devnull, 'w')
+        stdout = devnull
+    try:
+        proc = subprocess.Popen(runtime.cmdline,
+                                stdout=stdout,
+                                stderr=PIPE,
+                                shell=True,
+                                cwd=runtime.cwd,
+                                env=runtime.environ)
+        echo = output in ['full', 'tail']
+        streams = [Stream('stderr', proc.stderr, tail=tail, logfile=logfile,
+                          echo=echo)]
+        if output != 'none':
+            streams.insert(0, Stream('stdout', proc.stdout, tail=stdout_tail,
+                                     logfile=logfile, echo=echo))
+
+        # block until output is available instead of polling the process
+        # and stop once both pipes are closed
+        while True:
+            pending = [stream for stream in streams if not stream.closed]
+            if not pending:
+                break
+            try:
+                res = select.select(pending, [], [])
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
                 raise
-        else:
             for stream in res[0]:
-                stream.read(drain)
-
-    while proc.returncode is None:
-        proc.poll()
-        _process()
-    runtime.returncode = proc.returncode
-    _process(drain=1)
+                stream.read()
+        runtime.returncode = proc.wait()
+    finally:
+        if logfile is not None:
+            logfile.close()
+        if devnull is not None:
+            devnull.close()
 
     # collect results, merge and return
-    result = {}
+    result = {'stdout': []}
     temp = []
     for stream in streams:
-        rows = stream._rows
+        rows = list(stream._rows)
         temp += rows
         result[stream._name] = [r[2] for r in rows]
     temp.sort()
@@ -988,10 +1086,33 @@ def run_command(runtime, timeout=0.01):
     return runtime
 
 
+@memoize_probe('executable', ['PATH', 'PATHEXT'])
+def find_executable(cmd):
+    '''Return the path to an executable, or None if it is not in the path
+
+    Based on a code snippet from http://orip.org/2009/08/python-checking-if-executable-exists-in.html
+    '''
+
+    extensions = os.environ.get("PATHEXT", "").split(os.pathsep)
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        base = os.path.join(directory, cmd)
+        options = [base] + [(base + ext) for ext in extensions]
+        for filename in options:
+            if os.path.exists(filename):
+                return filename
+    return None
+
+
 class CommandLineInputSpec(BaseInterfaceInputSpec):
     args = traits.Str(argstr='%s', desc='Additional parameters to the command')
     environ = traits.DictStrStr(desc='Environment variables', usedefault=True,
                                 nohash=True)
+    terminal_output = traits.Enum(*COMMAND_OUTPUT_MODES, nohash=True,
+                                  desc=('Capture of the command output: all '
+                                        'of it (full), last lines and log '
+                                        'file (tail), log file only (file) '
+                                        'or nothing (none). Defaults to the '
+                                        'command_output config option'))
 
 
 class CommandLine(BaseInterface):
@@ -1018,7 +1139,7 @@ class CommandLine(BaseInterface):
     'ls -al'
 
     >>> cli.inputs.trait_get()
-    {'ignore_exception': False, 'args': '-al', 'environ': {'DISPLAY': ':1'}}
+    {'ignore_exception': False, 'terminal_output': <undefined>, 'environ': {'DISPLAY': ':1'}, 'args': '-al'}
 
     >>> cli.inputs.get_hashval()
     ({'args': '-al'}, 'a2f45e04a34630c5f33a75ea2a533cdd')
@@ -1027,6 +1148,9 @@ class CommandLine(BaseInterface):
 
     input_spec = CommandLineInputSpec
     _cmd = None
+    # output capture mode used when the terminal_output input is not set,
+    # interfaces parsing the output of their command set it to 'full'
+    _terminal_output = None
 
     def __init__(self, command=None, **inputs):
         super(CommandLine, self).__init__(**inputs)
@@ -1056,6 +1180,8 @@ class CommandLine(BaseInterface):
         message = "Command:\n" + runtime.cmdline + "\n"
         message += "Standard output:\n" + runtime.stdout + "\n"
         message += "Standard error:\n" + runtime.stderr + "\n"
+        if getattr(runtime, 'output_log', None):
+            message += "Output log: " + runtime.output_log + "\n"
         message += "Return code: " + str(runtime.returncode)
         raise RuntimeError(message)
 
@@ -1086,6 +1212,19 @@ class CommandLine(BaseInterface):
         setattr(runtime, 'stdout', None)
         setattr(runtime, 'stderr', None)
         setattr(runtime, 'cmdline', self.cmdline)
+        self._update_environ(runtime)
+        if not self._exists_in_path(self.cmd.split()[0]):
+            raise IOError("%s could not be found on host %s" % (self.cmd.split()[0],
+                                                                runtime.hostname))
+        runtime = run_command(runtime, output=self._get_terminal_output())
+        if runtime.returncode is None or runtime.returncode != 0:
+            self.raise_exception(runtime)
+
+        return runtime
+
+    def _update_environ(self, runtime):
+        """Add the display variable and the environ input to the environment
+        of the command"""
         out_environ = {}
         try:
             display_var = config.get('execution', 'display_variable')
@@ -1096,28 +1235,16 @@ class CommandLine(BaseInterface):
         if isdefined(self.inputs.environ):
             out_environ.update(self.inputs.environ)
         runtime.environ.update(out_environ)
-        if not self._exists_in_path(self.cmd.split()[0]):
-            raise IOError("%s could not be found on host %s" % (self.cmd.split()[0],
-                                                                runtime.hostname))
-        runtime = run_command(runtime)
-        if runtime.returncode is None or runtime.returncode != 0:
-            self.raise_exception(runtime)
 
-        return runtime
+    def _get_terminal_output(self):
+        """Return the output capture mode of the command (None uses the
+        configured default)"""
+        if isdefined(self.inputs.terminal_output):
+            return self.inputs.terminal_output
+        return self._terminal_output
 
     def _exists_in_path(self, cmd):
-        '''
-        Based on a code snippet from http://orip.org/2009/08/python-checking-if-executable-exists-in.html
-        '''
-
-        extensions = os.environ.get("PATHEXT", "").split(os.pathsep)
-        for directory in os.environ.get("PATH", "").split(os.pathsep):
-            base = os.path.join(directory, cmd)
-            options = [base] + [(base + ext) for ext in extensions]
-            for filename in options:
-                if os.path.exists(filename):
-                    return True
-        return False
+        return find_executable(cmd) is not None
 
     def _gen_filename(self, name):
         """ Generate filename attributes before running.
@@ -15,6 +15,7 @@ from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, trait
 from nipype.utils.filemanip import split_filename
 import pickle
 import scipy.io as sio
+import scipy.sparse as sparse
 import os, os.path as op
 import numpy as np
 import nibabel as nb
@@ -68,54 +69,138 @@ def length(xyz, along=False):
         return np.cumsum(dists)
     return np.sum(dists)
 
+def fiber_lengths(streamlines, indices=None):
+    """ Lengths of fibers, computed in a single pass over their points
+
+    The lengths are identical to those given by `length` for each fiber.
+
+    Parameters
+    ----------
+    streamlines: the fibers data
+    indices: indices of the fibers to measure (default: all fibers)
+    """
+    if indices is None:
+        indices = range(len(streamlines))
+    points, fiber_idx = _concatenate_points([streamlines[i] for i in indices])
+    n_points = np.bincount(fiber_idx, minlength=len(indices))
+    offsets = np.cumsum(n_points) - n_points
+    segments = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+    lengths = np.zeros(len(indices), dtype=segments.dtype)
+    # sum the segments of fibers with the same number of points together, in
+    # the same order as np.sum does for each fiber
+    for n in np.unique(n_points[n_points > 1]):
+        selected = np.flatnonzero(n_points == n)
+        segment_idx = offsets[selected][:, None] + np.arange(n - 1)
+        lengths[selected] = segments[segment_idx].sum(axis=1)
+    if not len(indices) or (n_points < 2).any():
+        # `length` returns 0 for fibers with less than two points
+        lengths = lengths.astype(np.float64)
+    return lengths
+
+def _concatenate_points(streamlines):
+    """ Concatenate the points of streamlines
+
+    Returns
+    -------
+    points: array of size [#points, 3] with the points of all streamlines
+    fiber_idx: array of size [#points] with the index of the streamline of
+    each point
+    """
+    if len(streamlines) == 0:
+        return np.zeros((0, 3)), np.zeros(0, dtype=int)
+    points = [np.asarray(fiber[0]).reshape(-1, 3) for fiber in streamlines]
+    n_points = np.array([len(p) for p in points])
+    fiber_idx = np.repeat(np.arange(len(points)), n_points)
+    return np.concatenate(points), fiber_idx
+
+def _points_to_voxels(pointsmm, voxelSize):
+    """ Translate points from mm to voxel indices (truncated like int()) """
+    return (np.asarray(pointsmm, dtype=np.float64) /
+            np.asarray(voxelSize[:3], dtype=np.float64)).astype(int)
+
+def _get_labels(roiData, voxels):
+    """ Label of each voxel (rows of voxels) in the ROI image """
+    return roiData[voxels[:, 0], voxels[:, 1], voxels[:, 2]]
+
 def get_rois_crossed(pointsmm, roiData, voxelSize):
-	n_points = len(pointsmm)
-	rois_crossed = []
-	for j in xrange(0, n_points):
-		# store point
-		x = int(pointsmm[j, 0] / float(voxelSize[0]))
-		y = int(pointsmm[j, 1] / float(voxelSize[1]))
-		z = int(pointsmm[j, 2] / float(voxelSize[2]))
-		if not roiData[x, y, z] == 0:
-			rois_crossed.append(roiData[x, y, z])
-	rois_crossed = dict.fromkeys(rois_crossed).keys() #Removed duplicates from the list
-	return rois_crossed
+    """ Labels of the ROIs (without duplicates) crossed by a fiber """
+    voxels = _points_to_voxels(np.asarray(pointsmm).reshape(-1, 3), voxelSize)
+    labels = _get_labels(roiData, voxels)
+    return list(np.unique(labels[labels != 0]))
+
+def _fiber_roi_incidence(fiber_idx, labels, n_fibers, n_rois):
+    """ Sparse [#fibers, #rois] matrix with ones where a fiber crosses a ROI
+
+    Each (fiber, ROI) pair is counted once however many points of the fiber
+    lie in the ROI.
+    """
+    keep = labels != 0
+    rows = np.asarray(fiber_idx)[keep]
+    cols = np.asarray(labels)[keep].astype(int) - 1
+    if len(rows) and (cols.max() >= n_rois or cols.min() < 0):
+        raise IndexError('ROI label out of the range 1-%d' % n_rois)
+    incidence = sparse.coo_matrix((np.ones(len(rows), dtype=np.uint8),
+                                   (rows, cols)),
+                                  shape=(n_fibers, n_rois)).tocsr()
+    # duplicate entries were summed
+    incidence.data[:] = 1
+    return incidence
+
+def _crossing_counts(incidence):
+    """ Number of fibers crossing each pair of different ROIs """
+    incidence = incidence.astype(np.int64)
+    counts = np.asarray((incidence.T * incidence).todense())
+    counts[np.diag_indices_from(counts)] = 0
+    return counts
 
 def get_connectivity_matrix(n_rois, list_of_roi_crossed_lists):
-	connectivity_matrix = np.zeros((n_rois, n_rois), dtype=np.uint)
-	for rois_crossed in list_of_roi_crossed_lists:
-		for idx_i, roi_i in enumerate(rois_crossed):
-			for idx_j, roi_j in enumerate(rois_crossed):
-				if idx_i > idx_j:
-					if not roi_i == roi_j:
-						connectivity_matrix[roi_i - 1, roi_j - 1] += 1
-	connectivity_matrix = connectivity_matrix + connectivity_matrix.T
-	return connectivity_matrix
-
-def create_allpoints_cmat(streamlines, roiData, voxelSize, n_rois):
-	""" Create the intersection arrays for each fiber
-	"""
-	n_fib = len(streamlines)
-	pc = -1
-	# Computation for each fiber
-	final_fiber_ids = []
-	list_of_roi_crossed_lists = []
-	for i, fiber in enumerate(streamlines):
-		pcN = int(round(float(100 * i) / n_fib))
-		if pcN > pc and pcN % 1 == 0:
-			pc = pcN
-			print '%4.0f%%' % (pc)
-		rois_crossed = get_rois_crossed(fiber[0], roiData, voxelSize)
-		if len(rois_crossed) > 0:
-			list_of_roi_crossed_lists.append(list(rois_crossed))
-			final_fiber_ids.append(i)
-
-	connectivity_matrix = get_connectivity_matrix(n_rois, list_of_roi_crossed_lists)
-	dis = n_fib - len(final_fiber_ids)
-	iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n_fib, n_fib))
-	iflogger.info("Valid fibers: %i (%f percent)" % (n_fib - dis, 100 - dis * 100.0 / n_fib))
-	iflogger.info('Returning the intersecting point connectivity matrix')
-	return connectivity_matrix, final_fiber_ids
+    """ Number of fibers crossing each pair of different ROIs
+
+    Parameters
+    ----------
+    n_rois: number of ROIs
+    list_of_roi_crossed_lists: ROIs (labels starting at 1) crossed by each
+    fiber
+    """
+    n_fibers = len(list_of_roi_crossed_lists)
+    n_crossed = [len(rois) for rois in list_of_roi_crossed_lists]
+    fiber_idx = np.repeat(np.arange(n_fibers), n_crossed)
+    if sum(n_crossed):
+        labels = np.concatenate([np.asarray(rois, dtype=int).ravel()
+                                 for rois in list_of_roi_crossed_lists])
+    else:
+        labels = np.zeros(0, dtype=int)
+    incidence = _fiber_roi_incidence(fiber_idx, labels, n_fibers, n_rois)
+    return _crossing_counts(incidence).astype(np.uint)
+
+def create_allpoints_cmat(streamlines, roiData, voxelSize, n_rois,
+                          chunk_size=100000):
+    """ Create the intersection arrays for each fiber
+
+    Fibers are processed in chunks of chunk_size fibers, which bounds the
+    memory used by the concatenated points.
+    """
+    n_fib = len(streamlines)
+    connectivity_matrix = np.zeros((n_rois, n_rois), dtype=np.int64)
+    final_fiber_ids = []
+    for start in xrange(0, n_fib, chunk_size):
+        chunk = streamlines[start:start + chunk_size]
+        iflogger.info('Computing intersections of fibers %d to %d' %
+                      (start, start + len(chunk) - 1))
+        points, fiber_idx = _concatenate_points(chunk)
+        labels = _get_labels(roiData, _points_to_voxels(points, voxelSize))
+        incidence = _fiber_roi_incidence(fiber_idx, labels, len(chunk),
+                                         n_rois)
+        crossing = np.flatnonzero(np.diff(incidence.indptr) > 0)
+        final_fiber_ids.extend((crossing + start).tolist())
+        connectivity_matrix += _crossing_counts(incidence)
+    connectivity_matrix = connectivity_matrix.astype(np.uint)
+
+    dis = n_fib - len(final_fiber_ids)
+    iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n_fib, n_fib))
+    iflogger.info("Valid fibers: %i (%f percent)" % (n_fib - dis, 100 - dis * 100.0 / n_fib))
+    iflogger.info('Returning the intersecting point connectivity matrix')
+    return connectivity_matrix, final_fiber_ids
 
 def create_endpoints_array(fib, voxelSize):
     """ Create the endpoints arrays for each fiber
@@ -130,36 +215,19 @@ def create_endpoints_array(fib, voxelSize):
     endpointsmm) : endpoints in milimeter coordinates
     """
 
-    # Init
     n = len(fib)
-    endpoints = np.zeros((n, 2, 3))
-    endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
-
-    if print_info:
-        print("Number of fibers : %s" % n)
-
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
-        f = fi[0]
+    iflogger.info("Number of fibers : %s" % n)
 
-        # store startpoint
-        endpoints[i, 0, :] = f[0, :]
-        # store endpoint
-        endpoints[i, 1, :] = f[-1, :]
-
-        # store startpoint
-        endpointsmm[i, 0, :] = f[0, :]
-        # store endpoint
-        endpointsmm[i, 1, :] = f[-1, :]
+    # first and last point of each fiber
+    endpointsmm = np.zeros((n, 2, 3))
+    if n:
+        endpointsmm[:, 0, :] = [fi[0][0] for fi in fib]
+        endpointsmm[:, 1, :] = [fi[0][-1] for fi in fib]
 
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
+    # Translate from mm to index
+    endpoints = np.zeros((n, 2, 3))
+    endpoints[:] = _points_to_voxels(endpointsmm.reshape(-1, 3),
+                                     voxelSize).reshape(n, 2, 3)
 
     # Return the matrices
     iflogger.info('Returning the endpoint matrix')
@@ -192,8 +260,6 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
 
     # Create empty fiber label array
     fiberlabels = np.zeros((n, 2))
-    final_fiberlabels = []
-    final_fibers_idx = []
 
     # Add node information from specified parcellation scheme
     path, name, ext = split_filename(resolution_network_file)
@@ -228,65 +294,68 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
         H = nx.relabel_nodes(H, lambda x: x + 1) #relabel nodes so they start at 1		
         I.add_weighted_edges_from(((u, v, d['weight']) for u, v, d in H.edges(data=True)))
 
-    dis = 0
-    for i in xrange(endpoints.shape[0]):
-
-        # ROI start => ROI end
-        try:
-            startROI = int(roiData[endpoints[i, 0, 0], endpoints[i, 0, 1], endpoints[i, 0, 2]])
-            endROI = int(roiData[endpoints[i, 1, 0], endpoints[i, 1, 1], endpoints[i, 1, 2]])
-        except IndexError:
-            iflogger.error(("AN INDEXERROR EXCEPTION OCCURED FOR FIBER %s. PLEASE CHECK ENDPOINT GENERATION" % i))
-            break
-
-        # Filter
-        if startROI == 0 or endROI == 0:
-            dis += 1
-            fiberlabels[i, 0] = -1
-            continue
-
-        if startROI > nROIs or endROI > nROIs:
-            iflogger.error("Start or endpoint of fiber terminate in a voxel which is labeled higher")
-            iflogger.error("than is expected by the parcellation node information.")
-            iflogger.error("Start ROI: %i, End ROI: %i" % (startROI, endROI))
-            iflogger.error("This needs bugfixing!")
-            continue
-
-        # Update fiber label
-        # switch the rois in order to enforce startROI < endROI
-        if endROI < startROI:
-            tmp = startROI
-            startROI = endROI
-            endROI = tmp
-
-        fiberlabels[i, 0] = startROI
-        fiberlabels[i, 1] = endROI
-
-        final_fiberlabels.append([ startROI, endROI ])
-        final_fibers_idx.append(i)
-
+    # ROI start => ROI end, for all fibers at once
+    fiber_ids = np.arange(endpoints.shape[0])
+    voxels = endpoints.astype(int)
+    shape = np.array(roiData.shape[:3])
+    inside = ((voxels >= -shape) & (voxels < shape)).all(axis=2).all(axis=1)
+    if not inside.all():
+        i = np.flatnonzero(~inside)[0]
+        iflogger.error(("AN INDEXERROR EXCEPTION OCCURED FOR FIBER %s. PLEASE CHECK ENDPOINT GENERATION" % i))
+        fiber_ids = fiber_ids[:i]
+        voxels = voxels[:i]
+    startROIs = _get_labels(roiData, voxels[:, 0, :]).astype(int)
+    endROIs = _get_labels(roiData, voxels[:, 1, :]).astype(int)
+
+    # Filter
+    orphans = (startROIs == 0) | (endROIs == 0)
+    dis = int(orphans.sum())
+    fiberlabels[fiber_ids[orphans], 0] = -1
+
+    higher = ~orphans & ((startROIs > nROIs) | (endROIs > nROIs))
+    for i in np.flatnonzero(higher):
+        iflogger.error("Start or endpoint of fiber terminate in a voxel which is labeled higher")
+        iflogger.error("than is expected by the parcellation node information.")
+        iflogger.error("Start ROI: %i, End ROI: %i" % (startROIs[i], endROIs[i]))
+        iflogger.error("This needs bugfixing!")
+
+    # Update fiber labels, enforcing startROI <= endROI
+    valid = ~(orphans | higher)
+    final_fibers_idx = fiber_ids[valid].tolist()
+    final_startROIs = np.minimum(startROIs, endROIs)[valid]
+    final_endROIs = np.maximum(startROIs, endROIs)[valid]
+    fiberlabels[final_fibers_idx, 0] = final_startROIs
+    fiberlabels[final_fibers_idx, 1] = final_endROIs
+    if final_fibers_idx:
+        final_fiberlabels_array = np.column_stack((final_startROIs,
+                                                   final_endROIs))
+    else:
+        final_fiberlabels_array = np.array([], dtype=int)
+
+    # group the fibers by edge, edges are added in order of first fiber
+    edge_keys = final_startROIs * (nROIs + 1) + final_endROIs
+    order = np.argsort(edge_keys, kind='mergesort')
+    _, group_starts = np.unique(edge_keys[order], return_index=True)
+    groups = np.split(order, group_starts[1:]) if len(order) else []
+    groups.sort(key=lambda group: group[0])
+    edge_fibers = {}
+    for group in groups:
+        startROI = int(final_startROIs[group[0]])
+        endROI = int(final_endROIs[group[0]])
+        edge_fibers[(startROI, endROI)] = group
+        fiblist = [final_fibers_idx[k] for k in group]
         # Add edge to graph
         if G.has_edge(startROI, endROI) and G.edge[startROI][endROI].has_key('fiblist'):
-            G.edge[startROI][endROI]['fiblist'].append(i)
+            G.edge[startROI][endROI]['fiblist'].extend(fiblist)
         else:
-            G.add_edge(startROI, endROI, fiblist=[i])
+            G.add_edge(startROI, endROI, fiblist=fiblist)
 
     # create a final fiber length array
-    finalfiberlength = []
     if intersections:
         final_fibers_indices = final_fiber_ids
     else:
         final_fibers_indices = final_fibers_idx
-
-    for idx in final_fibers_indices:
-        # compute length of fiber
-        finalfiberlength.append(length(fib[idx][0]))
-
-    # convert to array
-    final_fiberlength_array = np.array(finalfiberlength)
-
-    # make final fiber labels as array
-    final_fiberlabels_array = np.array(final_fiberlabels, dtype=int)
+    final_fiberlength_array = fiber_lengths(fib, final_fibers_indices)
 
     iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n, n))
     iflogger.info("Valid fibers: %i (%f percent)" % (n - dis, 100 - dis * 100.0 / n))
@@ -296,12 +365,13 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
     fibmean = numfib.copy()
     fibmedian = numfib.copy()
     fibdev = numfib.copy()
+    no_fibers = np.array([], dtype=int)
     for u, v, d in G.edges_iter(data=True):
         G.remove_edge(u, v)
         di = {}
         if d.has_key('fiblist'):
             di['number_of_fibers'] = len(d['fiblist'])
-            idx = np.where((final_fiberlabels_array[:, 0] == int(u)) & (final_fiberlabels_array[:, 1] == int(v)))[0]
+            idx = edge_fibers.get((int(u), int(v)), no_fibers)
             di['fiber_length_mean'] = float(np.mean(final_fiberlength_array[idx]))
             di['fiber_length_median'] = float(np.median(final_fiberlength_array[idx]))
             di['fiber_length_std'] = float(np.std(final_fiberlength_array[idx]))
@@ -5,7 +5,7 @@ def configuration(parent_package='',top_path=None):
 
     config = Configuration('cmtk', parent_package, top_path)
 
-    #config.add_data_dir('tests')
+    config.add_data_dir('tests')
     return config
 
 if __name__ == '__main__':
@@ -0,0 +1,241 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+import shutil
+from tempfile import mkdtemp
+
+import numpy as np
+import nibabel as nb
+import networkx as nx
+
+from nipype.testing import (assert_equal, assert_true, skipif)
+
+try:
+    import nipype.interfaces.cmtk.cmtk as cmtk
+except ImportError:
+    no_cmtk = True
+else:
+    no_cmtk = False
+
+
+def _create_fibers():
+    """ Fibers crossing a 4x4x4 ROI volume with 2x2x2mm voxels and 4 ROIs
+    """
+    roiData = np.zeros((4, 4, 4), dtype=np.int16)
+    roiData[0, :2, :] = 1
+    roiData[3, :2, :] = 2
+    roiData[:2, 3, :] = 3
+    roiData[2:, 3, 2] = 4
+    voxelSize = (2., 2., 2.)
+    rng = np.random.RandomState(0)
+    fibers = []
+    for n_points in [1, 2, 5, 9, 20, 5, 1, 33, 9, 2, 12]:
+        points = rng.uniform(0, 7.99, size=(n_points, 3)).astype(np.float32)
+        fibers.append((points, None, None))
+    # only in the background
+    fibers.append((np.array([[4.5, 4.5, 1.]], dtype=np.float32), None, None))
+    # crossing ROI 1 several times
+    fibers.append((np.array([[1., 1., 1.], [1., 3., 1.], [4.5, 1., 1.],
+                             [1., 1., 5.]], dtype=np.float32), None, None))
+    return fibers, roiData, voxelSize
+
+
+def _old_get_rois_crossed(pointsmm, roiData, voxelSize):
+    rois_crossed = []
+    for j in xrange(0, len(pointsmm)):
+        x = int(pointsmm[j, 0] / float(voxelSize[0]))
+        y = int(pointsmm[j, 1] / float(voxelSize[1]))
+        z = int(pointsmm[j, 2] / float(voxelSize[2]))
+        if not roiData[x, y, z] == 0:
+            rois_crossed.append(roiData[x, y, z])
+    return dict.fromkeys(rois_crossed).keys()
+
+
+def _old_create_allpoints_cmat(streamlines, roiData, voxelSize, n_rois):
+    final_fiber_ids = []
+    connectivity_matrix = np.zeros((n_rois, n_rois), dtype=np.uint)
+    for i, fiber in enumerate(streamlines):
+        rois_crossed = _old_get_rois_crossed(fiber[0], roiData, voxelSize)
+        if len(rois_crossed) > 0:
+            final_fiber_ids.append(i)
+        for idx_i, roi_i in enumerate(rois_crossed):
+            for idx_j, roi_j in enumerate(rois_crossed):
+                if idx_i > idx_j and not roi_i == roi_j:
+                    connectivity_matrix[roi_i - 1, roi_j - 1] += 1
+    connectivity_matrix = connectivity_matrix + connectivity_matrix.T
+    return connectivity_matrix, final_fiber_ids
+
+
+def _old_create_endpoints_array(fib, voxelSize):
+    n = len(fib)
+    endpoints = np.zeros((n, 2, 3))
+    endpointsmm = np.zeros((n, 2, 3))
+    for i, fi in enumerate(fib):
+        f = fi[0]
+        endpoints[i, 0, :] = f[0, :]
+        endpoints[i, 1, :] = f[-1, :]
+        endpointsmm[i, 0, :] = f[0, :]
+        endpointsmm[i, 1, :] = f[-1, :]
+        for j in range(2):
+            for k in range(3):
+                endpoints[i, j, k] = int(endpoints[i, j, k] /
+                                         float(voxelSize[k]))
+    return endpoints, endpointsmm
+
+
+def _old_fiber_labels(endpoints, roiData, nROIs):
+    fiberlabels = np.zeros((endpoints.shape[0], 2))
+    final_fiberlabels = []
+    final_fibers_idx = []
+    for i in xrange(endpoints.shape[0]):
+        startROI = int(roiData[tuple(endpoints[i, 0, :].astype(int))])
+        endROI = int(roiData[tuple(endpoints[i, 1, :].astype(int))])
+        if startROI == 0 or endROI == 0:
+            fiberlabels[i, 0] = -1
+            continue
+        if startROI > nROIs or endROI > nROIs:
+            continue
+        if endROI < startROI:
+            startROI, endROI = endROI, startROI
+        fiberlabels[i, 0] = startROI
+        fiberlabels[i, 1] = endROI
+        final_fiberlabels.append([startROI, endROI])
+        final_fibers_idx.append(i)
+    return fiberlabels, final_fiberlabels, final_fibers_idx
+
+
+def _create_tractogram():
+    """ Fibers between the ROIs of _create_fibers, some of them ending in the
+    background, with edges made of one or several fibers
+    """
+    _, roiData, voxelSize = _create_fibers()
+    centers = {0: [5., 3., 3.], 1: [1., 1., 1.], 2: [7., 1., 1.],
+               3: [1., 7., 1.], 4: [5., 7., 5.]}
+    rng = np.random.RandomState(1)
+    fibers = []
+    for start, end, n_points in [(1, 2, 6), (2, 1, 3), (1, 2, 11),
+                                 (1, 3, 4), (4, 2, 7), (2, 4, 2),
+                                 (0, 3, 5), (3, 0, 8), (0, 0, 3),
+                                 (3, 3, 4), (1, 4, 2)]:
+        points = rng.uniform(0, 7.99, size=(n_points, 3))
+        points[0] = centers[start]
+        points[-1] = centers[end]
+        fibers.append((points.astype(np.float32), None, None))
+    return fibers, roiData, voxelSize
+
+
+@skipif(no_cmtk)
+def test_get_rois_crossed():
+    fibers, roiData, voxelSize = _create_fibers()
+    for fiber in fibers:
+        yield (assert_equal,
+               sorted(cmtk.get_rois_crossed(fiber[0], roiData, voxelSize)),
+               sorted(_old_get_rois_crossed(fiber[0], roiData, voxelSize)))
+
+
+@skipif(no_cmtk)
+def test_create_allpoints_cmat():
+    fibers, roiData, voxelSize = _create_fibers()
+    old_matrix, old_ids = _old_create_allpoints_cmat(fibers, roiData,
+                                                     voxelSize, 4)
+    yield assert_true, old_matrix.any()
+    yield assert_true, len(old_ids) < len(fibers)
+    for chunk_size in [1, 3, 5, len(fibers), 100000]:
+        matrix, ids = cmtk.create_allpoints_cmat(fibers, roiData, voxelSize,
+                                                 4, chunk_size=chunk_size)
+        yield assert_equal, matrix.dtype, old_matrix.dtype
+        yield assert_equal, matrix.tolist(), old_matrix.tolist()
+        yield assert_equal, ids, old_ids
+
+
+@skipif(no_cmtk)
+def test_get_connectivity_matrix():
+    fibers, roiData, voxelSize = _create_fibers()
+    crossed = [_old_get_rois_crossed(fiber[0], roiData, voxelSize)
+               for fiber in fibers]
+    crossed = [rois for rois in crossed if len(rois)]
+    old_matrix, _ = _old_create_allpoints_cmat(fibers, roiData, voxelSize, 4)
+    matrix = cmtk.get_connectivity_matrix(4, crossed)
+    yield assert_equal, matrix.tolist(), old_matrix.tolist()
+    yield assert_equal, cmtk.get_connectivity_matrix(4, []).tolist(), \
+        np.zeros((4, 4), dtype=np.uint).tolist()
+
+
+@skipif(no_cmtk)
+def test_create_endpoints_array():
+    fibers, _, voxelSize = _create_fibers()
+    old_endpoints, old_endpointsmm = _old_create_endpoints_array(fibers,
+                                                                 voxelSize)
+    endpoints, endpointsmm = cmtk.create_endpoints_array(fibers, voxelSize)
+    yield assert_equal, endpoints.dtype, old_endpoints.dtype
+    yield assert_equal, endpoints.tolist(), old_endpoints.tolist()
+    yield assert_equal, endpointsmm.dtype, old_endpointsmm.dtype
+    yield assert_equal, endpointsmm.tolist(), old_endpointsmm.tolist()
+
+
+@skipif(no_cmtk)
+def test_fiber_lengths():
+    fibers, _, _ = _create_fibers()
+    old_lengths = [cmtk.length(fiber[0]) for fiber in fibers]
+    yield assert_equal, cmtk.fiber_lengths(fibers).tolist(), old_lengths
+    indices = [2, 3, 7, 12]
+    yield (assert_equal, cmtk.fiber_lengths(fibers, indices).tolist(),
+           [old_lengths[i] for i in indices])
+    yield assert_equal, len(cmtk.fiber_lengths(fibers, [])), 0
+
+
+@skipif(no_cmtk)
+def test_cmat():
+    fibers, roiData, voxelSize = _create_tractogram()
+    nROIs = 4
+    tmpdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tmpdir)
+    try:
+        hdr = nb.trackvis.empty_header()
+        hdr['voxel_size'] = voxelSize
+        hdr['dim'] = roiData.shape
+        nb.trackvis.write('tracks.trk', fibers, hdr)
+        roi = nb.Nifti1Image(roiData, np.diag(list(voxelSize) + [1.]))
+        nb.save(roi, 'roi.nii')
+        gp = nx.Graph()
+        for label in range(1, nROIs + 1):
+            gp.add_node(label, dn_correspondence_id=label)
+        nx.write_gpickle(gp, 'network.pck')
+        cmtk.cmat('tracks.trk', 'roi.nii', 'network.pck', 'cmatrix.pck',
+                  'cmatrix.mat', 'fibers')
+        fiberlabels = np.load('fibers_filtered_fiberslabel.npy')
+        final_fiberlabels = np.load('fibers_final_fiberslabels.npy')
+        final_fiberlengths = np.load('fibers_final_fiberslength.npy')
+        endpoints = np.load('fibers_endpoints.npy')
+        G = nx.read_gpickle('cmatrix.pck')
+        fib, _ = nb.trackvis.read('tracks.trk', False)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+    old_fiberlabels, old_final_fiberlabels, old_final_fibers_idx = \
+        _old_fiber_labels(endpoints, roiData, nROIs)
+    yield assert_equal, fiberlabels.tolist(), old_fiberlabels.tolist()
+    yield assert_equal, final_fiberlabels.tolist(), old_final_fiberlabels
+    old_fiberlengths = np.array([cmtk.length(fib[i][0])
+                                 for i in old_final_fibers_idx])
+    yield assert_equal, final_fiberlengths.tolist(), old_fiberlengths.tolist()
+
+    # the previous computation of the edge statistics
+    old_final_fiberlabels = np.array(old_final_fiberlabels, dtype=int)
+    edges = set(map(tuple, old_final_fiberlabels.tolist()))
+    yield assert_true, (1, 3) in edges
+    yield assert_true, (2, 4) in edges
+    for u, v in edges:
+        idx = np.where((old_final_fiberlabels[:, 0] == u) &
+                       (old_final_fiberlabels[:, 1] == v))[0]
+        if u == v:
+            yield assert_true, not G.has_edge(u, v)
+            continue
+        d = G.edge[u][v]
+        yield assert_equal, d['number_of_fibers'], len(idx)
+        for key, func in [('fiber_length_mean', np.mean),
+                          ('fiber_length_median', np.median),
+                          ('fiber_length_std', np.std)]:
+            yield assert_equal, d[key], float(func(old_fiberlengths[idx]))
@@ -34,6 +34,7 @@ class Dcm2nii(CommandLine):
     output_spec=Dcm2niiOutputSpec
 
     _cmd = 'dcm2nii'
+    _terminal_output = 'full'
 
     def _format_arg(self, opt, spec, val):
         if opt in ['gzip_output', 'nii_output', 'anonymize', 'id_in_filename', 'reorient', 'reorient_and_crop', 'convert_all_pars']:
@@ -178,6 +179,7 @@ class Dcm2niix(CommandLine):
     input_spec = Dcm2niixInputSpec
     output_spec = Dcm2niixOutputSpec
     _cmd = 'dcm2niix'
+    _terminal_output = 'full'
 
     def _format_arg(self, opt, spec, val):
         if opt in ['bids_format', 'merge_imgs', 'single_file', 'verbose', 'crop',
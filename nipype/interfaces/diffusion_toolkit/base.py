@@ -15,6 +15,7 @@ See the docstrings for the individual classes for 'working' examples.
 __docformat__ = 'restructuredtext'
 import re
 from nipype.interfaces.base import CommandLine
+from nipype.utils.probecache import memoize_probe
 
 class Info(object):
     """ Handle dtk output type and version information.
@@ -29,6 +30,7 @@ class Info(object):
     """
 
     @staticmethod
+    @memoize_probe('dtk_version', ['PATH'])
     def version():
         """Check for dtk version on system
 
@@ -42,7 +44,8 @@ class Info(object):
            Version number as string or None if FSL not found
 
         """
-        clout = CommandLine(command='dti_recon').run()
+        clout = CommandLine(command='dti_recon',
+                            terminal_output='full').run()
 
         if clout.runtime.returncode is not 0:
             return None
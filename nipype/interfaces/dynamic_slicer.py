@@ -22,7 +22,8 @@ class SlicerCommandLine(CommandLine):
 
 
     def _grab_xml(self, module):
-        cmd = CommandLine(command = "Slicer3", args="--launch %s --xml"%module)
+        cmd = CommandLine(command = "Slicer3", args="--launch %s --xml"%module,
+                          terminal_output='full')
         ret = cmd.run()
         if ret.runtime.returncode == 0:
             return xml.dom.minidom.parseString(ret.runtime.stdout)
@@ -18,6 +18,7 @@ __docformat__ = 'restructuredtext'
 import os
 
 from nipype.utils.filemanip import fname_presuffix
+from nipype.utils.probecache import memoize_probe
 from nipype.interfaces.base import (CommandLine, Directory,
                                     CommandLineInputSpec, isdefined)
 
@@ -35,6 +36,7 @@ class Info(object):
     """
 
     @staticmethod
+    @memoize_probe('freesurfer_version', ['FREESURFER_HOME'])
     def version():
         """Check for freesurfer version on system
 
@@ -17,7 +17,7 @@ from glob import glob
 #import itertools
 import numpy as np
 
-from nibabel import load
+from nipype.utils.imageheader import image_shape
 from nipype.utils.filemanip import fname_presuffix
 from nipype.interfaces.io import FreeSurferSource
 
@@ -369,7 +369,7 @@ class MRIConvert(FSCommand):
         outputs = self.output_spec().get()
         outfile = self._get_outfilename()
         if isdefined(self.inputs.split) and self.inputs.split:
-            size = load(self.inputs.in_file).get_shape()
+            size = image_shape(self.inputs.in_file)
             if len(size) == 3:
                 tp = 1
             else:
@@ -389,7 +389,7 @@ class MRIConvert(FSCommand):
         if isdefined(self.inputs.out_type):
             if self.inputs.out_type in ['spm', 'analyze']:
                 # generate all outputs
-                size = load(self.inputs.in_file).get_shape()
+                size = image_shape(self.inputs.in_file)
                 if len(size) == 3:
                     tp = 1
                 else:
@@ -659,6 +659,7 @@ class ImageInfoOutputSpec(TraitedSpec):
 class ImageInfo(FSCommand):
 
     _cmd = "mri_info"
+    _terminal_output = 'full'
     input_spec = ImageInfoInputSpec
     output_spec = ImageInfoOutputSpec
 
@@ -30,6 +30,7 @@ import os
 import warnings
 
 from nipype.utils.filemanip import fname_presuffix
+from nipype.utils.probecache import memoize_probe
 from nipype.interfaces.base import (CommandLine, traits, CommandLineInputSpec,
                                     isdefined)
 
@@ -53,6 +54,7 @@ class Info(object):
               'NIFTI_PAIR_GZ': '.img.gz'}
 
     @staticmethod
+    @memoize_probe('fsl_version', ['FSLDIR'])
     def version():
         """Check for fsl version on system
 
@@ -73,7 +75,8 @@ class Info(object):
         except KeyError:
             return None
         clout = CommandLine(command='cat',
-                            args='%s/etc/fslversion' % (basedir)).run()
+                            args='%s/etc/fslversion' % (basedir),
+                            terminal_output='full').run()
         out = clout.runtime.stdout
         return out.strip('\n')
 
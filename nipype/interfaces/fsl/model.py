@@ -24,7 +24,7 @@ from nipype.interfaces.base import (load_template, File, traits, isdefined,
                                     InputMultiPath, OutputMultiPath,
                                     BaseInterfaceInputSpec)
 from nipype.utils.filemanip import (list_to_filename, filename_to_list)
-from nibabel import load
+from nipype.utils.imageheader import image_shape
 
 warn = warnings.warn
 warnings.filterwarnings('always', category=UserWarning)
@@ -296,8 +296,7 @@ class Level1Design(BaseInterface):
             num_evs, cond_txt = self._create_ev_files(cwd, info, i, usetd,
                                                       self.inputs.contrasts,
                                                       no_bases, do_tempfilter)
-            nim = load(func_files[i])
-            (_, _, _, timepoints) = nim.get_shape()
+            (_, _, _, timepoints) = image_shape(func_files[i])
             fsf_txt = fsf_header.substitute(run_num=i,
                                             interscan_interval=self.inputs.interscan_interval,
                                             num_vols=timepoints,
@@ -1267,6 +1266,7 @@ class SmoothEstimate(FSLCommand):
     input_spec = SmoothEstimateInputSpec
     output_spec = SmoothEstimateOutputSpec
     _cmd = 'smoothest'
+    _terminal_output = 'full'
 
     def aggregate_outputs(self, runtime=None, needed_outputs=None):
         outputs = self._outputs()
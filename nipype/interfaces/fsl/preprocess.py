@@ -22,7 +22,7 @@ from nipype.interfaces.base import (TraitedSpec, File, InputMultiPath,
                                     isdefined, OutputMultiPath)
 from nipype.utils.filemanip import split_filename
 
-from nibabel import load
+from nipype.utils.imageheader import image_shape
 
 
 warn = warnings.warn
@@ -597,7 +597,7 @@ class MCFLIRT(FSLCommand):
         if isdefined(self.inputs.save_mats) and self.inputs.save_mats:
             _, filename = os.path.split(outputs['out_file'])
             matpathname = os.path.join(cwd, filename + '.mat')
-            _, _, _, timepoints = load(self.inputs.in_file).get_shape()
+            _, _, _, timepoints = image_shape(self.inputs.in_file)
             outputs['mat_file'] = []
             for t in range(timepoints):
                 outputs['mat_file'].append(os.path.join(matpathname,
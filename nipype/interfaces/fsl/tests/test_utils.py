@@ -382,3 +382,24 @@ def test_swapdims():
 
     # Clean up
     clean_directory(testdir, origdir)
+
+
+def test_stats_output_none():
+    # ImageStats parses the output of fslstats, which must be kept when the
+    # command output is not captured by default
+    from nipype import config
+    filelist, outdir, cwd = create_files_in_directory()
+    open('fslstats', 'wt').write('#!/bin/sh\necho 1.5 2.5\n')
+    os.chmod('fslstats', 0755)
+    path = os.environ['PATH']
+    os.environ['PATH'] = outdir + os.pathsep + path
+    output = config.get('execution', 'command_output')
+    config.set('execution', 'command_output', 'none')
+    try:
+        stats = fsl.ImageStats(in_file=filelist[0], op_string='-R')
+        res = stats.run()
+    finally:
+        config.set('execution', 'command_output', output)
+        os.environ['PATH'] = path
+        clean_directory(outdir, cwd)
+    yield assert_equal, res.outputs.out_stat, [1.5, 2.5]
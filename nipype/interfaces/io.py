@@ -22,6 +22,7 @@ import os
 import shutil
 import re
 import tempfile
+from time import time
 from warnings import warn
 
 import sqlite3
@@ -36,7 +37,8 @@ from nipype.interfaces.base import (TraitedSpec, traits, File, Directory,
                                     OutputMultiPath, DynamicTraitedSpec,
                                     Undefined, BaseInterfaceInputSpec)
 from nipype.utils.filemanip import (copyfile, list_to_filename,
-                                    filename_to_list)
+                                    filename_to_list, transfer_file)
+from nipype.utils.dirindex import get_directory_index
 
 from .. import logging
 iflogger = logging.getLogger('interface')
@@ -127,6 +129,14 @@ class DataSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
     _outputs = traits.Dict(traits.Str, value={}, usedefault=True)
     remove_dest_dir = traits.Bool(False, usedefault=True,
                                   desc='remove dest directory when copying dirs')
+    copy_method = traits.Enum('copy', 'hardlink', 'reflink', usedefault=True,
+                              nohash=True,
+                              desc=('store files as copies, hard links or '
+                                    'copy-on-write clones (reflink). Files '
+                                    'are copied when they cannot be linked '
+                                    'or cloned'))
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of files stored in parallel')
 
     def __setattr__(self, key, value):
         if key not in self.copyable_trait_names():
@@ -176,6 +186,11 @@ class DataSink(IOBase):
             This interface **cannot** be used in a MapNode as the inputs are
             defined only when the connect statement is executed.
 
+        Files whose size and modification time did not change since they were
+        stored are not copied again. Files can be stored as hard links or
+        copy-on-write clones when the base directory is on the same file
+        system (`copy_method`), and copied in parallel (`num_threads`).
+
         Examples
         --------
 
@@ -280,6 +295,7 @@ class DataSink(IOBase):
                     pass
                 else:
                     raise(inst)
+        transfers = []
         for key, files in self.inputs._outputs.items():
             if not isdefined(files):
                 continue
@@ -311,8 +327,7 @@ class DataSink(IOBase):
                                 pass
                             else:
                                 raise(inst)
-                    iflogger.debug("copyfile: %s %s"%(src, dst))
-                    copyfile(src, dst, copy=True, hashmethod='content')
+                    transfers.append((src, dst))
                 elif os.path.isdir(src):
                     dst = self._get_dst(os.path.join(src,''))
                     dst = os.path.join(tempoutdir, dst)
@@ -331,8 +346,50 @@ class DataSink(IOBase):
                         shutil.rmtree(dst)
                     iflogger.debug("copydir: %s %s"%(src, dst))
                     copytree(src, dst)
+        self._transfer_files(transfers)
         return None
 
+    def _transfer_files(self, transfers):
+        """Store the (source, destination) files and log the throughput
+        """
+        method = self.inputs.copy_method
+        # the last source stored to a destination wins, as when copying
+        # files one after the other
+        last = dict([(dst, i) for i, (src, dst) in enumerate(transfers)])
+        transfers = [pair for i, pair in enumerate(transfers)
+                     if last[pair[1]] == i]
+        transfer = lambda pair: transfer_file(pair[0], pair[1], method)
+        start = time()
+        num_threads = min(self.inputs.num_threads, len(transfers))
+        if num_threads < 2:
+            results = map(transfer, transfers)
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(num_threads)
+            try:
+                results = pool.map(transfer, transfers)
+            finally:
+                pool.close()
+                pool.join()
+        duration = time() - start
+        counts = {}
+        nbytes = 0
+        for _, action, size in [item for result in results
+                                for item in result]:
+            counts[action] = counts.get(action, 0) + 1
+            if action != 'unchanged':
+                nbytes += size
+        if results:
+            labels = dict(copy='copied', hardlink='hard linked',
+                          reflink='cloned', unchanged='unchanged')
+            iflogger.info('Stored %s files (%.1f MB) in %.2f seconds '
+                          '(%.1f MB/s)' %
+                          (', '.join(['%d %s' % (counts[action], labels[action])
+                                      for action in sorted(counts)]),
+                           nbytes / 1e6, duration,
+                           nbytes / 1e6 / max(duration, 1e-6)))
+        return counts
+
 
 class DataGrabberInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec): #InterfaceInputSpec):
     base_directory = Directory(exists=True,
@@ -346,6 +403,18 @@ class DataGrabberInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec): #Interfa
     template_args = traits.Dict(key_trait=traits.Str,
                                 value_trait= traits.List(traits.List),
                                 desc='Information to plug into template')
+    use_index = traits.Bool(False, usedefault=True, nohash=True,
+                    desc=('Match templates against an in-memory index of '
+                          'base_directory, shared by the DataGrabbers of a '
+                          'process, instead of listing directories for '
+                          'each template'))
+    index_file = File(nohash=True, requires=['use_index'],
+                      desc=('File the directory index is loaded from and '
+                            'saved to, e.g. to share it across runs'))
+    index_refresh = traits.Enum('mtime', 'none', usedefault=True, nohash=True,
+                        desc=('List indexed directories again when their '
+                              'modification time changed (mtime) or never '
+                              '(none, for data that does not change)'))
 
 class DataGrabber(IOBase):
     """ Generic datagrabber module that wraps around glob in an
@@ -397,6 +466,12 @@ class DataGrabber(IOBase):
         >>> dg.inputs.field_template = dict(struct='%s/struct.nii')
         >>> dg.inputs.template_args['struct'] = [['sid']]
 
+        Match the templates against an index of the base directory, and get
+        the files of many subjects at once
+
+        >>> dg.inputs.use_index = True
+        >>> outputs = dg.list_outputs_for(sid=['s1', 's2']) # doctest: +SKIP
+
     """
     input_spec = DataGrabberInputSpec
     output_spec = DynamicTraitedSpec
@@ -449,7 +524,46 @@ class DataGrabber(IOBase):
         """
         return add_traits(base, self.inputs.template_args.keys())
 
-    def _list_outputs(self):
+    def _directory_index(self):
+        if not self.inputs.use_index or \
+                not isdefined(self.inputs.base_directory):
+            return None
+        index_file = None
+        if isdefined(self.inputs.index_file):
+            index_file = os.path.abspath(self.inputs.index_file)
+        return get_directory_index(self.inputs.base_directory,
+                                   index_file=index_file,
+                                   refresh=self.inputs.index_refresh)
+
+    def list_outputs_for(self, **values):
+        """Return the outputs for several values of the infields at once
+
+        Each keyword gives a list of values of an infield, the lists having
+        the same length. Returns the list of the outputs for each set of
+        values; values raising IOError with raise_on_empty give None.
+        """
+        lengths = set([len(value) for value in values.values()])
+        if len(lengths) > 1:
+            raise ValueError('Infield values must be lists of the same length')
+        saved = dict([(key, getattr(self.inputs, key)) for key in values])
+        results = []
+        try:
+            for i in range(lengths.pop() if lengths else 0):
+                for key, value in values.items():
+                    setattr(self.inputs, key, value[i])
+                try:
+                    results.append(self._list_outputs(save_index=False))
+                except IOError, e:
+                    iflogger.warn(str(e))
+                    results.append(None)
+        finally:
+            self.inputs.trait_set(trait_change_notify=False, **saved)
+            index = self._directory_index()
+            if index is not None:
+                index.save_if_changed()
+        return results
+
+    def _list_outputs(self, save_index=True):
         # infields are mandatory, however I could not figure out how to set 'mandatory' flag dynamically
         # hence manual check
         if self._infields:
@@ -460,6 +574,11 @@ class DataGrabber(IOBase):
                     (self.__class__.__name__, key)
                     raise ValueError(msg)
 
+        index = self._directory_index()
+        if index is None:
+            find_files = glob.glob
+        else:
+            find_files = index.glob
         outputs = {}
         for key, args in self.inputs.template_args.items():
             outputs[key] = []
@@ -473,7 +592,7 @@ class DataGrabber(IOBase):
             else:
                 template = os.path.abspath(template)
             if not args:
-                filelist = glob.glob(template)
+                filelist = find_files(template)
                 if len(filelist) == 0:
                     msg = 'Output key: %s Template: %s returned no files'%(key, template)
                     if self.inputs.raise_on_empty:
@@ -507,7 +626,7 @@ class DataGrabber(IOBase):
                     filledtemplate = template
                     if argtuple:
                         filledtemplate = template%tuple(argtuple)
-                    outfiles = glob.glob(filledtemplate)
+                    outfiles = find_files(filledtemplate)
                     if len(outfiles) == 0:
                         msg = 'Output key: %s Template: %s returned no files'%(key, filledtemplate)
                         if self.inputs.raise_on_empty:
@@ -525,6 +644,8 @@ class DataGrabber(IOBase):
                 outputs[key] = None
             elif len(outputs[key]) == 1:
                 outputs[key] = outputs[key][0]
+        if index is not None and save_index:
+            index.save_if_changed()
         return outputs
 
 
@@ -5,7 +5,8 @@ import os
 
 from nipype.interfaces.base import (CommandLineInputSpec, InputMultiPath, isdefined,
                                     CommandLine, traits, File, Directory)
-from .. import config
+from .. import config, logging
+iflogger = logging.getLogger('interface')
 
 def get_matlab_command():
     if 'NIPYPE_NO_MATLAB' in os.environ:
@@ -17,7 +18,8 @@ def get_matlab_command():
         matlab_cmd = 'matlab'
 
     try:
-        res = CommandLine(command='which', args=matlab_cmd).run()
+        res = CommandLine(command='which', args=matlab_cmd,
+                          terminal_output='full').run()
         matlab_path = res.runtime.stdout.strip()
     except Exception, e:
         return None
@@ -130,6 +132,12 @@ class MatlabCommand(CommandLine):
         cls._default_paths = paths
 
     def _run_interface(self,runtime):
+        if self._uses_session():
+            from nipype.utils.matlabpool import SessionError
+            try:
+                return self._run_in_session(runtime)
+            except SessionError, e:
+                iflogger.warn('Running MATLAB without a session: %s' % e)
         runtime = super(MatlabCommand, self)._run_interface(runtime)
         try:
             # Matlab can leave the terminal in a barbbled state
@@ -141,6 +149,62 @@ class MatlabCommand(CommandLine):
             self.raise_exception(runtime)
         return runtime
 
+    def _uses_session(self):
+        """Whether the code is sent to a persistent MATLAB session"""
+        if not config.getboolean('execution', 'matlab_sessions'):
+            return False
+        # MCR applications and log files take the code on the command line
+        return not self.inputs.uses_mcr and not isdefined(self.inputs.logfile)
+
+    def _run_in_session(self, runtime):
+        from nipype.utils.matlabpool import get_session_pool
+        command = ' '.join([self.cmd] + self._parse_inputs(skip=['script']))
+        code = self._gen_matlab_command('%s', self.inputs.script)
+        if self.inputs.mfile:
+            # unlike addpath, run does not grow the path of the session
+            code = "run('%s')" % os.path.join(runtime.cwd,
+                                              self.inputs.script_file)
+        runtime.cmdline = '%s <<< "%s"' % (command, code)
+        runtime.stdout = None
+        runtime.stderr = None
+        runtime.output_log = None
+        self._update_environ(runtime)
+        rows = get_session_pool().run(command, code, runtime.cwd,
+                                      environ=runtime.environ)
+        runtime.returncode = 0
+        failed = [row for row in rows if row[1] == 'stderr' and
+                  'MATLAB code threw an exception' in row[2]]
+        # the output is captured as with run_command
+        output = self._get_terminal_output()
+        if output is None:
+            output = config.get('execution', 'command_output')
+        if output in ['tail', 'file']:
+            runtime.output_log = os.path.join(
+                runtime.cwd, config.get('execution', 'command_output_file'))
+            logfile = open(runtime.output_log, 'w')
+            logfile.write(''.join(['%s %s:%s\n' % (row[1], row[0], row[2])
+                                   for row in rows]))
+            logfile.close()
+        if output in ['full', 'tail']:
+            for row in rows:
+                iflogger.info(row[2])
+        tail = int(config.get('execution', 'command_output_tail'))
+        if output == 'tail':
+            rows = sorted([row for row in rows if row[1] == 'stdout'][-tail:] +
+                          [row for row in rows if row[1] == 'stderr'][-tail:])
+        elif output in ['file', 'none']:
+            # as with run_command, the end of stderr is kept
+            rows = [row for row in rows if row[1] == 'stderr'][-tail:]
+        runtime.stdout = '\n'.join([row[2] for row in rows
+                                    if row[1] == 'stdout'])
+        runtime.stderr = '\n'.join([row[2] for row in rows
+                                    if row[1] == 'stderr'])
+        runtime.merged = ['%s %s:%s' % (row[1], row[0], row[2])
+                          for row in rows]
+        if failed:
+            self.raise_exception(runtime)
+        return runtime
+
     def _format_arg(self, name, trait_spec, value):
         if name in ['script']:
             argstr = trait_spec.argstr
@@ -156,8 +220,8 @@ class MatlabCommand(CommandLine):
         if isdefined(self.inputs.paths):
             paths = self.inputs.paths
         # prescript
-        prescript = self.inputs.prescript
-        postscript = self.inputs.postscript
+        prescript = list(self.inputs.prescript)
+        postscript = list(self.inputs.postscript)
 
         #postcript takes different default value depending on the mfile argument
         if mfile:
@@ -17,10 +17,11 @@ from nipype.interfaces.base import (BaseInterface, traits, isdefined,
                                     InputMultiPath, BaseInterfaceInputSpec,
                                     Directory)
 
-from nibabel import load
 from nipype.interfaces.matlab import MatlabCommand
 
 import nipype.utils.spm_docs as sd
+from nipype.utils.imageheader import image_shape
+from nipype.utils.probecache import cached_probe
 
 from ... import logging
 logger = logging.getLogger('interface')
@@ -31,8 +32,7 @@ def func_is_3d(in_file):
     if isinstance(in_file, list):
         return func_is_3d(in_file[0])
     else:
-        img = load(in_file)
-        shape = img.get_shape()
+        shape = image_shape(in_file)
         if len(shape) == 3 or (len(shape)==4 and shape[3]==1):
             return True
         else:
@@ -49,7 +49,7 @@ def scans_for_fname(fname):
     """Reads a nifti file and converts it to a numpy array storing
     individual nifti volumes.
 
-    Opens images so will fail if they are not found.
+    Reads image headers so will fail if they are not found.
 
     """
     if isinstance(fname,list):
@@ -57,11 +57,11 @@ def scans_for_fname(fname):
         for sno,f in enumerate(fname):
             scans[sno] = '%s,1'%f
         return scans
-    img = load(fname)
-    if len(img.get_shape()) == 3:
+    shape = image_shape(fname)
+    if len(shape) == 3:
         return np.array(('%s,1'%fname,),dtype=object)
     else:
-        n_scans = img.get_shape()[3]
+        n_scans = shape[3]
         scans = np.zeros((n_scans,),dtype=object)
         for sno in range(n_scans):
             scans[sno] = '%s,%d'% (fname, sno+1)
@@ -132,7 +132,17 @@ class Info(object):
                 matlab_cmd = os.environ['MATLABCMD']
             except:
                 matlab_cmd = 'matlab -nodesktop -nosplash'
-        mlab = MatlabCommand(matlab_cmd = matlab_cmd)
+        # the SPM found depends on the matlab command and on the default
+        # paths of MatlabCommand
+        return cached_probe('spm_version', Info._probe_version,
+                            args=(matlab_cmd, MatlabCommand._default_paths),
+                            env_vars=['MATLABPATH', 'PATH'])
+
+    @staticmethod
+    def _probe_version(matlab_cmd, paths):
+        mlab = MatlabCommand(matlab_cmd = matlab_cmd, terminal_output='full')
+        if paths:
+            mlab.inputs.paths = paths
         mlab.inputs.script = """
         if isempty(which('spm')),
         throw(MException('SPMCheck:NotFound','SPM not in matlab path'));
@@ -140,7 +150,6 @@ class Info(object):
         spm_path = spm('dir');
         [name, version] = spm('ver');
         fprintf(1, 'NIPYPE path:%s|name:%s|release:%s', spm_path, name, version);
-        exit;
         """
         mlab.inputs.mfile = False
         try:
@@ -189,6 +198,9 @@ class SPMCommand(BaseInterface):
     _matlab_cmd = None
     _paths = None
     _use_mcr = None
+    # output capture of matlab, interfaces parsing its output set it to
+    # 'full'
+    _terminal_output = None
 
     def __init__(self, **inputs):
         super(SPMCommand, self).__init__(**inputs)
@@ -215,6 +227,10 @@ class SPMCommand(BaseInterface):
                                   uses_mcr=self.inputs.use_mcr)
         self.mlab.inputs.script_file = 'pyscript_%s.m' % \
         self.__class__.__name__.split('.')[-1].lower()
+        # stdout is parsed by some interfaces and reports failures of the MCR
+        if self._terminal_output or (isdefined(self.inputs.use_mcr) and
+                                     self.inputs.use_mcr):
+            self.mlab.inputs.terminal_output = 'full'
 
     @property
     def jobtype(self):
@@ -431,6 +431,7 @@ class Threshold(SPMCommand):
     '''
     input_spec = ThresholdInputSpec
     output_spec = ThresholdOutputSpec
+    _terminal_output = 'full'
 
     def _gen_thresholded_map_filename(self):
         _, fname, ext = split_filename(self.inputs.stat_image)
@@ -609,6 +610,7 @@ class ThresholdStatistics(SPMCommand):
     '''
     input_spec = ThresholdStatisticsInputSpec
     output_spec = ThresholdStatisticsOutputSpec
+    _terminal_output = 'full'
 
     def _make_matlab_command(self, _):
         script = "con_index = %d;\n" % self.inputs.contrast_index
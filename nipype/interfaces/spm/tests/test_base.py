@@ -147,3 +147,38 @@ def test_make_matlab_command():
     script = dc._make_matlab_command([contents])
     yield assert_true, 'jobs{1}.jobtype{1}.jobname{1}.contents(3) = 3;' in script
     clean_directory(outdir, cwd)
+
+
+def test_version_probe_key():
+    from nipype.utils.probecache import clear_probe_cache
+    from nipype import config
+    probes = []
+
+    def probe(matlab_cmd, paths):
+        probes.append((matlab_cmd, paths))
+        return dict(path=str(paths), name='SPM8', release='4290')
+
+    old_probe = spm.Info._probe_version
+    old_paths = mlab.MatlabCommand._default_paths
+    old_data_file = config.data_file
+    tmpdir = mkdtemp()
+    config.data_file = os.path.join(tmpdir, 'nipype.json')
+    spm.Info._probe_version = staticmethod(probe)
+    clear_probe_cache()
+    try:
+        mlab.MatlabCommand.set_default_paths('/spm8')
+        yield assert_equal, spm.Info.version('matlab')['path'], '/spm8'
+        yield assert_equal, spm.Info.version('matlab')['path'], '/spm8'
+        yield assert_equal, len(probes), 1
+        # the default paths and the matlab command are part of the key
+        mlab.MatlabCommand.set_default_paths('/spm12')
+        yield assert_equal, spm.Info.version('matlab')['path'], '/spm12'
+        spm.Info.version('matlab -nojvm')
+        yield assert_equal, probes[1:], [('matlab', '/spm12'),
+                                         ('matlab -nojvm', '/spm12')]
+    finally:
+        spm.Info._probe_version = old_probe
+        mlab.MatlabCommand._default_paths = old_paths
+        config.data_file = old_data_file
+        clear_probe_cache()
+        rmtree(tmpdir)
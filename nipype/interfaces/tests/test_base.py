@@ -307,3 +307,51 @@ def test_Commandline_environ():
     ci3.inputs.environ = {'DISPLAY' : ':2'}
     res = ci3.run()
     yield assert_equal, res.runtime.environ['DISPLAY'], ':2'
+
+
+def test_Commandline_output_modes():
+    tmpd = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tmpd)
+    cmd = 'for i in 1 2 3 4 5; do echo out$i; echo err$i 1>&2; done'
+    open('chatty.sh', 'wt').write(cmd)
+    for mode in nib.COMMAND_OUTPUT_MODES:
+        ci = nib.CommandLine(command='sh', args='chatty.sh',
+                             terminal_output=mode)
+        res = ci.run()
+        yield assert_equal, res.runtime.returncode, 0
+        if mode == 'full':
+            yield assert_equal, res.runtime.stdout.split('\n'), \
+                ['out1', 'out2', 'out3', 'out4', 'out5']
+            yield assert_equal, len(res.runtime.merged), 10
+            yield assert_equal, res.runtime.output_log, None
+        elif mode == 'none':
+            yield assert_equal, res.runtime.stdout, ''
+            # stderr is kept, interfaces detect failures from it
+            yield assert_equal, res.runtime.stderr.split('\n'), \
+                ['err1', 'err2', 'err3', 'err4', 'err5']
+            yield assert_equal, res.runtime.output_log, None
+        else:
+            logfile = os.path.join(tmpd, 'command_output.log')
+            yield assert_equal, res.runtime.output_log, logfile
+            lines = open(logfile).read().splitlines()
+            yield assert_equal, len(lines), 10
+            yield assert_true, lines[0].startswith('stdout ')
+            yield assert_true, lines[0].endswith(':out1')
+            if mode == 'file':
+                yield assert_equal, res.runtime.stdout, ''
+                yield assert_equal, res.runtime.stderr.split('\n'), \
+                    ['err1', 'err2', 'err3', 'err4', 'err5']
+    rt = nib.run_command(nib.Bunch(cmdline=cmd, cwd=tmpd,
+                                   environ=os.environ.copy()),
+                         output='tail', tail=2)
+    yield assert_equal, rt.stdout, 'out4\nout5'
+    yield assert_equal, rt.stderr, 'err4\nerr5'
+    yield assert_equal, len(rt.merged), 4
+    # an incomplete last line is kept
+    rt = nib.run_command(nib.Bunch(cmdline='printf "a\\nb"', cwd=tmpd,
+                                   environ=os.environ.copy()), output='full')
+    yield assert_equal, rt.stdout, 'a\nb'
+    yield assert_raises, ValueError, nib.run_command, rt, 'bogus'
+    os.chdir(cwd)
+    shutil.rmtree(tmpd)
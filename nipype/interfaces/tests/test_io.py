@@ -87,3 +87,89 @@ def test_freesurfersource():
     yield assert_equal, fss.inputs.hemi, 'both'
     yield assert_equal, fss.inputs.subject_id, Undefined
     yield assert_equal, fss.inputs.subjects_dir, Undefined
+
+def test_datasink_transfer():
+    indir = mkdtemp()
+    outdir = mkdtemp()
+    files = []
+    for name in ['a.txt', 'b.txt']:
+        files.append(os.path.join(indir, name))
+        open(files[-1], 'wt').write(name * 10)
+    ds = nio.DataSink(base_directory=outdir, parameterization=False,
+                      num_threads=2)
+    setattr(ds.inputs, 'out.@files', files)
+    ds.run()
+    stored = [os.path.join(outdir, 'out', name) for name in ['a.txt', 'b.txt']]
+    # copies keep the modification time of the original
+    yield assert_false, os.path.samefile(files[0], stored[0])
+    yield assert_true, abs(os.stat(files[0]).st_mtime -
+                           os.stat(stored[0]).st_mtime) < 1e-3
+    yield assert_equal, ds._transfer_files(zip(files, stored)), \
+        {'unchanged': 2}
+    open(files[0], 'wt').write('changed')
+    os.utime(files[0], (1000000000, 1000000000))
+    yield assert_equal, ds._transfer_files(zip(files, stored)), \
+        {'copy': 1, 'unchanged': 1}
+    yield assert_equal, open(stored[0]).read(), 'changed'
+    # files of the same size whose modification time changed are compared by
+    # content
+    open(files[0], 'wt').write('CHANGED')
+    yield assert_equal, ds._transfer_files(zip(files, stored)), \
+        {'copy': 1, 'unchanged': 1}
+    os.utime(files[0], (1000000000, 2000000000))
+    yield assert_equal, ds._transfer_files(zip(files, stored)), \
+        {'unchanged': 2}
+    # links replace the copies
+    ds.inputs.copy_method = 'hardlink'
+    open(files[1], 'wt').write('new content')
+    ds.run()
+    yield assert_true, os.path.samefile(files[1], stored[1])
+    yield assert_equal, ds._transfer_files(zip(files, stored)), \
+        {'unchanged': 2}
+    # copies replace the links
+    ds.inputs.copy_method = 'copy'
+    ds.run()
+    yield assert_false, os.path.samefile(files[1], stored[1])
+    yield assert_equal, open(stored[1]).read(), 'new content'
+    shutil.rmtree(indir)
+    shutil.rmtree(outdir)
+
+def test_datagrabber_index():
+    basedir = mkdtemp()
+    for sid in ['s1', 's2']:
+        os.makedirs(os.path.join(basedir, sid))
+        for name in ['f3.nii', 'f5.nii', 'struct.nii']:
+            open(os.path.join(basedir, sid, name), 'wt').close()
+    dg = nio.DataGrabber(infields=['sid'], outfields=['func', 'struct'])
+    dg.inputs.base_directory = basedir
+    dg.inputs.template = '%s/%s.nii'
+    dg.inputs.template_args['func'] = [['sid', ['f3', 'f5']]]
+    dg.inputs.template_args['struct'] = [['sid', 'struct']]
+    dg.inputs.sid = 's1'
+    expected = dg._list_outputs()
+    dg.inputs.use_index = True
+    yield assert_equal, dg._list_outputs(), expected
+    # files of many subjects at once
+    outputs = dg.list_outputs_for(sid=['s1', 's2', 's3'])
+    yield assert_equal, outputs[0], expected
+    yield assert_equal, outputs[1]['struct'], \
+        os.path.join(basedir, 's2', 'struct.nii')
+    yield assert_equal, outputs[2], None
+    yield assert_equal, dg.inputs.sid, 's1'
+    shutil.rmtree(basedir)
+
+def test_datasink_same_basename():
+    indir = mkdtemp()
+    outdir = mkdtemp()
+    files = []
+    for name in ['a', 'b']:
+        os.mkdir(os.path.join(indir, name))
+        files.append(os.path.join(indir, name, 'f.txt'))
+        open(files[-1], 'wt').write(name)
+    ds = nio.DataSink(base_directory=outdir, parameterization=False)
+    setattr(ds.inputs, 'x', files)
+    ds.run()
+    # the last file stored to a destination wins
+    yield assert_equal, open(os.path.join(outdir, 'x', 'f.txt')).read(), 'b'
+    shutil.rmtree(indir)
+    shutil.rmtree(outdir)
@@ -1,6 +1,7 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 import os
+import sys
 from tempfile import mkdtemp
 from shutil import rmtree
 
@@ -83,3 +84,89 @@ def test_set_matlabcmd():
     mi.set_default_matlab_cmd('foo')
     yield assert_equal, mi._default_matlab_cmd, 'foo'
     mi.set_default_matlab_cmd(matlab_cmd)
+
+
+# stand-in for matlab: the code of each line read from stdin is echoed, the
+# code given with -r is not run
+STANDIN = r"""
+import os, re, sys
+if '-r' in sys.argv:
+    print 'one-shot'
+    sys.exit(0)
+for line in iter(sys.stdin.readline, ''):
+    code = re.search(r"eval\('((?:[^']|'')*)'\)", line)
+    if code:
+        code = code.group(1).replace("''", "'")
+        if 'crash' in code:
+            sys.exit(1)
+        print 'pid %d ran: %s' % (os.getpid(), code)
+        if 'error(' in code:
+            sys.stderr.write('MATLAB code threw an exception:\nfailed\n')
+    for token in re.findall(r"fprintf\(1,'\\n(nipype_\w+)\\n'\)", line):
+        sys.stdout.write('\n%s\n' % token)
+        sys.stderr.write('\n%s\n' % token)
+    sys.stdout.flush()
+    sys.stderr.flush()
+"""
+
+
+def test_run_in_session():
+    from nipype import config
+    from nipype.utils import matlabpool
+    cwd = os.getcwd()
+    basedir = mkdtemp()
+    os.chdir(basedir)
+    standin = os.path.join(basedir, 'standin.py')
+    open(standin, 'wt').write(STANDIN)
+    matlab_cmd = '%s %s' % (sys.executable, standin)
+    old_value = config.get('execution', 'matlab_sessions')
+    config.set('execution', 'matlab_sessions', 'true')
+    try:
+        res = mlab.MatlabCommand(matlab_cmd=matlab_cmd, script='a=1;',
+                                 mfile=True).run()
+        pid, code = res.runtime.stdout.split(' ran: ')
+        yield assert_equal, code, "run('%s')" % os.path.join(basedir,
+                                                             'pyscript.m')
+        yield assert_true, os.path.exists(os.path.join(basedir,
+                                                       'pyscript.m'))
+        # the next job runs in the same session
+        res = mlab.MatlabCommand(matlab_cmd=matlab_cmd, script='b=1;',
+                                 mfile=False).run()
+        yield assert_true, res.runtime.stdout.startswith(pid + ' ran: ')
+        yield assert_true, 'b=1;' in res.runtime.stdout
+        mc = mlab.MatlabCommand(matlab_cmd=matlab_cmd, mfile=False,
+                                script="error('failed');")
+        yield assert_raises, RuntimeError, mc.run
+        # falls back to starting matlab when the session fails
+        res = mlab.MatlabCommand(matlab_cmd=matlab_cmd, script='crash',
+                                 mfile=False).run()
+        yield assert_equal, res.runtime.stdout, 'one-shot'
+    finally:
+        config.set('execution', 'matlab_sessions', old_value)
+        matlabpool.get_session_pool().close()
+        os.chdir(cwd)
+        rmtree(basedir)
+
+
+def test_failure_output_none():
+    # failures are detected from stderr, which is kept when the command
+    # output is not captured
+    from nipype import config
+    cwd = os.getcwd()
+    basedir = mkdtemp()
+    os.chdir(basedir)
+    failing = os.path.join(basedir, 'failing.py')
+    open(failing, 'wt').write("import sys\nprint 'output'\n"
+                              "sys.stderr.write('MATLAB code threw an "
+                              "exception:\\nfailed\\n')\n")
+    matlab_cmd = '%s %s' % (sys.executable, failing)
+    old_value = config.get('execution', 'command_output')
+    config.set('execution', 'command_output', 'none')
+    try:
+        mc = mlab.MatlabCommand(matlab_cmd=matlab_cmd, script='a=1;',
+                                mfile=False)
+        yield assert_raises, RuntimeError, mc.run
+    finally:
+        config.set('execution', 'command_output', old_value)
+        os.chdir(cwd)
+        rmtree(basedir)
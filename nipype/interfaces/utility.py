@@ -3,14 +3,12 @@
 import os
 import re
 import numpy as np
-import nibabel as nb
 
 from nipype.utils.filemanip import (filename_to_list, copyfile, split_filename)
 from nipype.interfaces.base import (traits, TraitedSpec, DynamicTraitedSpec, File,
                                     Undefined, isdefined, OutputMultiPath,
     InputMultiPath, BaseInterface, BaseInterfaceInputSpec)
 from nipype.interfaces.io import IOBase, add_traits
-from nipype.testing import assert_equal
 from nipype.utils.misc import getsource, create_function_from_source, dumps
 
 
@@ -422,6 +420,9 @@ class AssertEqual(BaseInterface):
     input_spec = AssertEqualInputSpec
 
     def _run_interface(self, runtime):
+        # imported here to keep nibabel and nose out of the import of nipype
+        import nibabel as nb
+        from nipype.testing import assert_equal
 
         data1 = nb.load(self.inputs.volume1).get_data()
         data2 = nb.load(self.inputs.volume2).get_data()
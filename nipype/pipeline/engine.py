@@ -43,13 +43,20 @@ from ..utils.filemanip import (save_json, FileNotFoundError,
                                copyfiles, fnames_presuffix, loadpkl,
                                split_filename, load_json, savepkl,
                                write_rst_header, write_rst_dict,
-                               write_rst_list)
+                               write_rst_list, get_hash_object)
 
 from .utils import (generate_expanded_graph, modify_paths,
                     export_graph, make_output_dir,
                     clean_working_directory, format_dot,
                     get_print_name, merge_dict,
-                    evaluate_connect_function)
+                    evaluate_connect_function, save_outputs_file,
+                    load_outputs_file, load_outputs, outputs_file,
+                    LazyResult, cache_outputs, get_duration)
+
+# key and version of the hash settings stored in the hash files of nodes
+HASHFILE_INFO_KEY = '__nipype_hashfile__'
+HASHFILE_VERSION = 1
+
 
 class WorkflowBase(object):
     """ Define common attributes and functions for workflows and nodes
@@ -487,16 +494,15 @@ connected.
         if type(plugin) is not str:
             runner = plugin
         else:
-            name = 'nipype.pipeline.plugins'
+            # only the module of the requested plugin is imported
+            from .plugins import get_plugin
             try:
-                __import__(name)
-            except ImportError:
-                msg = 'Could not import plugin module: %s' % name
+                plugin_mod = get_plugin(plugin)
+            except ImportError, e:
+                msg = 'Could not import plugin %s: %s' % (plugin, e)
                 logger.error(msg)
                 raise ImportError(msg)
-            else:
-                plugin_mod = getattr(sys.modules[name], '%sPlugin' % plugin)
-                runner = plugin_mod(plugin_args=plugin_args)
+            runner = plugin_mod(plugin_args=plugin_args)
         flatgraph = self._create_flat_graph()
         if 'crashdump_dir' in self.config:
             warn(("Deprecated: workflow.config['crashdump_dir']\n"
@@ -928,7 +934,8 @@ class Node(WorkflowBase):
     """
 
     def __init__(self, interface, iterables=None, overwrite=None,
-                 needed_outputs=None, run_without_submitting=False, **kwargs):
+                 needed_outputs=None, run_without_submitting=False,
+                 num_threads=1, estimated_memory_gb=0.25, **kwargs):
         """
         Parameters
         ----------
@@ -958,6 +965,14 @@ class Node(WorkflowBase):
         run_without_submitting : boolean
             Run the node without submitting to a job engine or to a
             multiprocessing pool
+
+        num_threads : int
+            Number of threads the underlying interface uses. The MultiProc
+            plugin reserves this many processors for the node.
+
+        estimated_memory_gb : float
+            Estimate of the peak memory (in GB) used by the node. The
+            MultiProc plugin reserves this much memory for the node.
         """
         super(Node, self).__init__(**kwargs)
         if interface is None:
@@ -970,6 +985,8 @@ class Node(WorkflowBase):
         self.overwrite = overwrite
         self.parameterization = None
         self.run_without_submitting = run_without_submitting
+        self.num_threads = num_threads
+        self.estimated_memory_gb = estimated_memory_gb
         self.input_source = {}
         self.needed_outputs = []
         self.plugin_args = {}
@@ -1038,6 +1055,9 @@ class Node(WorkflowBase):
         hashed_inputs, hashvalue = self._get_hashval()
         outdir = self.output_dir()
         hashfile = os.path.join(outdir, '_0x%s.json' % hashvalue)
+        if not updatehash and not os.path.exists(hashfile) and \
+                os.path.exists(outdir):
+            self._upgrade_hashfile(hashfile, hashed_inputs)
         if updatehash and os.path.exists(outdir):
             logger.debug("Updating hash: %s" % hashvalue)
             for file in glob(os.path.join(outdir, '_0x*.json')):
@@ -1094,6 +1114,7 @@ class Node(WorkflowBase):
                             logger.debug("Previous node hash = %s" % exp_hash)
                             try:
                                 prev_inputs = load_json(exp_hash_paths[0])
+                                prev_inputs.pop(HASHFILE_INFO_KEY, None)
                             except:
                                 pass
                             else:
@@ -1121,7 +1142,8 @@ class Node(WorkflowBase):
             outdir = make_output_dir(outdir)
             self._save_hashfile(hashfile_unfinished, hashed_inputs)
             self.write_report(report_type='preexec', cwd=outdir)
-            savepkl(os.path.join(outdir, '_node.pklz'), self)
+            if str2bool(self.config['execution']['create_node_file']):
+                savepkl(os.path.join(outdir, '_node.pklz'), self)
             savepkl(os.path.join(outdir, '_inputs.pklz'),
                     self.inputs.get_traitsfree())
             try:
@@ -1136,7 +1158,8 @@ class Node(WorkflowBase):
                 logger.debug('%s: creating inputs file' % self.name)
                 savepkl(os.path.join(outdir, '_inputs.pklz'),
                         self.inputs.get_traitsfree())
-            if not os.path.exists(os.path.join(outdir, '_node.pklz')):
+            if str2bool(self.config['execution']['create_node_file']) and \
+                    not os.path.exists(os.path.join(outdir, '_node.pklz')):
                 logger.debug('%s: creating node file' % self.name)
                 savepkl(os.path.join(outdir, '_node.pklz'), self)
             logger.debug("Hashfile exists. Skipping execution")
@@ -1145,16 +1168,25 @@ class Node(WorkflowBase):
         return self._result
 
     # Private functions
-    def _get_hashval(self):
+    def _hash_settings(self):
+        """Return the hash method and algorithm configured for this node"""
+        return (self.config['execution']['hash_method'].lower(),
+                self.config['execution'].get('hash_algorithm', 'md5').lower())
+
+    def _get_hashval(self, hash_method=None, hash_algorithm=None):
         """Return a hash of the input state"""
         if not self._got_inputs:
             self._get_inputs()
             self._got_inputs = True
+        if hash_method is None:
+            hash_method, _ = self._hash_settings()
+        if hash_algorithm is None:
+            _, hash_algorithm = self._hash_settings()
         hashed_inputs, hashvalue = self.inputs.get_hashval(
-            hash_method=self.config['execution']['hash_method'])
+            hash_method=hash_method, hash_algorithm=hash_algorithm)
         if str2bool(self.config['execution']['remove_unnecessary_outputs']) \
             and self.needed_outputs:
-            hashobject = md5()
+            hashobject = get_hash_object(hash_algorithm)
             hashobject.update(hashvalue)
             sorted_outputs = sorted(self.needed_outputs)
             hashobject.update(str(sorted_outputs))
@@ -1162,7 +1194,46 @@ class Node(WorkflowBase):
             hashed_inputs['needed_outputs'] = sorted_outputs
         return hashed_inputs, hashvalue
 
+    def _upgrade_hashfile(self, hashfile, hashed_inputs):
+        """Reuse a hash file written with different hash settings
+
+        When the node has finished with a different hash method or
+        algorithm (hash files without format information were written with
+        md5), the hash is recomputed with the settings recorded in that file.
+        If the inputs did not change, the hash file is rewritten with the
+        current settings instead of rerunning the node.
+        """
+        outdir = os.path.dirname(hashfile)
+        oldfiles = [f for f in glob(os.path.join(outdir, '_0x*.json'))
+                    if not f.endswith('_unfinished.json')]
+        if len(oldfiles) != 1:
+            return False
+        try:
+            oldinfo = load_json(oldfiles[0]).get(HASHFILE_INFO_KEY, {})
+        except Exception:
+            return False
+        settings = self._hash_settings()
+        oldsettings = (oldinfo.get('hash_method', settings[0]),
+                       oldinfo.get('hash_algorithm', 'md5'))
+        if oldsettings == settings:
+            return False
+        logger.info(('Node %s was hashed with %s (%s) and is now hashed with '
+                     '%s (%s): checking inputs with the previous settings') %
+                    ((self._id,) + oldsettings + settings))
+        _, oldhash = self._get_hashval(*oldsettings)
+        if os.path.basename(oldfiles[0]) != '_0x%s.json' % oldhash:
+            logger.info('Inputs of node %s changed' % self._id)
+            return False
+        os.remove(oldfiles[0])
+        self._save_hashfile(hashfile, hashed_inputs)
+        return True
+
     def _save_hashfile(self, hashfile, hashed_inputs):
+        hash_method, hash_algorithm = self._hash_settings()
+        hashed_inputs = dict(hashed_inputs)
+        hashed_inputs[HASHFILE_INFO_KEY] = dict(version=HASHFILE_VERSION,
+                                                hash_method=hash_method,
+                                                hash_algorithm=hash_algorithm)
         try:
             save_json(hashfile, hashed_inputs)
         except (IOError, TypeError):
@@ -1187,25 +1258,27 @@ class Node(WorkflowBase):
         other data sources (e.g., XNAT, HTTP, etc.,.)
         """
         logger.debug('Setting node inputs')
+        # only the outputs of upstream nodes are needed, read each file once
+        loaded = {}
         for key, info in self.input_source.items():
             logger.debug('input: %s' % key)
             results_file = info[0]
             logger.debug('results file: %s' % results_file)
-            results = loadpkl(results_file)
+            if results_file not in loaded:
+                loaded[results_file] = load_outputs(results_file)
+            outputs = loaded[results_file]
             output_value = Undefined
             if isinstance(info[1], tuple):
                 output_name = info[1][0]
-                value = getattr(results.outputs, output_name)
+                value = outputs[output_name]
                 if isdefined(value):
+                    # outputs may be shared with other nodes of the process
                     output_value = evaluate_connect_function(info[1][1],
                                                              info[1][2],
-                                                             value)
+                                                             deepcopy(value))
             else:
                 output_name = info[1]
-                try:
-                    output_value = results.outputs.get()[output_name]
-                except TypeError:
-                    output_value = results.outputs.dictcopy()[output_name]
+                output_value = outputs[output_name]
             logger.debug('output: %s' % output_name)
             try:
                 self.set_input(key, deepcopy(output_value))
@@ -1228,16 +1301,30 @@ class Node(WorkflowBase):
 
     def _save_results(self, result, cwd):
         resultsfile = os.path.join(cwd, 'result_%s.pklz' % self.name)
+        stored_outputs = None
         if result.outputs:
             try:
                 outputs = result.outputs.get()
             except TypeError:
                 outputs = result.outputs.dictcopy()  # outputs was a bunch
-            result.outputs.set(**modify_paths(outputs, relative=True,
-                                              basedir=cwd))
+            relative_outputs = modify_paths(outputs, relative=True,
+                                            basedir=cwd)
+            result.outputs.set(**relative_outputs)
+            stored_outputs = dict([(key, relative_outputs.get(key, Undefined))
+                                   for key in outputs])
 
         savepkl(resultsfile, result)
         logger.debug('saved results in %s' % resultsfile)
+        bunch = isinstance(result.outputs, Bunch)
+        if str2bool(self.config['execution']['create_outputs_file']) and \
+                (result.outputs is None or stored_outputs is not None):
+            save_outputs_file(resultsfile, stored_outputs, result.runtime,
+                              bunch=bunch)
+        elif os.path.exists(outputs_file(resultsfile)):
+            os.remove(outputs_file(resultsfile))
+        if result.outputs is None or stored_outputs is not None:
+            cache_outputs(resultsfile, stored_outputs,
+                          duration=get_duration(result.runtime), bunch=bunch)
 
         if result.outputs:
             result.outputs.set(**outputs)
@@ -1264,6 +1351,8 @@ class Node(WorkflowBase):
         result = None
         attribute_error = False
         if os.path.exists(resultsoutputfile):
+            result, aggregate = self._load_outputs_file(resultsoutputfile, cwd)
+        if result is None and os.path.exists(resultsoutputfile):
             pkl_file = gzip.open(resultsoutputfile, 'rb')
             try:
                 result = cPickle.load(pkl_file)
@@ -1294,6 +1383,40 @@ class Node(WorkflowBase):
         logger.debug('Aggregate: %s', aggregate)
         return result, aggregate, attribute_error
 
+    def _load_outputs_file(self, resultsfile, cwd):
+        """Load results from the json outputs file of the node
+
+        The runtime and inputs of the result are only read from the results
+        file when they are accessed. Returns (None, True) if the outputs could
+        not be restored from the json file.
+        """
+        stored = load_outputs_file(resultsfile)
+        if stored is None:
+            return None, True
+        outputs, bunch = stored[0], stored[2]
+        aggregate = True
+        if outputs is None:
+            return LazyResult(resultsfile, None), aggregate
+        if bunch:
+            result_outputs = Bunch(**outputs)
+        else:
+            result_outputs = self._interface._outputs()
+            if result_outputs is None:
+                return None, True
+        try:
+            result_outputs.set(**modify_paths(outputs, relative=False,
+                                              basedir=cwd))
+        except FileNotFoundError:
+            logger.debug(('conversion to full path results in '
+                          'non existent file'))
+        except (traits.TraitError, AttributeError), err:
+            logger.debug('could not restore outputs from %s: %s' %
+                         (outputs_file(resultsfile), str(err)))
+            return None, True
+        else:
+            aggregate = False
+        return LazyResult(resultsfile, result_outputs), aggregate
+
     def _load_results(self, cwd):
         result, aggregate, attribute_error = self._load_resultfile(cwd)
         # try aggregating first
@@ -1550,7 +1673,7 @@ class MapNode(Node):
         else:
             setattr(self._interface.inputs, name, newvalue)
 
-    def _get_hashval(self):
+    def _get_hashval(self, hash_method=None, hash_algorithm=None):
         """ Compute hash including iterfield lists
         """
         if not self._got_inputs:
@@ -1565,10 +1688,15 @@ class MapNode(Node):
             logger.debug('setting hashinput %s-> %s' %
                          (name, getattr(self._inputs, name)))
             setattr(hashinputs, name, getattr(self._inputs, name))
-        hashed_inputs, hashvalue = hashinputs.get_hashval(hash_method=self.config['execution']['hash_method'])
+        if hash_method is None:
+            hash_method, _ = self._hash_settings()
+        if hash_algorithm is None:
+            _, hash_algorithm = self._hash_settings()
+        hashed_inputs, hashvalue = hashinputs.get_hashval(
+            hash_method=hash_method, hash_algorithm=hash_algorithm)
         if str2bool(self.config['execution']['remove_unnecessary_outputs']) and \
         self.needed_outputs:
-            hashobject = md5()
+            hashobject = get_hash_object(hash_algorithm)
             hashobject.update(hashvalue)
             sorted_outputs = sorted(self.needed_outputs)
             hashobject.update(str(sorted_outputs))
@@ -1596,6 +1724,9 @@ class MapNode(Node):
             node = Node(deepcopy(self._interface), name=nodename)
             node.overwrite = self.overwrite
             node.run_without_submitting = self.run_without_submitting
+            node.num_threads = self.num_threads
+            node.estimated_memory_gb = self.estimated_memory_gb
+            node.plugin_args = deepcopy(self.plugin_args)
             node._interface.inputs.set(**deepcopy(self._interface.inputs.get()))
             for field in self.iterfield:
                 fieldvals = filename_to_list(getattr(self.inputs, field))
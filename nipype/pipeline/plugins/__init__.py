@@ -1,15 +1,67 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Execution plugins
 
-from .debug import DebugPlugin
-from .linear import LinearPlugin
-from .ipythonx import IPythonXPlugin
-from .pbs import PBSPlugin
-from .sge import SGEPlugin
-from .condor import CondorPlugin
-from .dagman import CondorDAGManPlugin
-from .multiproc import MultiProcPlugin
-from .ipython import IPythonPlugin
-from .somaflow import SomaFlowPlugin
-from .pbsgraph import PBSGraphPlugin
-from .sgegraph import SGEGraphPlugin
+Plugin modules are only imported when their plugin is requested, either with
+`get_plugin` or as an attribute of this package (e.g.,
+``from nipype.pipeline.plugins import MultiProcPlugin``).
+"""
+
+import sys
+from types import ModuleType
+
+# module defining each plugin
+PLUGIN_MODULES = {'DebugPlugin': 'debug',
+                  'LinearPlugin': 'linear',
+                  'IPythonXPlugin': 'ipythonx',
+                  'PBSPlugin': 'pbs',
+                  'SGEPlugin': 'sge',
+                  'CondorPlugin': 'condor',
+                  'CondorDAGManPlugin': 'dagman',
+                  'MultiProcPlugin': 'multiproc',
+                  'WorkerPoolPlugin': 'workerpool',
+                  'IPythonPlugin': 'ipython',
+                  'SomaFlowPlugin': 'somaflow',
+                  'PBSGraphPlugin': 'pbsgraph',
+                  'SGEGraphPlugin': 'sgegraph'}
+
+__all__ = sorted(PLUGIN_MODULES) + ['get_plugin']
+
+
+def get_plugin(name):
+    """Return a plugin class given its name, importing its module
+
+    Parameters
+    ----------
+    name : str
+        name of the plugin, with or without the Plugin suffix (e.g.,
+        'MultiProc' or 'MultiProcPlugin')
+    """
+    if not name.endswith('Plugin'):
+        name += 'Plugin'
+    if name not in PLUGIN_MODULES:
+        raise ValueError('Unknown plugin: %s. Available plugins: %s' %
+                         (name[:-len('Plugin')],
+                          ', '.join(sorted([plugin[:-len('Plugin')]
+                                            for plugin in PLUGIN_MODULES]))))
+    module = '%s.%s' % (__name__, PLUGIN_MODULES[name])
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+class _PluginsModule(ModuleType):
+    """Package module importing plugins on first access"""
+
+    def __getattr__(self, name):
+        if name in PLUGIN_MODULES:
+            plugin = get_plugin(name)
+            setattr(self, name, plugin)
+            return plugin
+        raise AttributeError("'module' object has no attribute '%s'" % name)
+
+
+_module = _PluginsModule(__name__, __doc__)
+_module.__dict__.update(globals())
+# keep the original module alive, its functions use its globals
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
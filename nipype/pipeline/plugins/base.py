@@ -5,19 +5,20 @@
 
 from copy import deepcopy
 from glob import glob
+import heapq
 import os
 import pwd
 import shutil
 from socket import gethostname
 import sys
+import threading
 from time import strftime, sleep, time
 from traceback import format_exception, format_exc
 from warnings import warn
 
 import numpy as np
-import scipy.sparse as ssp
 
-from ..utils import (nx, dfs_preorder)
+from ..utils import (nx, dfs_preorder, load_outputs_file)
 from ..engine import (MapNode, str2bool)
 
 from nipype.utils.filemanip import savepkl, loadpkl
@@ -28,6 +29,9 @@ from ... import logging
 logger = logging.getLogger('workflow')
 iflogger = logging.getLogger('interface')
 
+SCHEDULING_POLICIES = ['fifo', 'priority', 'critical_path', 'depth_first',
+                       'breadth_first']
+
 
 def report_crash(node, traceback=None, hostname=None):
     """Writes crash related information to a file
@@ -90,8 +94,12 @@ def report_nodes_not_run(notrun):
                             'Check log for details'))
 
 
-def create_pyscript(node, updatehash=False, store_exception=True):
-    # pickle node
+def _pickle_node(node, updatehash=False):
+    """Pickle a node in its batch directory
+
+    Returns the pickle file, the batch directory and the suffix of the files
+    of the node.
+    """
     timestamp = strftime('%Y%m%d_%H%M%S')
     if node._hierarchy:
         suffix = '%s_%s_%s' % (timestamp, node._hierarchy, node._id)
@@ -105,6 +113,12 @@ def create_pyscript(node, updatehash=False, store_exception=True):
         os.makedirs(batch_dir)
     pkl_file = os.path.join(batch_dir, 'node_%s.pklz' % suffix)
     savepkl(pkl_file, dict(node=node, updatehash=updatehash))
+    return pkl_file, batch_dir, suffix
+
+
+def create_pyscript(node, updatehash=False, store_exception=True):
+    # pickle node
+    pkl_file, batch_dir, suffix = _pickle_node(node, updatehash=updatehash)
     # create python script to load and trap exception
     cmdstr = """import os
 import sys
@@ -116,8 +130,10 @@ batchdir = '%s'
 try:
     from nipype import config, logging
     import sys
-    if not sys.version_info < (2, 7):
+    if sys.version_info < (2, 7):
         from ordereddict import OrderedDict
+    else:
+        from collections import OrderedDict
     config_dict=%s
     config.update_config(config_dict)
     config.update_matplotlib()
@@ -161,6 +177,59 @@ except Exception, e:
     return pyscript
 
 
+def create_bundle_pyscript(nodes, updatehash=False):
+    """Create a python script running several nodes one after the other
+
+    Each node is pickled and run as by the script of `create_pyscript`, and
+    the results or the exception of each node are stored in its own results
+    file. A failing node does not prevent the next nodes from running.
+    """
+    tasks = []
+    for node in nodes:
+        pkl_file, batch_dir, suffix = _pickle_node(node, updatehash=updatehash)
+        tasks.append((pkl_file, suffix, node.config))
+    cmdstr = """import os
+import sys
+from socket import gethostname
+from traceback import format_exception
+if sys.version_info < (2, 7):
+    from ordereddict import OrderedDict
+else:
+    from collections import OrderedDict
+batchdir = '%s'
+tasks = %s
+for pklfile, suffix, config_dict in tasks:
+    info = None
+    try:
+        from nipype import config, logging
+        config.update_config(config_dict)
+        config.update_matplotlib()
+        logging.update_logging(config)
+        from nipype.utils.filemanip import loadpkl, savepkl
+        traceback=None
+        info = loadpkl(pklfile)
+        result = info['node'].run(updatehash=info['updatehash'])
+    except Exception, e:
+        etype, eval, etr = sys.exc_info()
+        traceback = format_exception(etype,eval,etr)
+        if info is None:
+            result = None
+            resultsfile = os.path.join(batchdir, 'crashdump_%%s.pklz' %% suffix)
+        else:
+            result = info['node'].result
+            resultsfile = os.path.join(info['node'].output_dir(),
+                                       'result_%%s.pklz'%%info['node'].name)
+        savepkl(resultsfile, dict(result=result, hostname=gethostname(),
+                                  traceback=traceback))
+"""
+    cmdstr = cmdstr % (batch_dir, repr(tasks))
+    pyscript = os.path.join(batch_dir, 'pyscript_bundle_%s.py' % tasks[0][1])
+    fp = open(pyscript, 'wt')
+    fp.writelines(cmdstr)
+    fp.close()
+    return pyscript
+
+
 class PluginBase(object):
     """Base class for plugins"""
 
@@ -189,20 +258,53 @@ class DistributedPluginBase(PluginBase):
             process is currently running. Note: A process is finished only when
             both proc_done==True and
         proc_pending==False
-        depidx: a boolean matrix (NxN) storing the dependency structure accross
-            processes. Process dependencies are derived from each column.
+        proc_index: a dictionary mapping each process to its index in procs
+        children: a list (N) with the indices of the processes depending on
+            each process
+        num_deps: a list (N) with the number of unfinished dependencies of
+            each process. A process whose count drops to zero is appended to
+            the ready queue.
+        refcount: a vector storing for each process of the original graph the
+            number of dependent processes that still need its outputs
         """
         super(DistributedPluginBase, self).__init__(plugin_args=plugin_args)
         self.procs = None
-        self.depidx = None
-        self.refidx = None
+        self.proc_index = None
+        self.children = None
+        self.parents = None
+        self.num_deps = None
+        self.refcount = None
         self.mapnodes = None
         self.mapnodesubids = None
         self.proc_done = None
         self.proc_pending = None
         self.max_jobs = np.inf
-        if plugin_args and 'max_jobs' in plugin_args:
-            self.max_jobs = plugin_args['max_jobs']
+        self._poll_sleep_secs = 2.
+        self._min_poll_sleep_secs = 0.05
+        self._scheduling_policy = 'fifo'
+        if plugin_args:
+            if 'max_jobs' in plugin_args:
+                self.max_jobs = plugin_args['max_jobs']
+            if 'poll_sleep_duration' in plugin_args:
+                self._poll_sleep_secs = float(
+                    plugin_args['poll_sleep_duration'])
+            if 'min_poll_sleep_duration' in plugin_args:
+                self._min_poll_sleep_secs = float(
+                    plugin_args['min_poll_sleep_duration'])
+            if 'scheduling_policy' in plugin_args:
+                self._scheduling_policy = plugin_args['scheduling_policy']
+        self._min_poll_sleep_secs = min(self._min_poll_sleep_secs,
+                                        self._poll_sleep_secs)
+        if not (callable(self._scheduling_policy) or
+                self._scheduling_policy in SCHEDULING_POLICIES):
+            raise ValueError(('Unknown scheduling policy: %s. Use a callable '
+                              'or one of: %s') %
+                             (self._scheduling_policy,
+                              ', '.join(SCHEDULING_POLICIES)))
+        # plugins whose workers report completion through a callback set
+        # _event_driven and call _notify_task_done to wake up the scheduler
+        self._event_driven = False
+        self._wakeup = threading.Event()
 
     def run(self, graph, config, updatehash=False):
         """Executes a pre-defined pipeline using distributed approaches
@@ -212,13 +314,13 @@ class DistributedPluginBase(PluginBase):
         # Generate appropriate structures for worker-manager model
         self._generate_dependency_list(graph)
         self.pending_tasks = []
-        self.readytorun = []
-        self.mapnodes = []
-        self.mapnodesubids = {}
-        # setup polling - TODO: change to threaded model
         notrun = []
-        while np.any(self.proc_done == False) | \
-              np.any(self.proc_pending == True):
+        sleep_secs = self._min_poll_sleep_secs
+        while self._has_unfinished_jobs():
+            # clear before collecting so that a completion reported while
+            # this pass runs makes the next wait return immediately
+            self._wakeup.clear()
+            progress = False
             toappend = []
             # trigger callbacks for any pending results
             while self.pending_tasks:
@@ -226,6 +328,7 @@ class DistributedPluginBase(PluginBase):
                 try:
                     result = self._get_result(taskid)
                     if result:
+                        progress = True
                         if result['traceback']:
                             notrun.append(self._clean_queue(jobid, graph,
                                                             result=result))
@@ -236,6 +339,7 @@ class DistributedPluginBase(PluginBase):
                     else:
                         toappend.insert(0, (taskid, jobid))
                 except Exception:
+                    progress = True
                     result = {'result': None,
                               'traceback': format_exc()}
                     notrun.append(self._clean_queue(jobid, graph,
@@ -250,10 +354,43 @@ class DistributedPluginBase(PluginBase):
                     slots = self.max_jobs - num_jobs
                 self._send_procs_to_workers(updatehash=updatehash,
                                             slots=slots, graph=graph)
-            sleep(2)
+            if len(self.pending_tasks) != num_jobs:
+                progress = True
+            if self._has_unfinished_jobs():
+                sleep_secs = self._wait_for_tasks(sleep_secs, progress)
         self._remove_node_dirs()
         report_nodes_not_run(notrun)
 
+    def _has_unfinished_jobs(self):
+        return np.any(self.proc_done == False) | \
+            np.any(self.proc_pending == True)
+
+    def _notify_task_done(self, *args):
+        """Wake up the scheduler loop
+
+        Can be passed directly as a completion callback to the underlying
+        execution engine.
+        """
+        self._wakeup.set()
+
+    def _wait_for_tasks(self, sleep_secs, progress):
+        """Block until a task completes or the poll interval elapses
+
+        Event driven plugins are woken up by `_notify_task_done` and only use
+        `poll_sleep_duration` as a safety timeout. Polling plugins restart at
+        `min_poll_sleep_duration` whenever the last pass made progress and
+        double the interval, up to `poll_sleep_duration`, while idle.
+
+        Returns the interval to use for the next pass.
+        """
+        if self._event_driven:
+            self._wakeup.wait(self._poll_sleep_secs)
+            return sleep_secs
+        if progress:
+            sleep_secs = self._min_poll_sleep_secs
+        self._wakeup.wait(sleep_secs)
+        return min(2 * sleep_secs, self._poll_sleep_secs)
+
     def _get_result(self, taskid):
         raise NotImplementedError
 
@@ -287,98 +424,142 @@ class DistributedPluginBase(PluginBase):
     def _submit_mapnode(self, jobid):
         if jobid in self.mapnodes:
             return True
-        self.mapnodes.append(jobid)
+        self.mapnodes.add(jobid)
         mapnodesubids = self.procs[jobid].get_subnodes()
         numnodes = len(mapnodesubids)
         logger.info('Adding %d jobs for mapnode %s' % (numnodes,
                                                        self.procs[jobid]._id))
-        for i in range(numnodes):
-            self.mapnodesubids[self.depidx.shape[0] + i] = jobid
+        firstid = len(self.procs)
         self.procs.extend(mapnodesubids)
-        self.depidx = ssp.vstack((self.depidx,
-                                  ssp.lil_matrix(np.zeros((numnodes,
-                                                    self.depidx.shape[1])))),
-                                 'lil')
-        self.depidx = ssp.hstack((self.depidx,
-                                  ssp.lil_matrix(np.zeros((self.depidx.shape[0],
-                                                           numnodes)))),
-                                 'lil')
-        self.depidx[-numnodes:, jobid] = 1
-        self.proc_done = np.concatenate((self.proc_done,
-                                         np.zeros(numnodes, dtype=bool)))
-        self.proc_pending = np.concatenate((self.proc_pending,
-                                            np.zeros(numnodes, dtype=bool)))
+        self._extend_proc_status(numnodes)
+        for i, subnode in enumerate(mapnodesubids):
+            subid = firstid + i
+            self.mapnodesubids[subid] = jobid
+            self.proc_index[subnode] = subid
+            # the mapnode collates its subnodes, so it depends on all of them
+            self.children.append([jobid])
+            self.num_deps.append(0)
+            self._push_ready(subid)
+        self.num_deps[jobid] += numnodes
         return False
 
+    def _extend_proc_status(self, numnodes):
+        """Grow proc_done and proc_pending by numnodes entries
+
+        Both vectors are views on buffers whose capacity is doubled when
+        exhausted, so that adding subnodes is amortized constant time.
+        """
+        size = len(self.proc_done)
+        if size + numnodes > len(self._proc_done_buf):
+            capacity = max(2 * len(self._proc_done_buf), size + numnodes)
+            for name in ['_proc_done_buf', '_proc_pending_buf']:
+                buf = np.zeros(capacity, dtype=bool)
+                buf[:size] = getattr(self, name)[:size]
+                setattr(self, name, buf)
+        self.proc_done = self._proc_done_buf[:size + numnodes]
+        self.proc_pending = self._proc_pending_buf[:size + numnodes]
+
     def _send_procs_to_workers(self, updatehash=False, slots=None, graph=None):
-        """ Sends jobs to workers using ipython's taskclient interface
+        """ Sends jobs from the ready queue to workers
+
+        At most `slots` jobs are handed to the execution engine. Jobs that
+        are run on the master thread or found in the cache do not use a
+        slot.
         """
-        while np.any(self.proc_done == False):
-            # Check to see if a job is available
-            jobids = np.flatnonzero((self.proc_done == False) & \
-                                    (self.depidx.sum(axis=0) == 0).__array__())
-            if len(jobids) > 0:
-                # send all available jobs
-                logger.info('Submitting %d jobs' % len(jobids))
-                for jobid in jobids[:slots]:
-                    if isinstance(self.procs[jobid], MapNode):
-                        try:
-                            num_subnodes = self.procs[jobid].num_subnodes()
-                        except Exception:
-                            self._clean_queue(jobid, graph)
-                            self.proc_pending[jobid] = False
-                            continue
-                        if num_subnodes > 1:
-                            submit = self._submit_mapnode(jobid)
-                            if not submit:
-                                continue
-                    # change job status in appropriate queues
-                    self.proc_done[jobid] = True
-                    self.proc_pending[jobid] = True
-                    # Send job to task manager and add to pending tasks
-                    logger.info('Executing: %s ID: %d' % \
-                                    (self.procs[jobid]._id, jobid))
-                    if self._status_callback:
-                        self._status_callback(self.procs[jobid], 'start')
-                    continue_with_submission = True
-                    if str2bool(self.procs[jobid].config['execution']['local_hash_check']):
-                        logger.debug('checking hash locally')
-                        try:
-                            hash_exists, _, _, _ = self.procs[jobid].hash_exists()
-                            logger.debug('Hash exists %s' % str(hash_exists))
-                            if (hash_exists and
-                            (self.procs[jobid].overwrite == False or
-                             (self.procs[jobid].overwrite == None and
-                              not self.procs[jobid]._interface.always_run))):
-                                continue_with_submission = False
-                                self._task_finished_cb(jobid)
-                                self._remove_node_dirs()
-                        except Exception:
-                            self._clean_queue(jobid, graph)
-                            self.proc_pending[jobid] = False
-                            continue_with_submission = False
-                    logger.debug('Finished checking hash %s' %
-                                 str(continue_with_submission))
-                    if continue_with_submission:
-                        if self.procs[jobid].run_without_submitting:
-                            logger.debug('Running node %s on master thread' %
-                                         self.procs[jobid])
-                            try:
-                                self.procs[jobid].run()
-                            except Exception:
-                                self._clean_queue(jobid, graph)
-                            self._task_finished_cb(jobid)
-                            self._remove_node_dirs()
-                        else:
-                            tid = self._submit_job(deepcopy(self.procs[jobid]),
-                                                   updatehash=updatehash)
-                            if tid is None:
-                                self.proc_done[jobid] = False
-                                self.proc_pending[jobid] = False
-                            else:
-                                self.pending_tasks.insert(0, (tid, jobid))
-            else:
-                break
+        deferred = []
+        while self._ready and (slots is None or slots > 0):
+            jobid = self._pop_ready()
+            if self.proc_done[jobid]:
+                # a dependency crashed after this job became ready
+                continue
+            if isinstance(self.procs[jobid], MapNode):
+                try:
+                    num_subnodes = self.procs[jobid].num_subnodes()
+                except Exception:
+                    self._clean_queue(jobid, graph)
+                    self.proc_pending[jobid] = False
+                    continue
+                if num_subnodes > 1:
+                    submit = self._submit_mapnode(jobid)
+                    if not submit:
+                        continue
+            if not (self.procs[jobid].run_without_submitting or
+                    self._can_submit(jobid)):
+                # look for smaller jobs that fit the available resources
+                deferred.append(jobid)
+                continue
+            # change job status in appropriate queues
+            self.proc_done[jobid] = True
+            self.proc_pending[jobid] = True
+            # Send job to task manager and add to pending tasks
+            logger.info('Executing: %s ID: %d' % \
+                            (self.procs[jobid]._id, jobid))
+            if self._status_callback:
+                self._status_callback(self.procs[jobid], 'start')
+            continue_with_submission = True
+            if str2bool(self.procs[jobid].config['execution']['local_hash_check']):
+                logger.debug('checking hash locally')
+                try:
+                    hash_exists, _, _, _ = self.procs[jobid].hash_exists()
+                    logger.debug('Hash exists %s' % str(hash_exists))
+                    if (hash_exists and
+                    (self.procs[jobid].overwrite == False or
+                     (self.procs[jobid].overwrite == None and
+                      not self.procs[jobid]._interface.always_run))):
+                        continue_with_submission = False
+                        self._task_finished_cb(jobid)
+                        self._remove_node_dirs()
+                except Exception:
+                    self._clean_queue(jobid, graph)
+                    self.proc_pending[jobid] = False
+                    continue_with_submission = False
+            logger.debug('Finished checking hash %s' %
+                         str(continue_with_submission))
+            if continue_with_submission:
+                if self.procs[jobid].run_without_submitting:
+                    logger.debug('Running node %s on master thread' %
+                                 self.procs[jobid])
+                    try:
+                        self.procs[jobid].run()
+                    except Exception:
+                        self._clean_queue(jobid, graph)
+                    self._task_finished_cb(jobid)
+                    self._remove_node_dirs()
+                else:
+                    tid = self._submit_task(jobid, updatehash=updatehash)
+                    if tid is None:
+                        self.proc_done[jobid] = False
+                        self.proc_pending[jobid] = False
+                        # retry on the next scheduler pass
+                        self._push_ready(jobid, front=True)
+                        break
+                    self.pending_tasks.insert(0, (tid, jobid))
+                    if slots is not None:
+                        slots -= 1
+        for jobid in reversed(deferred):
+            self._push_ready(jobid, front=True)
+        self._flush_submissions()
+
+    def _submit_task(self, jobid, updatehash=False):
+        """Hand a job to the execution engine and return its task id
+
+        Plugins may hold the job back and return a provisional task id, as
+        long as `_flush_submissions` replaces it in `pending_tasks`.
+        """
+        return self._submit_job(deepcopy(self.procs[jobid]),
+                                updatehash=updatehash)
+
+    def _flush_submissions(self):
+        """Submit the jobs held back during the last scheduler pass
+        """
+        pass
+
+    def _can_submit(self, jobid):
+        """Check whether a job can be handed to the workers right now
+
+        Plugins that keep track of resources override this method.
+        """
+        return True
 
     def _task_finished_cb(self, jobid):
         """ Extract outputs and assign to inputs of dependent tasks
@@ -391,29 +572,104 @@ class DistributedPluginBase(PluginBase):
             self._status_callback(self.procs[jobid], 'end')
         # Update job and worker queues
         self.proc_pending[jobid] = False
+        if jobid in self._released:
+            return
+        self._released.add(jobid)
         # update the job dependency structure
-        rowview = self.depidx.getrowview(jobid)
-        rowview[rowview.nonzero()] = 0
+        for child in self.children[jobid]:
+            self.num_deps[child] -= 1
+            if self.num_deps[child] == 0 and not self.proc_done[child]:
+                self._push_ready(child)
         if jobid not in self.mapnodesubids:
-            self.refidx[self.refidx[:, jobid].nonzero()[0], jobid] = 0
+            for parent in self.parents[jobid]:
+                self.refcount[parent] -= 1
 
     def _generate_dependency_list(self, graph):
         """ Generates a dependency list for a list of graphs.
         """
         self.procs = graph.nodes()
-        try:
-            self.depidx = nx.to_scipy_sparse_matrix(graph, format='lil')
-        except:
-            self.depidx = nx.to_scipy_sparse_matrix(graph)
-        self.refidx = deepcopy(self.depidx)
-        self.refidx.astype = np.int
-        self.proc_done = np.zeros(len(self.procs), dtype=bool)
-        self.proc_pending = np.zeros(len(self.procs), dtype=bool)
+        self.proc_index = dict((node, idx)
+                               for idx, node in enumerate(self.procs))
+        self.children = [[self.proc_index[child]
+                          for child in graph.successors(node)]
+                         for node in self.procs]
+        self.parents = [[self.proc_index[parent]
+                         for parent in graph.predecessors(node)]
+                        for node in self.procs]
+        self.num_deps = [len(parents) for parents in self.parents]
+        self.refcount = np.array([len(children) for children in self.children],
+                                 dtype=int)
+        self._proc_done_buf = np.zeros(len(self.procs), dtype=bool)
+        self._proc_pending_buf = np.zeros(len(self.procs), dtype=bool)
+        self.proc_done = self._proc_done_buf[:]
+        self.proc_pending = self._proc_pending_buf[:]
+        self._released = set()
+        self.mapnodes = set()
+        self.mapnodesubids = {}
+        self._priorities = self._get_priorities(graph)
+        self._ready = []
+        self._ready_seq = 0
+        self._front_seq = 0
+        for idx, num_deps in enumerate(self.num_deps):
+            if num_deps == 0:
+                self._push_ready(idx)
+
+    def _push_ready(self, jobid, front=False):
+        """Add a job to the ready queue
+
+        Jobs are ordered by priority. Jobs with equal priority leave the
+        queue in the order they were added, unless `front` is set.
+        """
+        if jobid in self.mapnodesubids:
+            key = self._priorities[self.mapnodesubids[jobid]]
+        else:
+            key = self._priorities[jobid]
+        if front:
+            self._front_seq -= 1
+            seq = self._front_seq
+        else:
+            self._ready_seq += 1
+            seq = self._ready_seq
+        heapq.heappush(self._ready, (-key, seq, jobid))
+
+    def _pop_ready(self):
+        return heapq.heappop(self._ready)[2]
+
+    def _get_priorities(self, graph):
+        """Compute the priority of each process under the scheduling policy
+
+        Higher values are submitted first. Subnodes of a MapNode inherit the
+        priority of their parent.
+        """
+        policy = self._scheduling_policy
+        if callable(policy):
+            return [policy(node) for node in self.procs]
+        if policy == 'fifo':
+            return [0] * len(self.procs)
+        if policy == 'priority':
+            return [node.plugin_args.get('priority', 0)
+                    for node in self.procs]
+        order = [self.proc_index[node] for node in nx.topological_sort(graph)]
+        if policy in ['depth_first', 'breadth_first']:
+            level = [0] * len(self.procs)
+            for idx in order:
+                for child in self.children[idx]:
+                    level[child] = max(level[child], level[idx] + 1)
+            if policy == 'breadth_first':
+                return [-val for val in level]
+            return level
+        # critical_path: longest expected time to the end of the workflow
+        remaining = [0.] * len(self.procs)
+        for idx in reversed(order):
+            downstream = [remaining[child] for child in self.children[idx]]
+            remaining[idx] = (_expected_duration(self.procs[idx]) +
+                              max([0.] + downstream))
+        return remaining
 
     def _remove_node_deps(self, jobid, crashfile, graph):
         subnodes = [s for s in dfs_preorder(graph, self.procs[jobid])]
         for node in subnodes:
-            idx = self.procs.index(node)
+            idx = self.proc_index[node]
             self.proc_done[idx] = True
             self.proc_pending[idx] = False
         return dict(node=self.procs[jobid],
@@ -424,11 +680,9 @@ class DistributedPluginBase(PluginBase):
         """Removes directories whose outputs have already been used up
         """
         if str2bool(self._config['execution']['remove_node_directories']):
-            for idx in np.nonzero((self.refidx.sum(axis=1) == 0).__array__())[0]:
-                if idx in self.mapnodesubids:
-                    continue
+            for idx in np.flatnonzero(self.refcount == 0):
                 if self.proc_done[idx] and (not self.proc_pending[idx]):
-                    self.refidx[idx, idx] = -1
+                    self.refcount[idx] = -1
                     outdir = self.procs[idx]._output_directory()
                     logger.info(('[node dependencies finished] '
                                  'removing node: %s from directory %s') % \
@@ -436,14 +690,57 @@ class DistributedPluginBase(PluginBase):
                     shutil.rmtree(outdir)
 
 
+def _expected_duration(node, default=1.):
+    """Return the duration of the last run of a node, or a default
+    """
+    try:
+        resultsfile = os.path.join(node.output_dir(),
+                                   'result_%s.pklz' % node.name)
+        if not os.path.exists(resultsfile):
+            return default
+        stored = load_outputs_file(resultsfile)
+        if stored is not None:
+            return stored[1] or default
+        runtime = loadpkl(resultsfile).runtime
+        if isinstance(runtime, list):
+            # MapNode subnodes may run concurrently
+            return max([default] + [rt.duration for rt in runtime
+                                    if rt and rt.duration])
+        if runtime.duration:
+            return runtime.duration
+    except Exception:
+        logger.debug('Could not read duration of node %s' % node._id)
+    return default
+
+
 class SGELikeBatchManagerBase(DistributedPluginBase):
     """Execute workflow with SGE/OGE/PBS like batch system
+
+    The state of all jobs is obtained with a single query of the batch
+    system, issued at most every `status_interval` seconds, when the plugin
+    implements `_query_job_states`. Otherwise each pending job is queried on
+    its own with `_is_pending`.
+
+    When `job_arrays` is set, the subnodes of a MapNode that become ready in
+    the same scheduler pass are submitted as a single job array.
+
+    When `bundle_duration` is set, jobs that become ready in the same
+    scheduler pass are packed into bundles run one after the other by a
+    single batch job, as long as their expected durations add up to at most
+    `bundle_duration` seconds and a bundle has at most `bundle_size` nodes.
+    The expected duration of a node is its `expected_duration` node
+    plugin_arg, the duration of its previous run, or 1 second for utility
+    interfaces. Other nodes are not bundled.
     """
 
     def __init__(self, template, plugin_args=None):
         super(SGELikeBatchManagerBase, self).__init__(plugin_args=plugin_args)
         self._template = template
         self._qsub_args = None
+        self._status_interval = 2.
+        self._job_arrays = False
+        self._bundle_duration = None
+        self._bundle_size = np.inf
         if plugin_args:
             if 'template' in plugin_args:
                 self._template = plugin_args['template']
@@ -451,22 +748,68 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
                     self._template = open(self._template).read()
             if 'qsub_args' in plugin_args:
                 self._qsub_args = plugin_args['qsub_args']
+            if 'status_interval' in plugin_args:
+                self._status_interval = float(plugin_args['status_interval'])
+            if 'job_arrays' in plugin_args:
+                self._job_arrays = plugin_args['job_arrays']
+            if 'bundle_duration' in plugin_args:
+                self._bundle_duration = plugin_args['bundle_duration']
+            if 'bundle_size' in plugin_args:
+                self._bundle_size = plugin_args['bundle_size']
+        # every poll queries the batch system, so back off from a coarser
+        # starting interval than local plugins
+        if not (plugin_args and 'min_poll_sleep_duration' in plugin_args):
+            self._min_poll_sleep_secs = min(0.5, self._poll_sleep_secs)
         self._pending = {}
+        self._submit_times = {}
+        self._job_states = None
+        self._job_states_time = None
+        self._queued = []
+        self._batch_tasks = {}
 
     def _is_pending(self, taskid):
         """Check if a task is pending in the batch system
         """
         raise NotImplementedError
 
-    def _submit_batchtask(self, scriptfile, node):
+    def _query_job_states(self):
+        """Return the unfinished jobs of the batch system in one query
+
+        Returns None if the batch system could not be queried, in which case
+        every task is checked with `_is_pending`.
+        """
+        return None
+
+    def _task_in_states(self, taskid, states):
+        """Check if a task is among the jobs returned by _query_job_states
+        """
+        return taskid in states
+
+    def _task_pending(self, taskid):
+        now = time()
+        if self._job_states_time is None or \
+                now - self._job_states_time >= self._status_interval:
+            self._job_states = self._query_job_states()
+            self._job_states_time = now
+        if self._job_states is None:
+            return self._is_pending(taskid)
+        if self._submit_times.get(taskid, 0) >= self._job_states_time:
+            # submitted after the batch system was last queried
+            return True
+        return self._task_in_states(taskid, self._job_states)
+
+    def _submit_batchtask(self, scriptfile, node, array_size=None):
         """Submit a task to the batch system
+
+        When `array_size` is given, the script is submitted as a job array of
+        that many tasks and the list of their task ids is returned.
         """
         raise NotImplementedError
 
     def _get_result(self, taskid):
         if taskid not in self._pending:
-            raise Exception('Task %d not found' % taskid)
-        if self._is_pending(taskid):
+            raise Exception('Task %s not found' % str(taskid))
+        if self._task_pending(self._batch_tasks.get(taskid, taskid)):
             return None
         node_dir = self._pending[taskid]
         # MIT HACK
@@ -514,19 +857,170 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
             result_out['result'] = result_data
         return result_out
 
-    def _submit_job(self, node, updatehash=False):
-        """submit job and return taskid
-        """
-        pyscript = create_pyscript(node, updatehash=updatehash)
+    def _write_batchscript(self, pyscript, command):
         batch_dir, name = os.path.split(pyscript)
         name = '.'.join(name.split('.')[:-1])
-        batchscript = '\n'.join((self._template,
-                                 '%s %s' % (sys.executable, pyscript)))
+        batchscript = '\n'.join((self._template, command))
         batchscriptfile = os.path.join(batch_dir, 'batchscript_%s.sh' % name)
         fp = open(batchscriptfile, 'wt')
         fp.writelines(batchscript)
         fp.close()
-        return self._submit_batchtask(batchscriptfile, node)
+        return batchscriptfile
+
+    def _register_tasks(self, taskid, nodes):
+        """Record the nodes run by a batch task and return their taskids
+
+        The nodes of a bundle are tracked with taskids of their own, mapped to
+        the batch task running them.
+        """
+        self._submit_times[taskid] = time()
+        if len(nodes) == 1:
+            self._pending[taskid] = nodes[0].output_dir()
+            return [taskid]
+        taskids = []
+        for i, node in enumerate(nodes):
+            nodetaskid = ('bundle', taskid, i)
+            self._pending[nodetaskid] = node.output_dir()
+            self._batch_tasks[nodetaskid] = taskid
+            taskids.append(nodetaskid)
+        return taskids
+
+    def _create_pyscript(self, nodes, updatehash=False):
+        if len(nodes) == 1:
+            return create_pyscript(nodes[0], updatehash=updatehash)
+        return create_bundle_pyscript(nodes, updatehash=updatehash)
+
+    def _submit_job(self, node, updatehash=False):
+        """submit job and return taskid
+        """
+        return self._submit_bundle([node], updatehash=updatehash)[0]
+
+    def _submit_bundle(self, nodes, updatehash=False):
+        """submit nodes run one after the other by a single job
+
+        Returns the taskids of the nodes.
+        """
+        pyscript = self._create_pyscript(nodes, updatehash=updatehash)
+        batchscriptfile = self._write_batchscript(
+            pyscript, '%s %s' % (sys.executable, pyscript))
+        taskid = self._submit_batchtask(batchscriptfile, nodes[0])
+        return self._register_tasks(taskid, nodes)
+
+    def _submit_array(self, bundles, updatehash=False):
+        """submit bundles of nodes as a job array and return their taskids
+        """
+        pyscripts = [self._create_pyscript(nodes, updatehash=updatehash)
+                     for nodes in bundles]
+        batch_dir, name = os.path.split(pyscripts[0])
+        name = '.'.join(name.split('.')[:-1])
+        listfile = os.path.join(batch_dir, 'arraytasks_%s.txt' % name)
+        fp = open(listfile, 'wt')
+        fp.writelines('\n'.join(pyscripts + ['']))
+        fp.close()
+        # the task index variable depends on the batch system
+        batchscriptfile = self._write_batchscript(
+            os.path.join(batch_dir, 'array_%s.py' % name),
+            '\n'.join((
+                'TASK_ID=${SGE_TASK_ID:-${PBS_ARRAY_INDEX:-$PBS_ARRAYID}}',
+                '%s "$(sed -n "${TASK_ID}p" %s)"' % (sys.executable,
+                                                     listfile))))
+        arraytaskids = self._submit_batchtask(batchscriptfile, bundles[0][0],
+                                              array_size=len(bundles))
+        taskids = []
+        for taskid, nodes in zip(arraytaskids, bundles):
+            taskids.extend(self._register_tasks(taskid, nodes))
+        return taskids
+
+    def _bundle_estimate(self, node):
+        """Return the expected duration of a node used to bundle jobs
+        """
+        if 'expected_duration' in node.plugin_args:
+            return float(node.plugin_args['expected_duration'])
+        duration = _expected_duration(node, default=None)
+        if duration is not None:
+            return duration
+        # utility interfaces (Function, Rename, Merge, ...) are usually quick
+        if node._interface.__class__.__module__ == Function.__module__:
+            return 1.
+        return np.inf
+
+    def _make_bundles(self, queued):
+        """Pack queued jobs into bundles of at most `bundle_duration` seconds
+
+        Only jobs with the same node plugin_args, and subnodes of the same
+        MapNode, are bundled together. Returns a list of (jobids, updatehash)
+        tuples.
+        """
+        if not self._bundle_duration:
+            return [([jobid], updatehash) for jobid, updatehash in queued]
+        bundles = []
+        current = {}
+        for jobid, updatehash in queued:
+            node = self.procs[jobid]
+            duration = self._bundle_estimate(node)
+            if duration >= self._bundle_duration:
+                bundles.append(([jobid], updatehash))
+                continue
+            key = (updatehash, self.mapnodesubids.get(jobid),
+                   repr(sorted(node.plugin_args.items())))
+            if key in current:
+                jobids, total = current[key]
+                if (total + duration <= self._bundle_duration and
+                        len(jobids) < self._bundle_size):
+                    jobids.append(jobid)
+                    current[key] = (jobids, total + duration)
+                    continue
+            current[key] = ([jobid], duration)
+            bundles.append((current[key][0], updatehash))
+        return bundles
+
+    def _submit_task(self, jobid, updatehash=False):
+        if not (self._bundle_duration or
+                (self._job_arrays and jobid in self.mapnodesubids)):
+            return super(SGELikeBatchManagerBase,
+                         self)._submit_task(jobid, updatehash=updatehash)
+        # submitted with the other jobs that are ready in this pass
+        self._queued.append((jobid, updatehash))
+        return 'queued_%d' % jobid
+
+    def _flush_submissions(self):
+        if not self._queued:
+            return
+        bundles = self._make_bundles(self._queued)
+        self._queued = []
+        groups = {}
+        order = []
+        for i, (jobids, updatehash) in enumerate(bundles):
+            parents = set([self.mapnodesubids.get(jobid) for jobid in jobids])
+            parent = parents.pop()
+            if self._job_arrays and parent is not None and not parents:
+                key = (parent, updatehash)
+            else:
+                key = (None, i)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append((jobids, updatehash))
+        taskids = {}
+        for key in order:
+            group = groups[key]
+            updatehash = group[0][1]
+            bundles = [[deepcopy(self.procs[jobid]) for jobid in jobids]
+                       for jobids, _ in group]
+            if len(bundles) == 1:
+                if len(bundles[0]) > 1:
+                    logger.info('Submitting %d nodes as a single job' %
+                                len(bundles[0]))
+                tids = self._submit_bundle(bundles[0], updatehash=updatehash)
+            else:
+                logger.info('Submitting %d jobs of subnodes of %s as a job '
+                            'array' % (len(bundles), self.procs[key[0]]._id))
+                tids = self._submit_array(bundles, updatehash=updatehash)
+            jobids = [jobid for ids, _ in group for jobid in ids]
+            for jobid, tid in zip(jobids, tids):
+                taskids['queued_%d' % jobid] = tid
+        self.pending_tasks = [(taskids.get(tid, tid), jobid)
+                              for tid, jobid in self.pending_tasks]
 
     def _report_crash(self, node, result=None):
         if result and result['traceback']:
@@ -539,6 +1033,7 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
 
     def _clear_task(self, taskid):
         del self._pending[taskid]
+        self._submit_times.pop(self._batch_tasks.pop(taskid, taskid), None)
 
 
 class GraphPluginBase(PluginBase):
@@ -2,6 +2,7 @@
 """
 
 import os
+import subprocess
 
 from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 
@@ -28,6 +29,10 @@ class CondorPlugin(SGELikeBatchManagerBase):
                  by condor_qsub
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
+    - status_interval : minimum number of seconds between two queries of the
+                        state of all jobs (default: 2)
+
+    Job arrays are not supported.
     """
 
     def __init__(self, **kwargs):
@@ -43,9 +48,26 @@ class CondorPlugin(SGELikeBatchManagerBase):
             if  'max_tries' in kwargs['plugin_args']:
                 self._max_tries = kwargs['plugin_args']['max_tries']
         super(CondorPlugin, self).__init__(template, **kwargs)
+        if self._job_arrays:
+            logger.warn('Job arrays are not supported by the Condor plugin')
+            self._job_arrays = False
+
+    def _query_job_states(self):
+        try:
+            proc = subprocess.Popen(['condor_q', '-format', '%d\n',
+                                     'ClusterId'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            o, e = proc.communicate()
+            if proc.returncode:
+                raise RuntimeError(e)
+            return set([int(line) for line in o.split()])
+        except Exception, e:
+            logger.debug('Could not query condor job states: %s' % e)
+            return None
 
     def _is_pending(self, taskid):
-        cmd = CommandLine('condor_q')
+        cmd = CommandLine('condor_q', terminal_output='full')
         cmd.inputs.args = '%d' % taskid
         # check condor cluster
         oldlevel = iflogger.level
@@ -56,8 +78,9 @@ class CondorPlugin(SGELikeBatchManagerBase):
             return True
         return False
 
-    def _submit_batchtask(self, scriptfile, node):
-        cmd = CommandLine('condor_qsub', environ=os.environ.data)
+    def _submit_batchtask(self, scriptfile, node, array_size=None):
+        cmd = CommandLine('condor_qsub', environ=os.environ.data,
+                          terminal_output='full')
         path = os.path.dirname(scriptfile)
         qsubargs = ''
         if self._qsub_args:
@@ -108,7 +131,6 @@ class CondorPlugin(SGELikeBatchManagerBase):
         iflogger.setLevel(oldlevel)
         # retrieve condor clusterid
         taskid = int(result.runtime.stdout.split(' ')[2])
-        self._pending[taskid] = node.output_dir()
         logger.debug('submitted condor cluster: %d for node %s' % (taskid,
                                                                    node._id))
         return taskid
@@ -87,6 +87,10 @@ class IPythonPlugin(DistributedPluginBase):
                                                                    pckld_node,
                                                                    node.config,
                                                                    updatehash)
+        # newer IPython versions report completion through futures
+        if hasattr(result_object, 'add_done_callback'):
+            self._event_driven = True
+            result_object.add_done_callback(self._notify_task_done)
         self._taskid += 1
         self.taskmap[self._taskid] = result_object
         return self._taskid
@@ -4,52 +4,133 @@
 """
 
 from multiprocessing import Pool
+import os
 from traceback import format_exception
 import sys
 
+import numpy as np
+
 from .base import (DistributedPluginBase, logger, report_crash)
 
-def run_node(node, updatehash):
+# environment variables controlling the number of threads used by tools
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
+
+
+def run_node(node, updatehash, num_threads=None):
     result = dict(result=None, traceback=None)
+    old_environ = {}
+    if num_threads:
+        for var in THREAD_ENV_VARS:
+            old_environ[var] = os.environ.get(var)
+            os.environ[var] = str(num_threads)
     try:
         result['result'] = node.run(updatehash=updatehash)
     except:
         etype, eval, etr = sys.exc_info()
         result['traceback'] = format_exception(etype,eval,etr)
         result['result'] = node.result
+    finally:
+        # pool processes are reused by later jobs
+        for var, value in old_environ.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value
     return result
 
+
+def get_system_memory_gb():
+    """Return the amount of physical memory in GB (inf if unknown)"""
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') *
+                os.sysconf('SC_PHYS_PAGES')) / 1024. ** 3
+    except (ValueError, OSError, AttributeError):
+        return np.inf
+
+
 class MultiProcPlugin(DistributedPluginBase):
     """Execute workflow with multiprocessing
 
     The plugin_args input to run can be used to control the multiprocessing
     execution. Currently supported options are:
 
-    - n_procs : number of processes to use
+    - n_procs : number of processors to use
+    - memory_gb : amount of memory (in GB) available to jobs (default: the
+      physical memory of the system)
+
+    Ready jobs are packed so that the sum of the `num_threads` and of the
+    `estimated_memory_gb` declared by the running nodes stay within these
+    budgets. The thread environment variables (e.g., OMP_NUM_THREADS) of each
+    job are set to its `num_threads`.
 
     """
 
     def __init__(self, plugin_args=None):
         super(MultiProcPlugin, self).__init__(plugin_args=plugin_args)
         self._taskresult = {}
+        self._taskresources = {}
         self._taskid = 0
         n_procs = 1
+        self.memory_gb = None
         if plugin_args:
             if 'n_procs' in plugin_args:
                 n_procs = plugin_args['n_procs']
+            if 'memory_gb' in plugin_args:
+                self.memory_gb = plugin_args['memory_gb']
+        if self.memory_gb is None:
+            self.memory_gb = get_system_memory_gb()
+        self.processors = n_procs
+        self._free_procs = self.processors
+        self._free_memory_gb = self.memory_gb
+        self._capped = set()
         self.pool = Pool(processes=n_procs)
+        self._event_driven = True
+
+    def _job_resources(self, node):
+        """Return the processors and memory reserved for a node
+
+        Requests larger than the budgets are capped, so that such a node
+        runs on its own instead of never being scheduled.
+        """
+        num_threads = getattr(node, 'num_threads', 1)
+        memory_gb = getattr(node, 'estimated_memory_gb', 0)
+        if num_threads > self.processors or memory_gb > self.memory_gb:
+            if node._id not in self._capped:
+                self._capped.add(node._id)
+                logger.warn(('Node %s requests %d threads and %.2f GB, '
+                             'only %d processors and %.2f GB available') %
+                            (node._id, num_threads, memory_gb,
+                             self.processors, self.memory_gb))
+            num_threads = min(num_threads, self.processors)
+            memory_gb = min(memory_gb, self.memory_gb)
+        return num_threads, memory_gb
+
+    def _can_submit(self, jobid):
+        num_threads, memory_gb = self._job_resources(self.procs[jobid])
+        # tolerate rounding errors accumulated by the memory bookkeeping
+        return (num_threads <= self._free_procs and
+                memory_gb <= self._free_memory_gb + 1e-6)
 
     def _get_result(self, taskid):
         if taskid not in self._taskresult:
             raise RuntimeError('Multiproc task %d not found'%taskid)
         if not self._taskresult[taskid].ready():
             return None
+        if taskid in self._taskresources:
+            num_threads, memory_gb = self._taskresources.pop(taskid)
+            self._free_procs += num_threads
+            self._free_memory_gb += memory_gb
         return self._taskresult[taskid].get()
 
     def _submit_job(self, node, updatehash=False):
         self._taskid += 1
-        self._taskresult[self._taskid] = self.pool.apply_async(run_node,
-                                                               (node, updatehash,))
+        num_threads, memory_gb = self._job_resources(node)
+        self._free_procs -= num_threads
+        self._free_memory_gb -= memory_gb
+        self._taskresources[self._taskid] = (num_threads, memory_gb)
+        self._taskresult[self._taskid] = self.pool.apply_async(
+            run_node, (node, updatehash, num_threads,),
+            callback=self._notify_task_done)
         return self._taskid
 
     def _report_crash(self, node, result=None):
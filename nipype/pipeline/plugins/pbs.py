@@ -10,6 +10,26 @@ from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 from nipype.interfaces.base import CommandLine
 
 
+# job states of finished jobs that may still be listed by qstat
+FINISHED_STATES = ['C', 'F', 'X']
+
+
+def parse_qstat_output(output):
+    """Parse the default output of qstat
+
+    Returns the set of the ids of unfinished jobs and array subjobs, without
+    the server name (e.g., '42' or '42[3]').
+    """
+    jobids = set()
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 6 or not fields[0][0].isdigit():
+            continue
+        if fields[-2] not in FINISHED_STATES:
+            jobids.add(fields[0].split('.')[0])
+    return jobids
+
+
 class PBSPlugin(SGELikeBatchManagerBase):
     """Execute using PBS/Torque
 
@@ -19,6 +39,12 @@ class PBSPlugin(SGELikeBatchManagerBase):
     - template : template to use for batch job submission
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
+    - status_interval : minimum number of seconds between two queries of the
+                        state of all jobs (default: 2)
+    - job_arrays : submit the subnodes of a MapNode as a job array
+                   (default: False)
+    - array_flag : qsub flag submitting a job array, '-J' for PBS Pro or '-t'
+                   for Torque (default: '-J')
 
     """
 
@@ -28,13 +54,29 @@ class PBSPlugin(SGELikeBatchManagerBase):
         """
         self._retry_timeout = 2
         self._max_tries = 2
+        self._array_flag = '-J'
         if 'plugin_args' in kwargs and kwargs['plugin_args']:
+            if 'array_flag' in kwargs['plugin_args']:
+                self._array_flag = kwargs['plugin_args']['array_flag']
             if 'retry_timeout' in kwargs['plugin_args']:
                 self._retry_timeout = kwargs['plugin_args']['retry_timeout']
             if  'max_tries' in kwargs['plugin_args']:
                 self._max_tries = kwargs['plugin_args']['max_tries']
         super(PBSPlugin, self).__init__(template, **kwargs)
 
+    def _query_job_states(self):
+        try:
+            proc = subprocess.Popen(['qstat', '-t'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            o, e = proc.communicate()
+            if proc.returncode:
+                raise RuntimeError(e)
+            return parse_qstat_output(o)
+        except Exception, e:
+            logger.debug('Could not query pbs job states: %s' % e)
+            return None
+
     def _is_pending(self, taskid):
         #  subprocess.Popen requires taskid to be a string
         proc = subprocess.Popen(["qstat", str(taskid)],
@@ -44,8 +86,9 @@ class PBSPlugin(SGELikeBatchManagerBase):
         errmsg = 'Unknown Job Id' # %s' % taskid
         return  errmsg not in e
 
-    def _submit_batchtask(self, scriptfile, node):
-        cmd = CommandLine('qsub', environ=os.environ.data)
+    def _submit_batchtask(self, scriptfile, node, array_size=None):
+        cmd = CommandLine('qsub', environ=os.environ.data,
+                          terminal_output='full')
         path = os.path.dirname(scriptfile)
         qsubargs = ''
         if self._qsub_args:
@@ -60,6 +103,8 @@ class PBSPlugin(SGELikeBatchManagerBase):
             qsubargs = '%s -o %s' % (qsubargs, path)
         if '-e' not in qsubargs:
             qsubargs = '%s -e %s' % (qsubargs, path)
+        if array_size:
+            qsubargs = '%s %s 1-%d' % (qsubargs, self._array_flag, array_size)
         if node._hierarchy:
             jobname = '.'.join((os.environ.data['LOGNAME'],
                                 node._hierarchy,
@@ -94,7 +139,13 @@ class PBSPlugin(SGELikeBatchManagerBase):
         iflogger.setLevel(oldlevel)
         # retrieve pbs taskid
         taskid = result.runtime.stdout.split('.')[0]
-        self._pending[taskid] = node.output_dir()
+        if array_size:
+            # job arrays are reported as '42[].server'
+            jobid = taskid.replace('[]', '')
+            logger.debug('submitted pbs job array: %s of %d tasks for node %s'
+                         % (jobid, array_size, node._id))
+            return ['%s[%d]' % (jobid, task)
+                    for task in range(1, array_size + 1)]
         logger.debug('submitted pbs task: %s for node %s' % (taskid, node._id))
 
         return taskid
@@ -4,12 +4,52 @@
 import os
 import subprocess
 from time import sleep
+from xml.etree import ElementTree
 
 from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 
 from nipype.interfaces.base import CommandLine
 
 
+def parse_task_ranges(tasks):
+    """Parse the task ranges of an array job listed by qstat
+
+    >>> parse_task_ranges('1-7:2,10')
+    [(1, 7, 2), (10, 10, 1)]
+    """
+    ranges = []
+    for item in tasks.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        step = 1
+        if ':' in item:
+            item, step = item.split(':')
+        if '-' in item:
+            start, stop = item.split('-')
+        else:
+            start = stop = item
+        ranges.append((int(start), int(stop), int(step)))
+    return ranges
+
+
+def parse_qstat_xml(xml):
+    """Parse the output of qstat -xml
+
+    Returns a dictionary mapping the number of each job to the ranges of its
+    listed tasks, or to None if the job is not an array job.
+    """
+    states = {}
+    for job in ElementTree.fromstring(xml).getiterator('job_list'):
+        jobid = int(job.findtext('JB_job_number'))
+        tasks = job.findtext('tasks')
+        if tasks is None:
+            states[jobid] = None
+        elif states.setdefault(jobid, []) is not None:
+            states[jobid].extend(parse_task_ranges(tasks))
+    return states
+
+
 class SGEPlugin(SGELikeBatchManagerBase):
     """Execute using SGE (OGE not tested)
 
@@ -19,6 +59,10 @@ class SGEPlugin(SGELikeBatchManagerBase):
     - template : template to use for batch job submission
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
+    - status_interval : minimum number of seconds between two queries of the
+                        state of all jobs (default: 2)
+    - job_arrays : submit the subnodes of a MapNode as a job array
+                   (default: True)
 
     """
 
@@ -35,8 +79,40 @@ class SGEPlugin(SGELikeBatchManagerBase):
             if  'max_tries' in kwargs['plugin_args']:
                 self._max_tries = kwargs['plugin_args']['max_tries']
         super(SGEPlugin, self).__init__(template, **kwargs)
+        if not ('plugin_args' in kwargs and kwargs['plugin_args'] and
+                'job_arrays' in kwargs['plugin_args']):
+            self._job_arrays = True
+
+    def _query_job_states(self):
+        try:
+            proc = subprocess.Popen(['qstat', '-xml'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            o, e = proc.communicate()
+            if proc.returncode:
+                raise RuntimeError(e)
+            return parse_qstat_xml(o)
+        except Exception, e:
+            logger.debug('Could not query sge job states: %s' % e)
+            return None
+
+    def _task_in_states(self, taskid, states):
+        if not isinstance(taskid, tuple):
+            return taskid in states
+        jobid, task = taskid
+        if jobid not in states:
+            return False
+        if states[jobid] is None:
+            return True
+        for start, stop, step in states[jobid]:
+            if start <= task <= stop and (task - start) % step == 0:
+                return True
+        return False
 
     def _is_pending(self, taskid):
+        if isinstance(taskid, tuple):
+            # task of a job array, check the whole array
+            taskid = taskid[0]
         #  subprocess.Popen requires taskid to be a string
         proc = subprocess.Popen(["qstat", '-j', str(taskid)],
                                 stdout=subprocess.PIPE,
@@ -44,8 +120,9 @@ class SGEPlugin(SGELikeBatchManagerBase):
         o, _ = proc.communicate()
         return o.startswith('=')
 
-    def _submit_batchtask(self, scriptfile, node):
-        cmd = CommandLine('qsub', environ=os.environ.data)
+    def _submit_batchtask(self, scriptfile, node, array_size=None):
+        cmd = CommandLine('qsub', environ=os.environ.data,
+                          terminal_output='full')
         path = os.path.dirname(scriptfile)
         qsubargs = ''
         if self._qsub_args:
@@ -60,6 +137,8 @@ class SGEPlugin(SGELikeBatchManagerBase):
             qsubargs = '%s -o %s' % (qsubargs, path)
         if '-e' not in qsubargs:
             qsubargs = '%s -e %s' % (qsubargs, path)
+        if array_size:
+            qsubargs = '%s -t 1-%d' % (qsubargs, array_size)
         if node._hierarchy:
             jobname = '.'.join((os.environ.data['LOGNAME'],
                                 node._hierarchy,
@@ -91,8 +170,11 @@ class SGEPlugin(SGELikeBatchManagerBase):
             else:
                 break
         iflogger.setLevel(oldlevel)
-        # retrieve sge taskid
-        taskid = int(result.runtime.stdout.split(' ')[2])
-        self._pending[taskid] = node.output_dir()
+        # retrieve sge taskid, e.g. 'Your job-array 42.1-10:1 ("name") ...'
+        taskid = int(result.runtime.stdout.split(' ')[2].split('.')[0])
+        if array_size:
+            logger.debug('submitted sge job array: %d of %d tasks for node %s'
+                         % (taskid, array_size, node._id))
+            return [(taskid, task) for task in range(1, array_size + 1)]
         logger.debug('submitted sge task: %d for node %s' % (taskid, node._id))
         return taskid
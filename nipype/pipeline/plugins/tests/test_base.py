@@ -2,12 +2,20 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 """Tests for the engine module
 """
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Timer
+from time import time
+
 import numpy as np
 import scipy.sparse as ssp
 
 from nipype.testing import (assert_raises, assert_equal, assert_true,
                             assert_false, skipif)
+import nipype.interfaces.utility as niu
+import nipype.pipeline.engine as pe
 import nipype.pipeline.plugins.base as pb
+from nipype.pipeline.utils import nx
 
 def test_scipy_sparse():
     foo = ssp.lil_matrix(np.eye(3, k=1))
@@ -15,6 +23,118 @@ def test_scipy_sparse():
     goo[goo.nonzero()] = 0
     yield assert_equal, foo[0,1], 0
 
+def test_ready_queue():
+    nodes = [pe.Node(niu.IdentityInterface(fields=['a']), name='n%d' % i)
+             for i in range(4)]
+    graph = nx.DiGraph()
+    # n0 -> n1 -> n3 and n0 -> n2 -> n3
+    graph.add_edges_from([(nodes[0], nodes[1]), (nodes[0], nodes[2]),
+                          (nodes[1], nodes[3]), (nodes[2], nodes[3])])
+    plugin = pb.DistributedPluginBase()
+    plugin._generate_dependency_list(graph)
+    idx = [plugin.proc_index[node] for node in nodes]
+    yield assert_equal, plugin._pop_ready(), idx[0]
+    yield assert_equal, plugin._ready, []
+    yield assert_equal, plugin.num_deps[idx[3]], 2
+    plugin.proc_done[idx[0]] = True
+    plugin._task_finished_cb(idx[0])
+    yield assert_equal, sorted([jobid for _, _, jobid in plugin._ready]), \
+        sorted([idx[1], idx[2]])
+    # n1 and n2 still need the outputs of n0
+    yield assert_equal, plugin.refcount[idx[0]], 2
+    # finishing a job twice does not release its dependents twice
+    plugin._task_finished_cb(idx[0])
+    yield assert_equal, plugin.num_deps[idx[1]], 0
+    yield assert_equal, len(plugin._ready), 2
+    plugin._task_finished_cb(idx[1])
+    yield assert_equal, plugin.refcount[idx[0]], 1
+    yield assert_equal, plugin.num_deps[idx[3]], 1
+
+def test_extend_proc_status():
+    graph = nx.DiGraph()
+    graph.add_node(pe.Node(niu.IdentityInterface(fields=['a']), name='n0'))
+    plugin = pb.DistributedPluginBase()
+    plugin._generate_dependency_list(graph)
+    plugin.proc_done[0] = True
+    for _ in range(5):
+        plugin._extend_proc_status(3)
+    yield assert_equal, len(plugin.proc_done), 16
+    yield assert_true, plugin.proc_done[0]
+    yield assert_false, np.any(plugin.proc_done[1:])
+    yield assert_false, np.any(plugin.proc_pending)
+
+def _policy_graph():
+    base_dir = mkdtemp()
+    chain = [pe.Node(niu.IdentityInterface(fields=['a']), name='chain%d' % i,
+                     base_dir=base_dir) for i in range(3)]
+    leaf = pe.Node(niu.IdentityInterface(fields=['a']), name='leaf',
+                   base_dir=base_dir)
+    graph = nx.DiGraph()
+    graph.add_edges_from([(chain[0], chain[1]), (chain[1], chain[2])])
+    graph.add_node(leaf)
+    return graph, chain, leaf, base_dir
+
+def test_scheduling_policies():
+    graph, chain, leaf, base_dir = _policy_graph()
+    leaf.plugin_args = {'priority': 10}
+    first = {}
+    following = {}
+    for policy in ['critical_path', 'priority', 'depth_first',
+                   'breadth_first']:
+        plugin = pb.DistributedPluginBase(
+            plugin_args={'scheduling_policy': policy})
+        plugin._generate_dependency_list(graph)
+        first[policy] = plugin.procs[plugin._pop_ready()]
+        # once chain[0] finished, chain[1] competes with leaf
+        plugin._generate_dependency_list(graph)
+        for _ in range(2):
+            plugin._pop_ready()
+        plugin._push_ready(plugin.proc_index[leaf])
+        plugin._task_finished_cb(plugin.proc_index[chain[0]])
+        following[policy] = [plugin.procs[plugin._pop_ready()]
+                             for _ in range(2)]
+    yield assert_equal, first['critical_path'], chain[0]
+    yield assert_equal, first['priority'], leaf
+    # chain[0] and leaf are both at the top of the graph
+    yield assert_true, first['depth_first'] in [chain[0], leaf]
+    yield assert_true, first['breadth_first'] in [chain[0], leaf]
+    yield assert_equal, following['depth_first'], [chain[1], leaf]
+    yield assert_equal, following['breadth_first'], [leaf, chain[1]]
+    yield assert_equal, following['critical_path'], [chain[1], leaf]
+    plugin = pb.DistributedPluginBase(
+        plugin_args={'scheduling_policy': lambda node: node is chain[0]})
+    plugin._generate_dependency_list(graph)
+    yield assert_equal, plugin.procs[plugin._pop_ready()], chain[0]
+    # jobs of equal priority keep their order, unless put back in front
+    plugin._push_ready(plugin.proc_index[chain[2]])
+    plugin._push_ready(plugin.proc_index[chain[1]], front=True)
+    order = [plugin.procs[plugin._pop_ready()] for _ in range(3)]
+    yield assert_equal, order, [chain[1], leaf, chain[2]]
+    yield assert_raises, ValueError, pb.DistributedPluginBase, \
+        {'scheduling_policy': 'random'}
+    rmtree(base_dir)
+
+def test_poll_backoff():
+    plugin = pb.DistributedPluginBase(
+        plugin_args={'poll_sleep_duration': 0.04,
+                     'min_poll_sleep_duration': 0.01})
+    secs = plugin._min_poll_sleep_secs
+    intervals = []
+    for _ in range(4):
+        secs = plugin._wait_for_tasks(secs, False)
+        intervals.append(secs)
+    yield assert_equal, intervals, [0.02, 0.04, 0.04, 0.04]
+    # progress resets the back-off
+    yield assert_equal, plugin._wait_for_tasks(secs, True), 0.02
+
+def test_event_driven_wakeup():
+    plugin = pb.DistributedPluginBase(plugin_args={'poll_sleep_duration': 30})
+    plugin._event_driven = True
+    Timer(0.1, plugin._notify_task_done).start()
+    t0 = time()
+    plugin._wait_for_tasks(plugin._min_poll_sleep_secs, False)
+    yield assert_true, (time() - t0) < 10
+
 '''
 Can use the following code to test that a mapnode crash continues successfully
 Need to put this into a nose-test with a timeout
@@ -45,4 +45,47 @@ def test_run_multiproc():
     result = node.get_output('output1')
     yield assert_equal, result, [1, 1]
     os.chdir(cur_dir)
-    rmtree(temp_dir)
\ No newline at end of file
+    rmtree(temp_dir)
+
+def get_num_threads():
+    import os
+    return int(os.environ['OMP_NUM_THREADS'])
+
+
+def test_resource_budget():
+    from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+    plugin = MultiProcPlugin(plugin_args={'n_procs': 4, 'memory_gb': 2})
+    big = pe.Node(interface=TestInterface(), name='big', num_threads=3,
+                  estimated_memory_gb=1.5)
+    small = pe.Node(interface=TestInterface(), name='small')
+    huge = pe.Node(interface=TestInterface(), name='huge', num_threads=8)
+    plugin.procs = [big, small, huge]
+    yield assert_equal, plugin._can_submit(0), True
+    plugin._free_procs -= 3
+    plugin._free_memory_gb -= 1.5
+    yield assert_equal, plugin._can_submit(1), True
+    yield assert_equal, plugin._can_submit(2), False
+    # requests above the budget are capped
+    yield assert_equal, plugin._job_resources(huge), (4, 0.25)
+    plugin.pool.close()
+
+
+def test_run_multiproc_threads():
+    import nipype.interfaces.utility as niu
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    pipe = pe.Workflow(name='pipe', base_dir=temp_dir)
+    nodes = [pe.Node(niu.Function(function=get_num_threads,
+                                  input_names=[], output_names=['out']),
+                     name='threads%d' % i, num_threads=i + 1)
+             for i in range(3)]
+    pipe.add_nodes(nodes)
+    execgraph = pipe.run(plugin="MultiProc",
+                         plugin_args={'n_procs': 3, 'memory_gb': 1})
+    results = sorted([(node.name, node.get_output('out'))
+                      for node in execgraph.nodes()])
+    yield assert_equal, results, [('threads0', 1), ('threads1', 2),
+                                  ('threads2', 3)]
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
@@ -0,0 +1,256 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+
+import nipype.interfaces.base as nib
+import nipype.interfaces.utility as niu
+from nipype.testing import (assert_equal, assert_true, assert_false,
+                            skipif)
+import nipype.pipeline.engine as pe
+from nipype.pipeline.utils import nx
+from nipype.pipeline.plugins.sge import (SGEPlugin, parse_qstat_xml,
+                                         parse_task_ranges)
+from nipype.pipeline.plugins.pbs import parse_qstat_output
+
+try:
+    # imported by the python scripts of the batch jobs
+    import matplotlib
+    have_matplotlib = True
+except ImportError:
+    have_matplotlib = False
+
+# stand-ins for the SGE commands: qsub runs the job (array) right away and
+# records its arguments, qstat records its calls and reports an empty queue
+QSUB = """#!/bin/sh
+echo "$@" >> %(log)s
+eval script=\\${$#}
+size=1
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-t" ]; then size=${2#1-}; fi
+    shift
+done
+task=1
+while [ $task -le $size ]; do
+    SGE_TASK_ID=$task sh $script > /dev/null 2>&1
+    task=$((task + 1))
+done
+echo "Your job 42 (\\"name\\") has been submitted"
+"""
+
+QSTAT = """#!/bin/sh
+echo "qstat $@" >> %(log)s
+echo "<?xml version='1.0'?><job_info><queue_info/><job_info/></job_info>"
+"""
+
+QSTAT_XML = """<?xml version='1.0'?>
+<job_info>
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>12</JB_job_number>
+      <state>r</state>
+    </job_list>
+    <job_list state="running">
+      <JB_job_number>13</JB_job_number>
+      <state>r</state>
+      <tasks>1</tasks>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>13</JB_job_number>
+      <state>qw</state>
+      <tasks>3-9:2</tasks>
+    </job_list>
+  </job_info>
+</job_info>
+"""
+
+QSTAT_PBS = """Job ID                    Name             User            Time Use S Queue
+------------------------- ---------------- --------------- -------- - -----
+41.server                  job1             user            00:00:01 C batch
+42.server                  job2             user            00:00:01 R batch
+43[].server                array            user                   0 B batch
+43[1].server               array            user            00:00:01 R batch
+43[2].server               array            user                   0 Q batch
+"""
+
+
+class InputSpec(nib.TraitedSpec):
+    input1 = nib.traits.Int(desc='a random int')
+
+
+class OutputSpec(nib.TraitedSpec):
+    output1 = nib.traits.Int(desc='outputs')
+
+
+class TestInterface(nib.BaseInterface):
+    input_spec = InputSpec
+    output_spec = OutputSpec
+
+    def _run_interface(self, runtime):
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output1'] = 2 * self.inputs.input1
+        return outputs
+
+
+def test_parse_qstat():
+    yield assert_equal, parse_task_ranges('1'), [(1, 1, 1)]
+    yield assert_equal, parse_task_ranges('1-7:2,10'), [(1, 7, 2),
+                                                        (10, 10, 1)]
+    states = parse_qstat_xml(QSTAT_XML)
+    yield assert_equal, states, {12: None, 13: [(1, 1, 1), (3, 9, 2)]}
+    plugin = SGEPlugin()
+    for taskid, pending in [(12, True), (14, False), ((13, 1), True),
+                            ((13, 2), False), ((13, 7), True),
+                            ((13, 10), False), ((12, 3), True)]:
+        yield assert_equal, plugin._task_in_states(taskid, states), pending
+    yield assert_equal, parse_qstat_output(QSTAT_PBS), set(['42', '43[]',
+                                                           '43[1]', '43[2]'])
+
+
+class CountingPlugin(SGEPlugin):
+
+    def __init__(self, **kwargs):
+        super(CountingPlugin, self).__init__(**kwargs)
+        self.queries = 0
+
+    def _query_job_states(self):
+        self.queries += 1
+        return set([1, 2])
+
+
+def test_status_interval():
+    plugin = CountingPlugin(plugin_args={'status_interval': 60})
+    for taskid in [1, 2, 3]:
+        plugin._pending[taskid] = None
+    yield assert_true, plugin._task_pending(1)
+    yield assert_true, plugin._task_pending(2)
+    yield assert_false, plugin._task_pending(3)
+    # all tasks were checked against a single query
+    yield assert_equal, plugin.queries, 1
+    # tasks submitted after the query are pending until the next one
+    plugin._submit_times[4] = plugin._job_states_time
+    yield assert_true, plugin._task_pending(4)
+    yield assert_equal, plugin.queries, 1
+    sleep(0.01)
+    plugin._status_interval = 0
+    yield assert_false, plugin._task_pending(4)
+    yield assert_equal, plugin.queries, 2
+
+
+@skipif(not have_matplotlib)
+def test_make_bundles():
+    graph = nx.DiGraph()
+    nodes = [pe.Node(niu.Rename(), name='quick%d' % i) for i in range(5)]
+    nodes.append(pe.Node(TestInterface(), name='slow'))
+    nodes.append(pe.Node(TestInterface(), name='hinted'))
+    nodes[-1].plugin_args = {'expected_duration': 0.5}
+    graph.add_nodes_from(nodes)
+    plugin = SGEPlugin(plugin_args={'bundle_duration': 3})
+    plugin._generate_dependency_list(graph)
+    queued = [(plugin.proc_index[node], False) for node in nodes]
+    jobids = [jobid for jobid, _ in queued]
+    bundles = plugin._make_bundles(queued)
+    # quick nodes of 1 second each, the node of unknown duration on its own
+    yield assert_equal, [ids for ids, _ in bundles], [jobids[:3],
+                                                      jobids[3:5],
+                                                      [jobids[5]],
+                                                      [jobids[6]]]
+    plugin._bundle_size = 2
+    bundles = plugin._make_bundles(queued)
+    yield assert_equal, [ids for ids, _ in bundles], [jobids[:2],
+                                                      jobids[2:4],
+                                                      [jobids[4]],
+                                                      [jobids[5]],
+                                                      [jobids[6]]]
+    plugin._bundle_duration = None
+    yield assert_equal, len(plugin._make_bundles(queued)), 7
+
+
+def double(x):
+    return 2 * x
+
+
+def run_fake_sge(plugin_args):
+    """Run a MapNode with SGE stand-ins and return the submitted commands
+    """
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_sge_')
+    bin_dir = os.path.join(temp_dir, 'bin')
+    os.makedirs(bin_dir)
+    log = os.path.join(temp_dir, 'commands.log')
+    for name, script in [('qsub', QSUB), ('qstat', QSTAT)]:
+        filename = os.path.join(bin_dir, name)
+        open(filename, 'wt').write(script % dict(log=log))
+        os.chmod(filename, 0755)
+    old_environ = dict([(var, os.environ.get(var)) for var in
+                        ['PATH', 'PYTHONPATH', 'LOGNAME']])
+    # the jobs import the nipype under test
+    nipype_dir = os.path.dirname(os.path.dirname(nib.__file__))
+    os.environ['PATH'] = os.pathsep.join((bin_dir, os.environ['PATH']))
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(nipype_dir)] +
+        [path for path in [old_environ['PYTHONPATH']] if path])
+    os.environ.setdefault('LOGNAME', 'nipype')
+    os.chdir(temp_dir)
+    try:
+        pipe = pe.Workflow(name='pipe')
+        mod1 = pe.MapNode(niu.Function(input_names=['x'],
+                                       output_names=['y'],
+                                       function=double),
+                          iterfield=['x'], name='mod1')
+        mod1.inputs.x = [1, 2, 3]
+        pipe.add_nodes([mod1])
+        pipe.base_dir = temp_dir
+        plugin_args.update(status_interval=0, poll_sleep_duration=0.1)
+        execgraph = pipe.run(plugin='SGE', plugin_args=plugin_args)
+        outputs = execgraph.nodes()[0].get_output('y')
+        return outputs, open(log).read().splitlines()
+    finally:
+        os.chdir(cur_dir)
+        for var, value in old_environ.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        rmtree(temp_dir)
+
+
+@skipif(not have_matplotlib)
+def test_run_sge_job_array():
+    outputs, commands = run_fake_sge({})
+    yield assert_equal, outputs, [2, 4, 6]
+    submissions = [cmd for cmd in commands if not cmd.startswith('qstat')]
+    # the three subnodes were submitted as a single job array, followed by
+    # the MapNode collating their results
+    yield assert_equal, len(submissions), 2
+    yield assert_true, '-t 1-3' in submissions[0]
+    yield assert_false, '-t' in submissions[1]
+    # the queue is queried as a whole
+    yield assert_true, all([cmd == 'qstat -xml' for cmd in commands
+                            if cmd.startswith('qstat')])
+
+
+@skipif(not have_matplotlib)
+def test_run_sge_bundles():
+    outputs, commands = run_fake_sge({'bundle_duration': 10,
+                                      'bundle_size': 2,
+                                      'job_arrays': False})
+    yield assert_equal, outputs, [2, 4, 6]
+    submissions = [cmd for cmd in commands if not cmd.startswith('qstat')]
+    # a bundle of two subnodes, the last subnode and the MapNode
+    yield assert_equal, len(submissions), 3
+    yield assert_true, 'pyscript_bundle_' in submissions[0]
+    yield assert_false, 'pyscript_bundle_' in submissions[1]
+    # bundles of subnodes are submitted as a job array
+    outputs, commands = run_fake_sge({'bundle_duration': 10,
+                                      'bundle_size': 2})
+    yield assert_equal, outputs, [2, 4, 6]
+    submissions = [cmd for cmd in commands if not cmd.startswith('qstat')]
+    yield assert_equal, len(submissions), 2
+    yield assert_true, '-t 1-2' in submissions[0]
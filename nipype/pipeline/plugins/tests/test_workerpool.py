@@ -0,0 +1,69 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nipype.testing import assert_equal, assert_true, assert_false
+import nipype.interfaces.utility as niu
+import nipype.pipeline.engine as pe
+
+
+def get_pid(x):
+    import os
+    return os.getpid()
+
+
+def add_pid(x, pids):
+    import os
+    return pids + [os.getpid()]
+
+
+def run_workflow(plugin_args):
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_workerpool_')
+    os.chdir(temp_dir)
+    try:
+        pipe = pe.Workflow(name='pipe')
+        pids = pe.MapNode(niu.Function(input_names=['x'],
+                                       output_names=['pid'],
+                                       function=get_pid),
+                          iterfield=['x'], name='pids')
+        pids.inputs.x = range(6)
+        chain = pe.Node(niu.Function(input_names=['x', 'pids'],
+                                     output_names=['pids'],
+                                     function=add_pid), name='chain')
+        chain.inputs.x = 0
+        pipe.connect(pids, 'pid', chain, 'pids')
+        pipe.base_dir = temp_dir
+        execgraph = pipe.run(plugin='WorkerPool', plugin_args=plugin_args)
+        names = [node.name for node in execgraph.nodes()]
+        return execgraph.nodes()[names.index('chain')].get_output('pids')
+    finally:
+        os.chdir(cur_dir)
+        rmtree(temp_dir)
+
+
+def test_run_workerpool():
+    pids = run_workflow({'n_workers': 2})
+    yield assert_equal, len(pids), 7
+    # the nodes ran in at most two worker processes
+    yield assert_true, len(set(pids)) <= 2
+    yield assert_false, os.getpid() in pids
+
+
+def test_idle_workers_restarted():
+    # workers stop as soon as they are idle and are started again for the
+    # next jobs
+    pids = run_workflow({'n_workers': 1, 'idle_timeout': 0.})
+    yield assert_equal, len(pids), 7
+    yield assert_false, os.getpid() in pids
+
+
+def test_worker_command():
+    # the scheduler does not wait for the command submitting a worker
+    nipype_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+    command = 'sleep 1; PYTHONPATH=%s %%(command)s' % nipype_dir
+    pids = run_workflow({'n_workers': 2, 'address': 'localhost',
+                         'worker_command': command})
+    yield assert_equal, len(pids), 7
+    yield assert_false, os.getpid() in pids
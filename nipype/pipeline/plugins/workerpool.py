@@ -0,0 +1,324 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Parallel workflow execution via a pool of persistent worker processes
+
+Workers connect to the scheduler over a socket and run node after node until
+they stay idle, so that the start up of the python interpreter and the import
+of nipype are paid once per worker instead of once per node.
+
+A worker is started with::
+
+  NIPYPE_WORKER_AUTHKEY=<key> python -m nipype.pipeline.plugins.workerpool \
+      <host>:<port>
+"""
+
+from multiprocessing import cpu_count
+from multiprocessing.connection import Listener, Client
+import os
+import Queue
+from socket import gethostname
+import subprocess
+import sys
+import threading
+from time import sleep, time
+from uuid import uuid4
+
+from .base import (DistributedPluginBase, logger, report_crash)
+from .multiproc import run_node
+
+AUTHKEY_ENV = 'NIPYPE_WORKER_AUTHKEY'
+
+
+def run_worker(address, authkey, token=None):
+    """Run the nodes sent by a scheduler until it stops the worker
+
+    Parameters
+    ----------
+    address : tuple
+        (host, port) of the scheduler
+    authkey : str
+        key authenticating the worker to the scheduler
+    token : str
+        identifies the worker to the scheduler that started it
+    """
+    from nipype import config, logging
+    conn = Client(address, authkey=authkey)
+    conn.send(('hello', token, gethostname(), os.getpid()))
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, IOError):
+            break
+        if msg[0] != 'run':
+            break
+        _, taskid, node, updatehash = msg
+        if node.config:
+            config.update_config(node.config)
+            logging.update_logging(config)
+        conn.send(run_node(node, updatehash))
+    conn.close()
+
+
+class WorkerPoolPlugin(DistributedPluginBase):
+    """Execute workflow with a pool of persistent worker processes
+
+    The plugin_args input to run can be used to control the workers.
+    Currently supported options are:
+
+    - n_workers : maximum number of workers (default: number of processors)
+    - worker_command : shell command starting a worker, e.g., through a batch
+      system. '%(command)s' is replaced by the python command running the
+      worker, whose environment must contain the NIPYPE_WORKER_AUTHKEY
+      variable of the scheduler (e.g., qsub -V). Workers are started as local
+      processes by default.
+    - address : host name the workers connect to (default: localhost for
+      local workers, the host name of the machine otherwise)
+    - port : port the scheduler listens to (default: any free port)
+    - idle_timeout : number of seconds after which an idle worker is stopped
+      (default: 60). Workers are started again when new jobs are ready.
+
+    """
+
+    def __init__(self, plugin_args=None):
+        super(WorkerPoolPlugin, self).__init__(plugin_args=plugin_args)
+        self._n_workers = cpu_count()
+        self._worker_command = None
+        self._host = None
+        self._port = 0
+        self._idle_timeout = 60.
+        if plugin_args:
+            if 'n_workers' in plugin_args:
+                self._n_workers = plugin_args['n_workers']
+            if 'worker_command' in plugin_args:
+                self._worker_command = plugin_args['worker_command']
+            if 'address' in plugin_args:
+                self._host = plugin_args['address']
+            if 'port' in plugin_args:
+                self._port = plugin_args['port']
+            if 'idle_timeout' in plugin_args:
+                self._idle_timeout = plugin_args['idle_timeout']
+        if self._host is None:
+            if self._worker_command:
+                self._host = gethostname()
+            else:
+                self._host = 'localhost'
+        self._authkey = uuid4().hex
+        self._listener = None
+        self._tasks = Queue.Queue()
+        self._taskresult = {}
+        self._taskid = 0
+        # jobs submitted and not finished yet
+        self._running = 0
+        self._workers = set()
+        # workers started but not registered yet, by token
+        self._starting = {}
+        self._procs = []
+        self._lock = threading.RLock()
+        self._stopping = False
+        self._event_driven = True
+
+    def run(self, graph, config, updatehash=False):
+        self._listener = Listener((self._host, self._port),
+                                  authkey=self._authkey)
+        logger.info('Waiting for workers on %s:%d' % self._listener.address)
+        self._stopping = False
+        acceptor = threading.Thread(target=self._accept_workers)
+        acceptor.daemon = True
+        acceptor.start()
+        try:
+            super(WorkerPoolPlugin, self).run(graph, config,
+                                              updatehash=updatehash)
+        finally:
+            self._stop_workers()
+
+    def _worker_args(self, token=None):
+        args = [sys.executable, '-m', 'nipype.pipeline.plugins.workerpool',
+                '%s:%d' % self._listener.address]
+        if token:
+            args.extend(['--token', token])
+        return args
+
+    def worker_command(self, token=None):
+        """Return the command running a worker for this scheduler
+        """
+        return ' '.join(self._worker_args(token))
+
+    def _start_worker(self):
+        token = uuid4().hex
+        env = dict(os.environ)
+        env[AUTHKEY_ENV] = self._authkey
+        if self._worker_command:
+            command = self._worker_command % dict(
+                command=self.worker_command(token))
+            logger.debug('Starting worker: %s' % command)
+            # not waited for, as the command may take a while to submit the
+            # worker (this runs with the lock held)
+            proc = subprocess.Popen(command, shell=True, env=env)
+        else:
+            # local workers use the nipype of the scheduler
+            nipype_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.dirname(os.path.abspath(__file__)))))
+            env['PYTHONPATH'] = os.pathsep.join(
+                [nipype_dir] + [path for path in
+                                [env.get('PYTHONPATH')] if path])
+            proc = subprocess.Popen(self._worker_args(token), env=env)
+            self._procs.append(proc)
+        self._starting[token] = (proc, bool(self._worker_command))
+
+    def _ensure_workers(self):
+        """Start workers until there is one per queued or running job
+        """
+        with self._lock:
+            if self._stopping:
+                return
+            for token, (proc, submitted) in self._starting.items():
+                if proc is None or proc.poll() is None:
+                    continue
+                if submitted and proc.returncode == 0:
+                    # the worker may run elsewhere once the command returned
+                    self._starting[token] = (None, True)
+                elif submitted:
+                    logger.warn('Worker command exited with code %d' %
+                                proc.returncode)
+                    del self._starting[token]
+                else:
+                    logger.warn('Worker exited with code %d before '
+                                'connecting' % proc.returncode)
+                    del self._starting[token]
+            needed = min(self._n_workers, self._running)
+            for _ in range(needed - len(self._workers) -
+                           len(self._starting)):
+                self._start_worker()
+
+    def _accept_workers(self):
+        while not self._stopping:
+            try:
+                conn = self._listener.accept()
+            except Exception, e:
+                if not self._stopping:
+                    logger.warn('Could not accept worker: %s' % e)
+                continue
+            if self._stopping:
+                conn.close()
+                break
+            thread = threading.Thread(target=self._serve_worker,
+                                      args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve_worker(self, conn):
+        try:
+            _, token, hostname, pid = conn.recv()
+        except (EOFError, IOError, ValueError):
+            conn.close()
+            return
+        name = '%s:%d' % (hostname, pid)
+        with self._lock:
+            self._starting.pop(token, None)
+            self._workers.add(name)
+        logger.debug('Worker %s connected' % name)
+        try:
+            while not self._stopping:
+                try:
+                    task = self._tasks.get(timeout=self._idle_timeout)
+                except Queue.Empty:
+                    logger.debug('Stopping idle worker %s' % name)
+                    break
+                if task is None:
+                    break
+                taskid, node, updatehash = task
+                try:
+                    conn.send(('run', taskid, node, updatehash))
+                    result = conn.recv()
+                except (EOFError, IOError), e:
+                    traceback = ['Worker %s was lost while running node '
+                                 '%s: %s\n' % (name, node._id, e)]
+                    self._set_result(taskid, dict(result=None,
+                                                  traceback=traceback))
+                    conn.close()
+                    return
+                self._set_result(taskid, result)
+            try:
+                conn.send(('stop',))
+            except IOError:
+                pass
+            conn.close()
+        finally:
+            with self._lock:
+                self._workers.discard(name)
+            # jobs may have been queued while this worker was stopping
+            self._ensure_workers()
+
+    def _set_result(self, taskid, result):
+        with self._lock:
+            self._taskresult[taskid] = result
+            self._running -= 1
+        self._notify_task_done()
+
+    def _stop_workers(self):
+        with self._lock:
+            self._stopping = True
+            try:
+                while True:
+                    self._tasks.get_nowait()
+            except Queue.Empty:
+                pass
+            for _ in range(len(self._workers)):
+                self._tasks.put(None)
+        # wake up the thread accepting connections
+        try:
+            Client(self._listener.address, authkey=self._authkey).close()
+        except Exception:
+            pass
+        self._listener.close()
+        # give local workers some time to finish their job
+        t = time()
+        while [proc for proc in self._procs if proc.poll() is None] and \
+                time() - t < 5:
+            sleep(0.05)
+        for proc in self._procs:
+            if proc.poll() is None:
+                proc.terminate()
+        self._procs = []
+        self._starting = {}
+
+    def _get_result(self, taskid):
+        if taskid not in self._taskresult:
+            raise RuntimeError('WorkerPool task %d not found' % taskid)
+        return self._taskresult[taskid]
+
+    def _submit_job(self, node, updatehash=False):
+        with self._lock:
+            self._taskid += 1
+            taskid = self._taskid
+            self._taskresult[taskid] = None
+            self._running += 1
+            self._tasks.put((taskid, node, updatehash))
+        self._ensure_workers()
+        return taskid
+
+    def _report_crash(self, node, result=None):
+        if result and result['traceback']:
+            node._result = result['result']
+            node._traceback = result['traceback']
+            return report_crash(node,
+                                traceback=result['traceback'])
+        else:
+            return report_crash(node)
+
+    def _clear_task(self, taskid):
+        del self._taskresult[taskid]
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] host:port')
+    parser.add_option('--token', help='identifies the worker to the '
+                      'scheduler that started it')
+    options, args = parser.parse_args()
+    if len(args) != 1 or AUTHKEY_ENV not in os.environ:
+        parser.error('the address of the scheduler and the %s environment '
+                     'variable are required' % AUTHKEY_ENV)
+    host, port = args[0].rsplit(':', 1)
+    run_worker((host, int(port)), os.environ[AUTHKEY_ENV],
+               token=options.token)
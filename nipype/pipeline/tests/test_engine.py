@@ -405,3 +405,38 @@ def test_node_hash():
     os.chdir(cwd)
     rmtree(wd)
 
+
+
+def test_hashfile_upgrade():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    fname = os.path.join(wd, 'data.txt')
+    open(fname, 'wt').write('some data')
+    from nipype.interfaces.utility import IdentityInterface
+    n1 = pe.Node(IdentityInterface(fields=['infile']), name='n1',
+                 base_dir=wd)
+    n1.inputs.infile = fname
+    n1.config = deepcopy(n1.config)
+    n1.config['execution']['hash_method'] = 'content'
+    n1.run()
+    _, md5hash = n1._get_hashval()
+    hashfile = os.path.join(n1.output_dir(), '_0x%s.json' % md5hash)
+    yield assert_true, os.path.exists(hashfile)
+    # the hash settings are stored with the hash file
+    info = pe.load_json(hashfile)[pe.HASHFILE_INFO_KEY]
+    yield assert_equal, info['hash_algorithm'], 'md5'
+    # switching algorithm reuses the results when inputs did not change
+    n1.config['execution']['hash_algorithm'] = 'sha1'
+    exists, sha1hash, sha1file, _ = n1.hash_exists()
+    yield assert_true, exists
+    yield assert_true, sha1hash != md5hash
+    yield assert_false, os.path.exists(hashfile)
+    # but not when they changed
+    open(fname, 'wt').write('other data')
+    n1.config['execution']['hash_algorithm'] = 'md5'
+    exists, _, _, _ = n1.hash_exists()
+    yield assert_false, exists
+    yield assert_true, os.path.exists(sha1file)
+    os.chdir(cwd)
+    rmtree(wd)
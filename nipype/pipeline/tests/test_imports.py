@@ -0,0 +1,66 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests keeping the import of the pipeline engine lightweight
+"""
+import os
+from shutil import rmtree
+import subprocess
+import sys
+from tempfile import mkdtemp
+
+import nipype
+from nipype.testing import assert_equal, assert_false
+
+CHECK_IMPORTS = """
+import sys
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as niu
+print(' '.join(sorted([name for name, module in sys.modules.items()
+                      if module is not None])))
+wf = pe.Workflow(name='wf', base_dir='%s')
+wf.add_nodes([pe.Node(niu.IdentityInterface(fields=['a']), name='n')])
+wf.run(plugin='Linear')
+print(' '.join(sorted([name for name, module in sys.modules.items()
+                      if module is not None])))
+"""
+
+
+def test_lazy_imports():
+    temp_dir = mkdtemp(prefix='test_imports_')
+    env = dict(os.environ)
+    env['HOME'] = temp_dir
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(nipype.__file__))] +
+        [path for path in [env.get('PYTHONPATH')] if path])
+    try:
+        proc = subprocess.Popen([sys.executable, '-c',
+                                 CHECK_IMPORTS % temp_dir],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env,
+                                cwd=temp_dir)
+        out, err = proc.communicate()
+        yield assert_equal, proc.returncode, 0, err
+        lines = out.splitlines()
+        imported = set(lines[0].split())
+        # optional and testing packages are imported when needed
+        for module in ['nose', 'nibabel', 'nipype.testing',
+                       'nipype.pipeline.plugins']:
+            yield assert_false, module in imported, module
+        # running a workflow only imports the plugin it uses
+        plugins = [module for module in lines[-1].split()
+                   if module.startswith('nipype.pipeline.plugins.')]
+        yield assert_equal, sorted(plugins), ['nipype.pipeline.plugins.base',
+                                              'nipype.pipeline.plugins.linear']
+        # the configuration directory is not created by the import
+        yield assert_false, os.path.exists(os.path.join(temp_dir, '.nipype'))
+    finally:
+        rmtree(temp_dir)
+
+
+def test_runners_not_collected():
+    # nipype.test and nipype.bench run the suite, they are not tests
+    from nose.config import Config
+    from nose.selector import Selector
+    selector = Selector(Config())
+    yield assert_false, selector.wantFunction(nipype.test)
+    yield assert_false, selector.wantFunction(nipype.bench)
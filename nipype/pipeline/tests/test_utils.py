@@ -13,7 +13,10 @@ import nipype.pipeline.engine as pe
 import nipype.interfaces.base as nib
 import nipype.interfaces.utility as niu
 from ... import config
-from ..utils import merge_dict
+from ..utils import (merge_dict, save_outputs_file, load_outputs_file,
+                     load_outputs, outputs_file, LazyResult, OutputsCache,
+                     cache_outputs, get_outputs_cache)
+from ...utils.filemanip import savepkl
 
 
 def test_identitynode_removal():
@@ -291,3 +294,96 @@ def test_multi_disconnected_iterable():
     eg = metawf.run(plugin='Linear')
     yield assert_equal, len(eg.nodes()), 60
     rmtree(out_dir)
+
+
+def test_outputs_file():
+    tempdir = mkdtemp()
+    resultsfile = os.path.join(tempdir, 'result_test.pklz')
+    outputs = {'a': 1, 'b': 'file.nii', 'c': ('x', [1.5, None]),
+               'd': {'e': u'\xe9'}, 'f': nib.Undefined, 'g': True}
+    yield assert_true, save_outputs_file(resultsfile, outputs,
+                                         nib.Bunch(duration=2.))
+    stored, duration, bunch = load_outputs_file(resultsfile)
+    yield assert_equal, duration, 2.
+    yield assert_false, bunch
+    yield assert_equal, stored, outputs
+    yield assert_true, isinstance(stored['b'], str)
+    yield assert_true, isinstance(stored['c'], tuple)
+    yield assert_true, isinstance(stored['d']['e'], unicode)
+    # unsupported values fall back to the pickled results
+    import numpy as np
+    result = nib.InterfaceResult(interface=None,
+                                 runtime=nib.Bunch(duration=3.),
+                                 outputs=nib.Bunch(a=np.zeros(2)))
+    savepkl(resultsfile, result)
+    yield assert_false, save_outputs_file(resultsfile,
+                                          result.outputs.dictcopy())
+    yield assert_false, os.path.exists(outputs_file(resultsfile))
+    yield assert_equal, load_outputs(resultsfile)['a'].tolist(), [0., 0.]
+    # runtime is read from the results file on access
+    lazy = LazyResult(resultsfile, None)
+    yield assert_equal, lazy.runtime.duration, 3.
+    yield assert_equal, lazy.version, 1.0
+    rmtree(tempdir)
+
+
+def test_outputs_file_workflow():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+
+    def func(a):
+        return a + 1
+
+    wf = pe.Workflow(name='outputsfile', base_dir=wd)
+    n1 = pe.Node(niu.Function(input_names=['a'], output_names=['b'],
+                              function=func), name='n1')
+    n1.inputs.a = 1
+    n2 = pe.MapNode(niu.Function(input_names=['a'], output_names=['b'],
+                                 function=func), iterfield=['a'], name='n2')
+    n2.inputs.a = [1, 2]
+    n3 = pe.Node(niu.Merge(2), name='n3')
+    wf.connect(n1, 'b', n3, 'in1')
+    wf.connect(n2, 'b', n3, 'in2')
+    wf.config['execution']['create_node_file'] = 'false'
+    wf.run()
+    n1dir = os.path.join(wd, 'outputsfile', 'n1')
+    yield assert_true, os.path.exists(os.path.join(n1dir, 'result_n1.json'))
+    yield assert_false, os.path.exists(os.path.join(n1dir, '_node.pklz'))
+    n3dir = os.path.join(wd, 'outputsfile', 'n3')
+    yield assert_equal, load_outputs(os.path.join(n3dir, 'result_n3.pklz')), \
+        {'out': [2, 2, 3]}
+    # rerunning uses the stored outputs
+    nodes = dict([(node.name, node) for node in wf.run().nodes()])
+    yield assert_true, isinstance(nodes['n2'].result, LazyResult)
+    yield assert_equal, nodes['n2'].result.outputs.b, [2, 3]
+    yield assert_equal, nodes['n3'].result.outputs.out, [2, 2, 3]
+    os.chdir(cwd)
+    rmtree(wd)
+
+
+def test_outputs_cache():
+    tempdir = mkdtemp()
+    resultsfile = os.path.join(tempdir, 'result_test.pklz')
+    savepkl(resultsfile, nib.InterfaceResult(interface=None,
+                                             runtime=nib.Bunch(),
+                                             outputs=nib.Bunch(a=1)))
+    cache_outputs(resultsfile, {'a': 2}, duration=3.)
+    # served from memory, without any outputs file
+    yield assert_false, os.path.exists(outputs_file(resultsfile))
+    yield assert_equal, load_outputs(resultsfile), {'a': 2}
+    yield assert_equal, load_outputs_file(resultsfile)[1], 3.
+    # a results file written by another process invalidates the entry
+    os.utime(resultsfile, (0, 0))
+    yield assert_equal, load_outputs(resultsfile), {'a': 1}
+    get_outputs_cache().clear()
+    # bounded size
+    cache = OutputsCache(maxsize=10)
+    for i in range(11):
+        open(resultsfile + str(i), 'wb').close()
+        cache.set(resultsfile + str(i), ({'a': i}, None, False))
+    yield assert_true, len(cache._entries) <= 10
+    yield assert_equal, cache.get(resultsfile + '10'), ({'a': 10}, None,
+                                                       False)
+    yield assert_equal, cache.get(resultsfile + '0'), None
+    rmtree(tempdir)
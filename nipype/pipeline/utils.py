@@ -5,17 +5,19 @@
 
 from copy import deepcopy
 from glob import glob
+import json
 import os
 import re
+import threading
 
 import numpy as np
 from nipype.utils.misc import package_check
 package_check('networkx', '1.3')
 import networkx as nx
 
-from nipype.interfaces.base import CommandLine, isdefined, Undefined
+from nipype.interfaces.base import CommandLine, isdefined, Undefined, Bunch
 from nipype.utils.filemanip import fname_presuffix, FileNotFoundError,\
-    filename_to_list
+    filename_to_list, loadpkl
 from nipype.utils.misc import create_function_from_source, str2bool
 from nipype.interfaces.utility import IdentityInterface
 
@@ -670,7 +672,8 @@ def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
         input_files.extend(walk_outputs(inputdict))
         needed_files += [path for path, type in input_files if type == 'f']
     for extra in ['_0x*.json', 'provenance.xml', 'pyscript*.m',
-                  'command.txt', 'result*.pklz', '_inputs.pklz', '_node.pklz']:
+                  'command.txt', 'result*.pklz', 'result*.json',
+                  '_inputs.pklz', '_node.pklz']:
         needed_files.extend(glob(os.path.join(cwd, extra)))
     if files2keep:
         needed_files.extend(filename_to_list(files2keep))
@@ -735,3 +738,290 @@ def merge_dict(d1, d2, merge=lambda x, y: y):
         else:
             result[k] = v
     return result
+
+
+# version of the json files storing the outputs of nodes
+OUTPUTS_FILE_VERSION = 1
+
+
+def outputs_file(results_file):
+    """Return the json file storing the outputs of a results file"""
+    return os.path.splitext(results_file)[0] + '.json'
+
+
+def _encode_value(value):
+    """Convert an output value into json serializable data
+
+    Tuples, unicode strings and undefined values are tagged so that they can
+    be restored exactly. Raises TypeError for any other type.
+    """
+    if not isdefined(value):
+        return {'__undefined__': True}
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, str):
+        # raises UnicodeDecodeError for non utf-8 data
+        value.decode('utf-8')
+        return value
+    if isinstance(value, unicode):
+        return {'__unicode__': value}
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encode_value(val) for val in value]}
+    if isinstance(value, list):
+        return [_encode_value(val) for val in value]
+    if isinstance(value, dict):
+        out = {}
+        for key, val in value.items():
+            if not isinstance(key, str) or key.startswith('__'):
+                raise TypeError('Cannot store dictionary key %r' % key)
+            out[key] = _encode_value(val)
+        return out
+    raise TypeError('Cannot store value of type %s' % type(value))
+
+
+def _decode_value(value):
+    """Restore an output value converted by _encode_value"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_decode_value(val) for val in value]
+    if isinstance(value, dict):
+        if '__undefined__' in value:
+            return Undefined
+        if '__unicode__' in value:
+            return value['__unicode__']
+        if '__tuple__' in value:
+            return tuple([_decode_value(val) for val in value['__tuple__']])
+        return dict([(str(key), _decode_value(val))
+                     for key, val in value.items()])
+    return value
+
+
+def get_duration(runtime):
+    """Return the duration of a run (the longest one for MapNodes) or None
+    """
+    if not isinstance(runtime, list):
+        runtime = [runtime]
+    durations = [getattr(rt, 'duration', None) for rt in runtime if rt]
+    durations = [val for val in durations if val is not None]
+    if durations:
+        return max(durations)
+    return None
+
+
+def save_outputs_file(results_file, outputs, runtime=None, bunch=False):
+    """Store outputs next to a results file, in a small json file
+
+    Parameters
+    ----------
+    results_file : str
+        pickled results file of a node
+    outputs : dict or None
+        the outputs of the node
+    runtime : Bunch or list of Bunch
+        runtime information of the node (only the duration is stored)
+    bunch : boolean
+        whether the outputs are restored as a Bunch (e.g., for MapNodes)
+
+    Returns
+    -------
+    True if the outputs could be stored. Otherwise the json file is removed
+    and the outputs have to be read from the results file.
+    """
+    filename = outputs_file(results_file)
+    data = {'version': OUTPUTS_FILE_VERSION,
+            'duration': get_duration(runtime),
+            'bunch': bool(bunch)}
+    try:
+        if outputs is None:
+            data['outputs'] = None
+        else:
+            data['outputs'] = _encode_value(dict(outputs))
+        content = json.dumps(data, sort_keys=True)
+    except (TypeError, ValueError), e:
+        logger.debug('Not storing outputs in %s: %s' % (filename, e))
+        if os.path.exists(filename):
+            os.remove(filename)
+        return False
+    # write atomically, other processes may be reading the outputs
+    tmpfile = '%s.%d.tmp' % (filename, os.getpid())
+    fp = open(tmpfile, 'wt')
+    fp.write(content)
+    fp.close()
+    os.rename(tmpfile, filename)
+    return True
+
+
+class OutputsCache(object):
+    """In-memory cache of the outputs of nodes, keyed on their results file
+
+    Entries are only returned while the results file has not been modified
+    (e.g., by a node run in another process), so that the files on disk
+    remain the reference.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries, the least recently used are evicted first
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def _stat(self, results_file):
+        try:
+            stat = os.stat(results_file)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def get(self, results_file):
+        """Return the stored (outputs, duration, bunch) tuple or None"""
+        with self._lock:
+            entry = self._entries.get(results_file)
+        if entry is None:
+            return None
+        if entry[0] != self._stat(results_file):
+            with self._lock:
+                self._entries.pop(results_file, None)
+            return None
+        with self._lock:
+            self._tick += 1
+            self._entries[results_file] = (entry[0], entry[1], self._tick)
+        return entry[1]
+
+    def set(self, results_file, stored):
+        if self.maxsize <= 0:
+            return
+        key = self._stat(results_file)
+        if key is None:
+            return
+        with self._lock:
+            self._tick += 1
+            self._entries[results_file] = (key, stored, self._tick)
+            if len(self._entries) > self.maxsize:
+                # evict the least recently used tenth of the entries at once
+                ticks = sorted([val[2] for val in self._entries.values()])
+                threshold = ticks[len(ticks) -
+                                  max(1, 9 * self.maxsize // 10)]
+                for oldkey, val in self._entries.items():
+                    if val[2] < threshold:
+                        del self._entries[oldkey]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_outputs_cache = None
+
+
+def get_outputs_cache():
+    """Return the process-wide outputs cache"""
+    global _outputs_cache
+    maxsize = int(config.get('execution', 'outputs_cache_size'))
+    if _outputs_cache is None:
+        _outputs_cache = OutputsCache(maxsize=maxsize)
+    _outputs_cache.maxsize = maxsize
+    return _outputs_cache
+
+
+def cache_outputs(results_file, outputs, duration=None, bunch=False):
+    """Keep the outputs of a node that was just saved in memory
+
+    Nodes running later in the same process read them from memory instead
+    of loading the outputs or results file.
+    """
+    get_outputs_cache().set(results_file,
+                            (deepcopy(outputs), duration, bunch))
+
+
+def load_outputs_file(results_file):
+    """Load the outputs and duration stored next to a results file
+
+    Outputs kept in memory by this process are returned without reading
+    the file, if the results file did not change since.
+
+    Returns
+    -------
+    (outputs, duration, bunch) or None if there is no valid outputs file.
+    outputs is a dictionary (or None for interfaces without outputs).
+    """
+    stored = get_outputs_cache().get(results_file)
+    if stored is not None:
+        return stored
+    filename = outputs_file(results_file)
+    if not os.path.exists(filename):
+        return None
+    try:
+        fp = open(filename, 'rt')
+        try:
+            data = json.load(fp)
+        finally:
+            fp.close()
+    except (IOError, ValueError), e:
+        logger.debug('Could not read outputs file %s: %s' % (filename, e))
+        return None
+    if data.get('version') != OUTPUTS_FILE_VERSION:
+        return None
+    outputs = data['outputs']
+    if outputs is not None:
+        outputs = _decode_value(outputs)
+    stored = (outputs, data.get('duration'), data.get('bunch', False))
+    get_outputs_cache().set(results_file, stored)
+    return stored
+
+
+def load_outputs(results_file):
+    """Return the outputs of a node as a dictionary
+
+    The outputs kept in memory or the json outputs file are used when
+    available, the pickled results file otherwise.
+    """
+    stored = load_outputs_file(results_file)
+    if stored is not None:
+        return stored[0]
+    outputs = loadpkl(results_file).outputs
+    bunch = isinstance(outputs, Bunch)
+    if outputs is not None:
+        try:
+            outputs = outputs.get()
+        except TypeError:
+            outputs = outputs.dictcopy()  # outputs was a bunch
+    get_outputs_cache().set(results_file, (outputs, None, bunch))
+    return outputs
+
+
+class LazyResult(object):
+    """Results of a node whose outputs are read from the json outputs file
+
+    The other attributes of the InterfaceResult (runtime, inputs, interface)
+    are loaded from the pickled results file on first access.
+    """
+
+    def __init__(self, results_file, outputs):
+        self._results_file = results_file
+        self.outputs = outputs
+
+    def _load(self):
+        result = loadpkl(self._results_file)
+        for key, value in result.__dict__.items():
+            if key != 'outputs':
+                self.__dict__[key] = value
+
+    def __getattr__(self, name):
+        if name.startswith('_') and name != '_version':
+            raise AttributeError(name)
+        if '_results_file' in self.__dict__ and \
+                '_version' not in self.__dict__:
+            self._load()
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(name)
+
+    @property
+    def version(self):
+        return self._version
@@ -4,7 +4,9 @@
 Created on 20 Apr 2010
 
 logging options : INFO, DEBUG
-hash_method : content, timestamp
+hash_method : content, timestamp, sampled
+hash_algorithm : md5, sha1, sha256, sha512, blake2b, xxhash
+command_output : full, tail, file, none
 
 @author: Chris Filo Gorgolewski
 '''
@@ -14,6 +16,7 @@ from json import load, dump
 import os
 import shutil
 from StringIO import StringIO
+from tempfile import mkstemp
 from warnings import warn
 
 from ..external import portalocker
@@ -30,15 +33,31 @@ log_size = 16384000
 log_rotate = 4
 
 [execution]
+command_output = full
+command_output_file = command_output.log
+command_output_tail = 1000
+create_node_file = true
+create_outputs_file = true
 create_report = true
 crashdump_dir = %s
 display_variable = :1
+hash_algorithm = md5
+hash_cache = true
+hash_cache_file =
+hash_cache_size = 100000
 hash_method = timestamp
+hash_threads = 4
 job_finished_timeout = 5
 keep_inputs = false
 local_hash_check = false
 matplotlib_backend = Agg
+matlab_session_jobs = 100
+matlab_session_timeout = 300
+matlab_sessions = false
+outputs_cache_size = 1000
 plugin = Linear
+probe_cache = true
+probe_cache_age = 86400
 remove_node_directories = false
 remove_unnecessary_outputs = true
 single_thread_matlab = true
@@ -56,9 +75,8 @@ class NipypeConfig(object):
 
     def __init__(self, *args, **kwargs):
         self._config = ConfigParser.ConfigParser()
+        # the configuration directory is only created when data is saved
         config_dir = os.path.expanduser('~/.nipype')
-        if not os.path.exists(config_dir):
-            os.makedirs(config_dir)
         old_config_file = os.path.expanduser('~/.nipype.cfg')
         new_config_file = os.path.join(config_dir, 'nipype.cfg')
         # To be deprecated in two releases
@@ -74,6 +92,8 @@ class NipypeConfig(object):
             else:
                 warn("Moving old config file from: %s to %s" % (old_config_file,
                                                                 new_config_file))
+                if not os.path.exists(config_dir):
+                    os.makedirs(config_dir)
                 shutil.move(old_config_file, new_config_file)
         self.data_file = os.path.join(config_dir, 'nipype.json')
         self._config.readfp(StringIO(default_cfg))
@@ -127,14 +147,24 @@ class NipypeConfig(object):
 
     def save_data(self, key, value):
         datadict = {}
+        data_dir = os.path.dirname(self.data_file)
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
         if os.path.exists(self.data_file):
             with open(self.data_file, 'rt') as file:
                 portalocker.lock(file, portalocker.LOCK_EX)
                 datadict = load(file)
-        with open(self.data_file, 'wt') as file:
-            portalocker.lock(file, portalocker.LOCK_EX)
-            datadict[key] = value
-            dump(datadict, file)
+        datadict[key] = value
+        # written to a temporary file renamed into place, so that readers
+        # never see a truncated file
+        fd, tmpfile = mkstemp(dir=data_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wt') as file:
+                dump(datadict, file)
+            os.rename(tmpfile, self.data_file)
+        except:
+            os.remove(tmpfile)
+            raise
 
     def update_config(self, config_dict):
         for section in ['execution', 'logging', 'check']:
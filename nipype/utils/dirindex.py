@@ -0,0 +1,220 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""In-memory index of directory trees for resolving glob patterns
+
+Resolving many glob patterns against the same directory tree (e.g., the
+templates of a DataGrabber for every subject of a study) lists the same
+directories over and over, which is slow on network file systems. An index
+lists each directory of the tree at most once, when a pattern first needs
+it, and matches the patterns in memory afterwards.
+
+Directories whose modification time changed since they were listed are
+listed again (``refresh='mtime'``), which only costs a stat of the
+directories visited by a pattern. Indexes can be saved to a file and loaded
+by later runs or by other processes.
+"""
+
+import cPickle
+import fnmatch
+import glob
+import gzip
+import os
+import threading
+
+from .. import logging
+fmlogger = logging.getLogger("filemanip")
+
+INDEX_VERSION = 1
+
+REFRESH_MODES = ['mtime', 'none']
+
+
+class DirectoryIndex(object):
+    """Listings of the directories below a base directory
+
+    Parameters
+    ----------
+    base_directory : str
+        root of the indexed tree
+    index_file : str
+        file the index is loaded from, if it exists, and saved to
+    refresh : {'mtime', 'none'}
+        whether directories are listed again when their modification time
+        changed, or listed only once
+
+    Examples
+    --------
+    >>> from nipype.utils.dirindex import DirectoryIndex
+    >>> index = DirectoryIndex('/data/study')
+    >>> index.glob('/data/study/s1/run*/func.nii') # doctest: +SKIP
+    ['/data/study/s1/run1/func.nii', '/data/study/s1/run2/func.nii']
+
+    """
+
+    def __init__(self, base_directory, index_file=None, refresh='mtime'):
+        if refresh not in REFRESH_MODES:
+            raise ValueError('Unknown refresh mode %s, use one of %s' %
+                             (refresh, ', '.join(REFRESH_MODES)))
+        self.base_directory = os.path.abspath(base_directory)
+        self.index_file = index_file
+        self.refresh = refresh
+        # directory -> (mtime, files, subdirectories)
+        self._dirs = {}
+        self._dirty = False
+        # number of directories listed, for diagnostics
+        self.listings = 0
+        self._lock = threading.RLock()
+        if index_file and os.path.exists(index_file):
+            self.load(index_file)
+
+    def load(self, index_file):
+        """Load the listings saved in a file, if they are for this tree"""
+        try:
+            fp = gzip.open(index_file, 'rb')
+            try:
+                data = cPickle.load(fp)
+            finally:
+                fp.close()
+        except Exception, e:
+            fmlogger.warn('Could not load directory index %s: %s' %
+                          (index_file, e))
+            return
+        if data.get('version') != INDEX_VERSION or \
+                data.get('base_directory') != self.base_directory:
+            fmlogger.warn('Ignoring directory index %s of another tree' %
+                          index_file)
+            return
+        with self._lock:
+            self._dirs.update(data['dirs'])
+
+    def save(self, index_file=None):
+        """Save the listings, atomically replacing the index file"""
+        if index_file is None:
+            index_file = self.index_file
+        with self._lock:
+            data = dict(version=INDEX_VERSION,
+                        base_directory=self.base_directory,
+                        dirs=dict(self._dirs))
+            self._dirty = False
+        tmpfile = '%s.%d.tmp' % (index_file, os.getpid())
+        fp = gzip.open(tmpfile, 'wb')
+        try:
+            cPickle.dump(data, fp, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+        os.rename(tmpfile, index_file)
+
+    def save_if_changed(self):
+        """Save the index to its file if directories were listed"""
+        if self.index_file and self._dirty:
+            try:
+                self.save()
+            except (IOError, OSError), e:
+                fmlogger.warn('Could not save directory index %s: %s' %
+                              (self.index_file, e))
+
+    def scan(self):
+        """List all the directories of the tree"""
+        pending = [self.base_directory]
+        while pending:
+            dirname = pending.pop()
+            listing = self.listdir(dirname)
+            if listing is not None:
+                pending.extend([os.path.join(dirname, subdir)
+                                for subdir in listing[1]])
+
+    def listdir(self, dirname):
+        """Return the (files, subdirectories) of a directory, or None if it
+        does not exist"""
+        with self._lock:
+            entry = self._dirs.get(dirname)
+            if entry is not None and self.refresh == 'none':
+                return entry[1:]
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError:
+            with self._lock:
+                if self._dirs.pop(dirname, None) is not None:
+                    self._dirty = True
+            return None
+        if entry is not None and entry[0] == mtime:
+            return entry[1:]
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return None
+        files = []
+        subdirs = []
+        for name in names:
+            if os.path.isdir(os.path.join(dirname, name)):
+                subdirs.append(name)
+            else:
+                files.append(name)
+        entry = (mtime, sorted(files), sorted(subdirs))
+        with self._lock:
+            self._dirs[dirname] = entry
+            self._dirty = True
+            self.listings += 1
+        return entry[1:]
+
+    def glob(self, pattern):
+        """Return the paths matching a pattern, as glob.glob does
+
+        Patterns outside of the base directory, or that are not normalized
+        (e.g., with '..' components), are resolved with glob.glob.
+        """
+        dirs_only = pattern.endswith(os.sep)
+        if not pattern.startswith(self.base_directory + os.sep) or \
+                os.path.normpath(pattern) != pattern.rstrip(os.sep):
+            return glob.glob(pattern)
+        parts = pattern[len(self.base_directory) + 1:].rstrip(os.sep)
+        parts = parts.split(os.sep)
+        paths = [self.base_directory]
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1 and not dirs_only
+            matches = []
+            for dirname in paths:
+                listing = self.listdir(dirname)
+                if listing is None:
+                    continue
+                files, subdirs = listing
+                names = subdirs
+                if last:
+                    names = files + subdirs
+                if glob.has_magic(part):
+                    found = fnmatch.filter(names, part)
+                    # as glob, wildcards do not match hidden files
+                    if not part.startswith('.'):
+                        found = [name for name in found
+                                 if not name.startswith('.')]
+                elif part in names:
+                    found = [part]
+                else:
+                    found = []
+                matches.extend([os.path.join(dirname, name)
+                                for name in found])
+            paths = matches
+        if dirs_only:
+            paths = [path + os.sep for path in paths]
+        return paths
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_directory_index(base_directory, index_file=None, refresh='mtime'):
+    """Return the index of a directory tree shared by this process"""
+    key = (os.path.abspath(base_directory), index_file, refresh)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = DirectoryIndex(base_directory,
+                                           index_file=index_file,
+                                           refresh=refresh)
+        return _indexes[key]
+
+
+def clear_directory_indexes():
+    """Forget the indexes of this process"""
+    with _indexes_lock:
+        _indexes.clear()
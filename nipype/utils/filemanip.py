@@ -15,6 +15,7 @@ import shutil
 # available as an external package for versions of python before 2.6.
 # Both md5 algorithms appear to return the same result.
 try:
+    import hashlib
     from hashlib import md5
 except ImportError:
     from md5 import md5
@@ -31,6 +32,7 @@ import numpy as np
 
 from nipype.interfaces.traits_extension import isdefined
 from nipype.utils.misc import is_container
+from nipype.utils.hashcache import get_hash_cache
 
 from .. import logging, config
 fmlogger = logging.getLogger("filemanip")
@@ -151,20 +153,108 @@ def check_forhash(filename):
         return False, None
 
 
-def hash_infile(afile, chunk_len=8192):
-    """ Computes md5 hash of a file"""
-    md5hex = None
+HASH_ALGORITHMS = ['md5', 'sha1', 'sha256', 'sha512', 'blake2b', 'xxhash']
+
+def get_hash_object(algorithm=None):
+    """Return a new hash object for the given algorithm
+
+    Parameters
+    ----------
+    algorithm : str
+        one of md5, sha1, sha256, sha512, blake2b (python >= 3.6 or
+        pyblake2) or xxhash (requires the xxhash package). Defaults to the
+        hash_algorithm execution option.
+    """
+    if algorithm is None:
+        algorithm = config.get('execution', 'hash_algorithm')
+    algorithm = algorithm.lower()
+    if algorithm == 'md5':
+        return md5()
+    if algorithm == 'blake2b':
+        try:
+            from hashlib import blake2b
+        except ImportError:
+            try:
+                from pyblake2 import blake2b
+            except ImportError:
+                raise ImportError(('blake2b hashing requires python >= 3.6 '
+                                   'or the pyblake2 package'))
+        # same length as md5 digests
+        return blake2b(digest_size=16)
+    if algorithm == 'xxhash':
+        try:
+            import xxhash
+        except ImportError:
+            raise ImportError('xxhash hashing requires the xxhash package')
+        return xxhash.xxh64()
+    if algorithm in HASH_ALGORITHMS:
+        return hashlib.new(algorithm)
+    raise ValueError('Unknown hash algorithm: %s' % algorithm)
+
+def hash_infile(afile, chunk_len=1024 * 1024, algorithm=None):
+    """ Computes the hash of the content of a file
+
+    Hashes of unchanged files are retrieved from the file hash cache (see
+    :mod:`nipype.utils.hashcache`) when it is enabled.
+    """
+    hashhex = None
     if os.path.isfile(afile):
-        md5obj = md5()
-        fp = file(afile, 'rb')
-        while True:
-            data = fp.read(chunk_len)
-            if not data:
-                break
-            md5obj.update(data)
-        fp.close()
-        md5hex = md5obj.hexdigest()
-    return md5hex
+        if algorithm is None:
+            algorithm = config.get('execution', 'hash_algorithm')
+        hashfunc = lambda f: _hash_file_content(f, chunk_len, algorithm)
+        cache = get_hash_cache()
+        if cache is None:
+            hashhex = hashfunc(afile)
+        else:
+            hashhex = cache.lookup(afile, algorithm.lower(), hashfunc)
+    return hashhex
+
+def _hash_file_content(afile, chunk_len=1024 * 1024, algorithm='md5'):
+    hashobj = get_hash_object(algorithm)
+    fp = open(afile, 'rb')
+    while True:
+        data = fp.read(chunk_len)
+        if not data:
+            break
+        hashobj.update(data)
+    fp.close()
+    return hashobj.hexdigest()
+
+def hash_sampled(afile, algorithm=None, num_blocks=16, block_size=65536):
+    """ Computes the hash of the size and of evenly spaced blocks of a file
+
+    Much faster than hashing the content of large images, but changes
+    confined to bytes that are not sampled go unnoticed. Files smaller than
+    the samples are hashed completely.
+    """
+    hashhex = None
+    if os.path.isfile(afile):
+        if algorithm is None:
+            algorithm = config.get('execution', 'hash_algorithm')
+        hashfunc = lambda f: _hash_file_samples(f, algorithm, num_blocks,
+                                                block_size)
+        cache = get_hash_cache()
+        if cache is None:
+            hashhex = hashfunc(afile)
+        else:
+            method = 'sampled-%s-%dx%d' % (algorithm.lower(), num_blocks,
+                                           block_size)
+            hashhex = cache.lookup(afile, method, hashfunc)
+    return hashhex
+
+def _hash_file_samples(afile, algorithm='md5', num_blocks=16,
+                       block_size=65536):
+    size = os.path.getsize(afile)
+    if size <= num_blocks * block_size:
+        return _hash_file_content(afile, algorithm=algorithm)
+    hashobj = get_hash_object(algorithm)
+    hashobj.update(str(size))
+    fp = open(afile, 'rb')
+    for offset in np.linspace(0, size - block_size, num_blocks):
+        fp.seek(int(offset))
+        hashobj.update(fp.read(block_size))
+    fp.close()
+    return hashobj.hexdigest()
 
 def hash_timestamp(afile):
     """ Computes md5 hash of the timestamp of a file """
@@ -177,6 +267,60 @@ def hash_timestamp(afile):
         md5hex = md5obj.hexdigest()
     return md5hex
 
+def hash_file(afile, hash_method=None, algorithm=None):
+    """ Computes the hash of a file with the given hash method
+
+    Parameters
+    ----------
+    afile : str
+        file to hash
+    hash_method : str
+        timestamp, content or sampled. Defaults to the hash_method
+        execution option.
+    algorithm : str
+        hash algorithm used by the content and sampled methods (see
+        `get_hash_object`)
+    """
+    if hash_method is None:
+        hash_method = config.get('execution', 'hash_method')
+    hash_method = hash_method.lower()
+    if hash_method == 'timestamp':
+        return hash_timestamp(afile)
+    if hash_method == 'content':
+        return hash_infile(afile, algorithm=algorithm)
+    if hash_method == 'sampled':
+        return hash_sampled(afile, algorithm=algorithm)
+    raise Exception("Unknown hash method: %s" % hash_method)
+
+def hash_files(files, hash_method=None, algorithm=None, num_threads=None):
+    """ Computes the hashes of several files
+
+    Content based hashes are computed in parallel on a pool of
+    `num_threads` threads (defaults to the hash_threads execution option).
+
+    Returns
+    -------
+    hashes : dict
+        maps each file to its hash
+    """
+    files = sorted(set(files))
+    if hash_method is None:
+        hash_method = config.get('execution', 'hash_method')
+    if num_threads is None:
+        num_threads = int(config.get('execution', 'hash_threads'))
+    hashfunc = lambda afile: hash_file(afile, hash_method, algorithm)
+    num_threads = min(num_threads, len(files))
+    if hash_method.lower() == 'timestamp' or num_threads < 2:
+        return dict(zip(files, map(hashfunc, files)))
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(num_threads)
+    try:
+        hashes = pool.map(hashfunc, files)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(files, hashes))
+
 def copyfile(originalfile, newfile, copy=False, create_new=False, hashmethod=None):
     """Copy or symlink ``originalfile`` to ``newfile``.
 
@@ -215,10 +359,7 @@ def copyfile(originalfile, newfile, copy=False, create_new=False, hashmethod=Non
         hashmethod = config.get('execution', 'hash_method').lower()
 
     elif os.path.exists(newfile):
-        if hashmethod == 'timestamp':
-            newhash = hash_timestamp(newfile)
-        elif hashmethod == 'content':
-            newhash = hash_infile(newfile)
+        newhash = hash_file(newfile, hashmethod)
         fmlogger.debug("File: %s already exists,%s, copy:%d" \
                            % (newfile, newhash, copy))
     #the following seems unnecessary
@@ -228,10 +369,7 @@ def copyfile(originalfile, newfile, copy=False, create_new=False, hashmethod=Non
     #        newhash = None
     if os.name is 'posix' and not copy:
         if os.path.lexists(newfile):
-            if hashmethod == 'timestamp':
-                orighash = hash_timestamp(originalfile)
-            elif hashmethod == 'content':
-                orighash = hash_infile(originalfile)
+            orighash = hash_file(originalfile, hashmethod)
             fmlogger.debug('Original hash: %s, %s'%(originalfile, orighash))
             if newhash != orighash:
                 os.unlink(newfile)
@@ -239,10 +377,7 @@ def copyfile(originalfile, newfile, copy=False, create_new=False, hashmethod=Non
             os.symlink(originalfile,newfile)
     else:
         if newhash:
-            if hashmethod == 'timestamp':
-                orighash = hash_timestamp(originalfile)
-            elif hashmethod == 'content':
-                orighash = hash_infile(originalfile)
+            orighash = hash_file(originalfile, hashmethod)
         if (newhash is None) or (newhash != orighash):
             try:
                 fmlogger.debug("Copying File: %s->%s" \
@@ -302,6 +437,122 @@ def copyfiles(filelist, dest, copy=False, create_new=False):
             newfiles.insert(i,destfile)
     return newfiles
 
+# ioctl cloning a file on copy-on-write file systems (linux/fs.h)
+FICLONE = 0x40049409
+
+TRANSFER_METHODS = ['copy', 'hardlink', 'reflink']
+
+def _related_files(originalfile, newfile):
+    """Return the (original, new) pairs of the companion files of an image
+    """
+    pairs = []
+    if originalfile.endswith(".img"):
+        matofile = originalfile[:-4] + ".mat"
+        if os.path.exists(matofile):
+            pairs.append((matofile, newfile[:-4] + ".mat"))
+        pairs.append((originalfile[:-4] + ".hdr", newfile[:-4] + ".hdr"))
+    elif originalfile.endswith(".BRIK"):
+        pairs.append((originalfile[:-4] + ".HEAD", newfile[:-4] + ".HEAD"))
+    return pairs
+
+def _is_unchanged(originalfile, newfile, method):
+    """Whether newfile already has the content of originalfile
+
+    Content hashes are only computed for files of the same size whose
+    modification times differ.
+    """
+    if not os.path.isfile(newfile) or os.path.islink(newfile):
+        return False
+    if os.path.samefile(originalfile, newfile):
+        # hard links are replaced by independent files unless requested
+        return method == 'hardlink'
+    origstat = os.stat(originalfile)
+    newstat = os.stat(newfile)
+    if origstat.st_size != newstat.st_size:
+        return False
+    # transferred files keep the modification time of the original
+    if abs(origstat.st_mtime - newstat.st_mtime) < 1e-3:
+        return True
+    return hash_infile(originalfile) == hash_infile(newfile)
+
+def _reflink(originalfile, newfile):
+    import fcntl
+    fsrc = open(originalfile, 'rb')
+    try:
+        fdst = open(newfile, 'wb')
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+def transfer_file(originalfile, newfile, method='copy'):
+    """Copy ``originalfile`` to ``newfile`` unless it is unchanged
+
+    Unlike `copyfile`, a file that has the size and modification time of
+    the original is assumed unchanged without hashing it, and the new file
+    can be a hard link or a copy-on-write clone of the original.
+
+    Parameters
+    ----------
+    originalfile : str
+        full path to original file
+    newfile : str
+        full path to new file
+    method : {'copy', 'hardlink', 'reflink'}
+        hardlink and reflink fall back to copying the file when the original
+        is on another file system or when the file system does not support
+        them. A hard link shares the data of the original, which is changed
+        if the original is modified in place.
+
+    Returns
+    -------
+    transfers : list
+        (newfile, action, number of bytes) of the file and of its companion
+        files (e.g., the .hdr of a .img), where action is one of
+        'unchanged', 'hardlink', 'reflink' or 'copy'
+    """
+    if method not in TRANSFER_METHODS:
+        raise ValueError('Unknown transfer method %s, use one of %s' %
+                         (method, ', '.join(TRANSFER_METHODS)))
+    # link the data, not symbolic links pointing to it
+    realfile = os.path.realpath(originalfile)
+    nbytes = os.path.getsize(realfile)
+    action = None
+    if _is_unchanged(realfile, newfile, method):
+        fmlogger.debug("File: %s already exists, not overwriting" % newfile)
+        action = 'unchanged'
+    else:
+        # writing to the file would modify the data it shares with a link
+        if os.path.lexists(newfile):
+            os.unlink(newfile)
+        if method == 'hardlink':
+            try:
+                os.link(realfile, newfile)
+                action = 'hardlink'
+            except OSError, e:
+                fmlogger.debug('Could not link %s: %s' % (newfile, e))
+        elif method == 'reflink':
+            try:
+                _reflink(realfile, newfile)
+                action = 'reflink'
+            except (IOError, OSError, ImportError), e:
+                fmlogger.debug('Could not clone %s: %s' % (newfile, e))
+                if os.path.lexists(newfile):
+                    os.unlink(newfile)
+        if action is None:
+            fmlogger.debug("Copying File: %s->%s" % (originalfile, newfile))
+            shutil.copyfile(realfile, newfile)
+            action = 'copy'
+        if action != 'hardlink':
+            stat = os.stat(realfile)
+            os.utime(newfile, (stat.st_atime, stat.st_mtime))
+    transfers = [(newfile, action, nbytes)]
+    for origrelated, newrelated in _related_files(originalfile, newfile):
+        transfers.extend(transfer_file(origrelated, newrelated, method))
+    return transfers
+
 def filename_to_list(filename):
     """Returns a list given either a string or a list
     """
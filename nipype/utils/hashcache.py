@@ -0,0 +1,240 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Cache of file content hashes
+
+Content hashes are keyed on the device, inode, size and modification time
+of a file, so that a file is only read again once it has changed. Hashes are
+kept in memory and, optionally, in a sqlite database that is shared by all
+processes using the same configuration (e.g., the workers of a distributed
+plugin). Both levels hold a bounded number of entries and evict the least
+recently used ones first.
+
+The cache is controlled by the ``hash_cache``, ``hash_cache_file`` and
+``hash_cache_size`` options of the execution section of the configuration.
+"""
+
+import os
+import threading
+from time import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from .. import logging, config
+fmlogger = logging.getLogger("filemanip")
+
+
+def stat_key(stat, method):
+    """Return the cache key of a file given its stat result"""
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(stat.st_mtime * 1e9))
+    return '%d:%d:%d:%d:%s' % (stat.st_dev, stat.st_ino, stat.st_size,
+                               mtime_ns, method)
+
+
+class FileHashCache(object):
+    """Bounded two-level (memory and sqlite) cache of file hashes
+
+    Parameters
+    ----------
+    filename : str
+        sqlite database storing the hashes across processes. Only the
+        in-memory cache is used if None.
+    maxsize : int
+        Maximum number of entries kept by each level of the cache
+
+    Examples
+    --------
+    >>> from nipype.utils.hashcache import FileHashCache
+    >>> cache = FileHashCache(maxsize=10)
+    >>> cache.lookup('setup.py', 'md5', hash_function) # doctest: +SKIP
+
+    """
+
+    # number of insertions between two checks of the database size
+    _prune_interval = 100
+    # number of hits between two updates of their access times in the
+    # database
+    _touch_interval = 100
+
+    def __init__(self, filename=None, maxsize=100000):
+        self.filename = filename
+        self.maxsize = maxsize
+        self._memory = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+        self._db_disabled = False
+        self._conn = None
+        self._pid = None
+        self._num_inserts = 0
+        # access times of the database hits not written yet
+        self._touched = {}
+
+    def lookup(self, afile, method, hashfunc):
+        """Return the hash of a file, computing it on a cache miss
+
+        Parameters
+        ----------
+        afile : str
+            file to hash
+        method : str
+            name identifying the hash function
+        hashfunc : callable
+            computes the hash given the file name
+        """
+        try:
+            key = stat_key(os.stat(afile), method)
+        except OSError:
+            return hashfunc(afile)
+        hashval = self.get(key)
+        if hashval is None:
+            hashval = hashfunc(afile)
+            if hashval is not None:
+                self.set(key, hashval)
+        return hashval
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                hashval = self._memory[key][0]
+                self._memory_set(key, hashval)
+                return hashval
+            hashval = self._db_get(key)
+            if hashval is not None:
+                self._memory_set(key, hashval)
+            return hashval
+
+    def set(self, key, hashval):
+        with self._lock:
+            self._memory_set(key, hashval)
+            self._db_set(key, hashval)
+
+    def clear(self):
+        """Remove all entries from both levels of the cache"""
+        with self._lock:
+            self._memory.clear()
+            conn = self._connect()
+            if conn is not None:
+                try:
+                    conn.execute('DELETE FROM filehashes')
+                    self._touched = {}
+                except sqlite3.Error, e:
+                    self._disable_db(e)
+
+    def _memory_set(self, key, hashval):
+        self._tick += 1
+        self._memory[key] = (hashval, self._tick)
+        if len(self._memory) > self.maxsize:
+            # evict the least recently used tenth of the entries at once
+            ticks = sorted([val[1] for val in self._memory.values()])
+            threshold = ticks[len(ticks) - max(1, 9 * self.maxsize // 10)]
+            for oldkey, val in self._memory.items():
+                if val[1] < threshold:
+                    del self._memory[oldkey]
+
+    def _connect(self):
+        if not self.filename or self._db_disabled or sqlite3 is None:
+            return None
+        # sqlite connections cannot be shared with forked processes
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        try:
+            dirname = os.path.dirname(os.path.abspath(self.filename))
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.filename, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute(('CREATE TABLE IF NOT EXISTS filehashes '
+                          '(key TEXT PRIMARY KEY, hash TEXT, atime REAL)'))
+            conn.execute(('CREATE INDEX IF NOT EXISTS filehashes_atime '
+                          'ON filehashes (atime)'))
+        except (sqlite3.Error, OSError), e:
+            self._disable_db(e)
+            return None
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def _disable_db(self, err):
+        fmlogger.warn('Disabling hash cache file %s: %s' % (self.filename,
+                                                            err))
+        self._db_disabled = True
+        self._conn = None
+
+    def _db_get(self, key):
+        conn = self._connect()
+        if conn is None:
+            return None
+        try:
+            row = conn.execute('SELECT hash FROM filehashes WHERE key = ?',
+                               (key,)).fetchone()
+            if row is None:
+                return None
+            self._touched[key] = time()
+            if len(self._touched) >= self._touch_interval:
+                self._db_touch(conn)
+        except sqlite3.Error, e:
+            self._disable_db(e)
+            return None
+        return str(row[0])
+
+    def _db_touch(self, conn):
+        # access times are only used to evict entries, those of the last
+        # hits of a process may be lost
+        touched = [(atime, key) for key, atime in self._touched.items()]
+        self._touched = {}
+        conn.execute('BEGIN')
+        try:
+            conn.executemany('UPDATE filehashes SET atime = ? WHERE key = ?',
+                             touched)
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _db_set(self, key, hashval):
+        conn = self._connect()
+        if conn is None:
+            return
+        try:
+            conn.execute(('INSERT OR REPLACE INTO filehashes (key, hash, '
+                          'atime) VALUES (?, ?, ?)'), (key, hashval, time()))
+            self._num_inserts += 1
+            if self._num_inserts % self._prune_interval == 0:
+                self._db_prune(conn)
+        except sqlite3.Error, e:
+            self._disable_db(e)
+
+    def _db_prune(self, conn):
+        if self._touched:
+            self._db_touch(conn)
+        count = conn.execute('SELECT COUNT(*) FROM filehashes').fetchone()[0]
+        if count > self.maxsize:
+            conn.execute(('DELETE FROM filehashes WHERE key IN (SELECT key '
+                          'FROM filehashes ORDER BY atime LIMIT ?)'),
+                         (count - self.maxsize,))
+
+
+_hash_cache = None
+
+
+def get_hash_cache():
+    """Return the process-wide hash cache for the current configuration
+
+    Returns None when the cache is disabled.
+    """
+    global _hash_cache
+    if not config.getboolean('execution', 'hash_cache'):
+        return None
+    filename = config.get('execution', 'hash_cache_file').strip() or None
+    if filename:
+        filename = os.path.expanduser(filename)
+    maxsize = int(config.get('execution', 'hash_cache_size'))
+    if _hash_cache is None or _hash_cache.filename != filename or \
+            _hash_cache.maxsize != maxsize:
+        _hash_cache = FileHashCache(filename=filename, maxsize=maxsize)
+    return _hash_cache
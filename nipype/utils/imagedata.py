@@ -0,0 +1,135 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Block-wise reading of the volumes of 3D and 4D images
+
+Algorithms reducing long time series (e.g., global signals, temporal SNR)
+read the volumes of the series in blocks, so that the memory they use does
+not depend on the length of the series. The data are read in their stored
+data type, scaling being applied to each block only when the image is
+scaled.
+
+Uncompressed images are memory mapped. Compressed images are decompressed
+once, in memory if their data fit in a block, or otherwise to a temporary
+file that is memory mapped, since reading a block of a gzip stream means
+decompressing the stream from its start.
+"""
+
+import gzip
+import os
+import shutil
+from tempfile import mkstemp
+
+import numpy as np
+
+
+def _scaling(img):
+    proxy = getattr(img, 'dataobj', None)
+    if proxy is not None and hasattr(proxy, 'slope'):
+        slope, inter = proxy.slope, proxy.inter
+    else:
+        slope, inter = img.get_header().get_slope_inter()
+    if slope is None or np.isnan(slope) or slope == 0:
+        slope = 1.
+    if inter is None or np.isnan(inter):
+        inter = 0.
+    return slope, inter
+
+
+class VolumeReader(object):
+    """Reads the volumes of images as (voxels x volumes) blocks
+
+    Parameters
+    ----------
+    images : list of nibabel images
+        3D or 4D images with the same spatial dimensions
+    max_bytes : float
+        size of the blocks, in bytes of the stored data
+    tmpdir : str
+        directory of the temporary files of compressed images
+
+    Blocks are read again by each call to `blocks`, temporary files being
+    removed by `close`.
+
+    Examples
+    --------
+    >>> import nibabel as nb
+    >>> from nipype.utils.imagedata import VolumeReader
+    >>> reader = VolumeReader([nb.load('functional.nii')], 256e6) # doctest: +SKIP
+    >>> means = [block.mean(axis=0) for block in reader.blocks()] # doctest: +SKIP
+    >>> reader.close() # doctest: +SKIP
+
+    """
+
+    def __init__(self, images, max_bytes, tmpdir=None):
+        self.images = images
+        self.max_bytes = max_bytes
+        self.tmpdir = tmpdir
+        self.nvoxels = int(np.prod(images[0].get_shape()[:3]))
+        self.nvolumes = sum([int(np.prod(img.get_shape()[3:]))
+                             for img in images])
+        self._arrays = {}
+        self._tmpfiles = []
+
+    def _array(self, i):
+        """Returns the stored data of an image, memory mapped if possible"""
+        if i in self._arrays:
+            return self._arrays[i]
+        img = self.images[i]
+        proxy = getattr(img, 'dataobj', None)
+        fname = getattr(proxy, 'file_like', None)
+        offset = getattr(proxy, 'offset', None)
+        if not isinstance(fname, basestring) or offset is None:
+            # not read from a file, or nibabel < 2.0
+            data = np.asarray(img.get_data())
+            self._arrays[i] = (data, 1., 0.)
+            return self._arrays[i]
+        header = img.get_header()
+        shape = header.get_data_shape()
+        dtype = header.get_data_dtype()
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if not fname.endswith('.gz'):
+            data = np.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                             shape=shape, order='F')
+        else:
+            fobj = gzip.open(fname, 'rb')
+            try:
+                fobj.read(offset)
+                if nbytes <= self.max_bytes:
+                    data = np.fromstring(fobj.read(nbytes), dtype=dtype)
+                    data = data.reshape(shape, order='F')
+                else:
+                    fd, tmpfile = mkstemp(suffix='.raw', dir=self.tmpdir)
+                    self._tmpfiles.append(tmpfile)
+                    out = os.fdopen(fd, 'wb')
+                    try:
+                        shutil.copyfileobj(fobj, out, 16 * 1024 * 1024)
+                    finally:
+                        out.close()
+                    data = np.memmap(tmpfile, dtype=dtype, mode='r',
+                                     shape=shape, order='F')
+            finally:
+                fobj.close()
+        self._arrays[i] = (data,) + _scaling(img)
+        return self._arrays[i]
+
+    def blocks(self):
+        """Yields the volumes of the images in blocks"""
+        for i, img in enumerate(self.images):
+            data, slope, inter = self._array(i)
+            if data.ndim < 4:
+                data = data.reshape(data.shape[:3] + (1,), order='F')
+            blocksize = max(1, int(self.max_bytes /
+                                   (self.nvoxels * data.dtype.itemsize)))
+            for t0 in range(0, data.shape[3], blocksize):
+                block = data[:, :, :, t0:t0 + blocksize]
+                block = block.reshape((self.nvoxels, -1), order='F')
+                if slope != 1 or inter != 0:
+                    block = block * slope + inter
+                yield block
+
+    def close(self):
+        """Removes the temporary files"""
+        self._arrays = {}
+        for tmpfile in self._tmpfiles:
+            os.remove(tmpfile)
+        self._tmpfiles = []
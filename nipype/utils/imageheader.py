@@ -0,0 +1,179 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Cached inspection of image headers
+
+Many interfaces only need the shape, voxel sizes, affine or data type of an
+image, e.g., to count the volumes of a 4D series. These are read from the
+348 bytes of the NIfTI-1 header (of the .nii file, or of the .hdr file of a
+.hdr/.img pair), without decompressing or loading the image data. Other
+formats (e.g., Analyze, MGH) are opened with nibabel, which also only reads
+their header.
+
+Header information is cached in memory, keyed on the path, size and
+modification time of the file, so that a file is only read again once it has
+changed.
+"""
+
+from collections import namedtuple
+import gzip
+import os
+import threading
+
+import numpy as np
+
+NIFTI_HEADER_SIZE = 348
+
+ImageInfo = namedtuple('ImageInfo', ['shape', 'zooms', 'affine', 'dtype'])
+
+
+def _open(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def _header_file(fname):
+    """Return the file holding the header of an image and its magic"""
+    if fname.endswith('.gz'):
+        base, ext = os.path.splitext(fname[:-3])
+    else:
+        base, ext = os.path.splitext(fname)
+    if ext == '.nii':
+        return fname, 'n+1\0'
+    if ext in ['.hdr', '.img']:
+        return base + '.hdr' + fname[len(base) + len(ext):], 'ni1\0'
+    return None, None
+
+
+def read_image_info(fname):
+    """Read the header information of an image, without any caching
+
+    Parameters
+    ----------
+    fname : str
+        image file. For .hdr/.img pairs, either of the two files.
+
+    Returns
+    -------
+    info : ImageInfo
+        named tuple with the shape, zooms, affine and dtype of the image
+    """
+    import nibabel as nb
+    from nibabel.nifti1 import Nifti1PairHeader
+    hdr_file, magic = _header_file(fname)
+    header = None
+    if hdr_file is not None:
+        fobj = _open(hdr_file)
+        try:
+            binaryblock = fobj.read(NIFTI_HEADER_SIZE)
+        finally:
+            fobj.close()
+        if len(binaryblock) == NIFTI_HEADER_SIZE and \
+                binaryblock[344:348] == magic:
+            if magic == 'n+1\0':
+                header = nb.Nifti1Header(binaryblock, check=False)
+            else:
+                header = Nifti1PairHeader(binaryblock, check=False)
+    if header is not None:
+        affine = header.get_best_affine()
+    else:
+        # Analyze images may take their affine from a .mat file
+        img = nb.load(fname)
+        header = img.get_header()
+        affine = img.get_affine()
+    affine = np.array(affine)
+    # shared by all callers
+    affine.flags.writeable = False
+    return ImageInfo(shape=tuple(header.get_data_shape()),
+                     zooms=tuple(header.get_zooms()),
+                     affine=affine,
+                     dtype=header.get_data_dtype())
+
+
+class ImageInfoCache(object):
+    """Bounded in-memory cache of image header information
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of images kept in the cache
+
+    Examples
+    --------
+    >>> from nipype.utils.imageheader import ImageInfoCache
+    >>> cache = ImageInfoCache(maxsize=10)
+    >>> cache.lookup('functional.nii').shape # doctest: +SKIP
+    (64, 64, 32, 200)
+
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._memory = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, fname):
+        """Return the header information of an image, reading it on a miss
+        """
+        fname = os.path.abspath(fname)
+        hdr_file, _ = _header_file(fname)
+        stat = os.stat(hdr_file or fname)
+        key = (fname, stat.st_size, stat.st_mtime)
+        with self._lock:
+            if key in self._memory:
+                info = self._memory[key][0]
+                self._set(key, info)
+                return info
+        info = read_image_info(fname)
+        with self._lock:
+            self._set(key, info)
+        return info
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        with self._lock:
+            self._memory.clear()
+
+    def _set(self, key, info):
+        self._tick += 1
+        self._memory[key] = (info, self._tick)
+        if len(self._memory) > self.maxsize:
+            # evict the least recently used tenth of the entries at once
+            ticks = sorted([val[1] for val in self._memory.values()])
+            threshold = ticks[len(ticks) - max(1, 9 * self.maxsize // 10)]
+            for oldkey, val in self._memory.items():
+                if val[1] < threshold:
+                    del self._memory[oldkey]
+
+
+_image_info_cache = ImageInfoCache()
+
+
+def image_info(fname):
+    """Return the shape, zooms, affine and dtype of an image
+
+    The header of the image is only read again once the file has changed.
+    The returned affine is read-only, as it is shared by all callers.
+
+    Parameters
+    ----------
+    fname : str
+        image file
+
+    Returns
+    -------
+    info : ImageInfo
+        named tuple with the shape, zooms, affine and dtype of the image
+    """
+    return _image_info_cache.lookup(fname)
+
+
+def image_shape(fname):
+    """Return the shape of an image, reading only its header"""
+    return image_info(fname).shape
+
+
+def clear_image_info_cache():
+    """Forget the header information of all images"""
+    _image_info_cache.clear()
@@ -0,0 +1,283 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Pool of persistent MATLAB sessions
+
+Starting MATLAB and initializing the path of toolboxes such as SPM takes
+tens of seconds, usually much longer than the jobs run by the MATLAB
+interfaces. Sessions of this pool are started once and then run job after job
+sent as single lines of code to their standard input. After each job, the
+session prints a token to its standard output and standard error so that the
+output of the job can be told apart from the output of the next one.
+
+Sessions are checked before running a job and replaced once they ran
+``matlab_session_jobs`` jobs. The pool is used by
+:class:`nipype.interfaces.matlab.MatlabCommand` when the ``matlab_sessions``
+option of the execution section of the configuration is set. Any command
+reading MATLAB (or Octave) code from its standard input can be used.
+"""
+
+import atexit
+import datetime
+import os
+import Queue
+import subprocess
+import threading
+from time import sleep, time
+from uuid import uuid4
+
+from .. import logging, config
+iflogger = logging.getLogger('interface')
+
+
+class SessionError(Exception):
+    """Raised when a MATLAB session does not answer"""
+
+
+def _quote(code):
+    """Return code as a MATLAB string literal"""
+    return "'%s'" % code.replace("'", "''")
+
+
+def _read_lines(name, stream, queue):
+    for line in iter(stream.readline, ''):
+        now = datetime.datetime.now().isoformat()
+        queue.put((now, name, line.rstrip('\r\n')))
+    queue.put(None)
+
+
+class MatlabSession(object):
+    """A MATLAB process running code read from its standard input
+
+    Parameters
+    ----------
+    command : str
+        shell command starting MATLAB, without the code to run
+    environ : dict
+        environment of the session
+    """
+
+    def __init__(self, command, environ=None):
+        self.command = command
+        # identifies the sessions of a pool that can run the same jobs
+        self.key = None
+        self.njobs = 0
+        self._proc = subprocess.Popen(command, shell=True,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      env=environ)
+        self._queues = {}
+        for name in ['stdout', 'stderr']:
+            self._queues[name] = Queue.Queue()
+            thread = threading.Thread(target=_read_lines,
+                                      args=(name, getattr(self._proc, name),
+                                            self._queues[name]))
+            thread.daemon = True
+            thread.start()
+        iflogger.debug('Started MATLAB session %d: %s' % (self._proc.pid,
+                                                          command))
+
+    @property
+    def pid(self):
+        return self._proc.pid
+
+    def is_alive(self):
+        return self._proc.poll() is None
+
+    def check(self, timeout=None):
+        """Raise SessionError unless the session answers within timeout
+        seconds"""
+        self._send('', timeout=timeout)
+
+    def run(self, code, cwd=None):
+        """Run a line of MATLAB code
+
+        Returns the lines written to the standard output and error by the
+        code as (timestamp, stream name, line) tuples.
+        """
+        rows = self._send(code, cwd=cwd)
+        self.njobs += 1
+        return rows
+
+    def close(self, timeout=5):
+        """Exit MATLAB, killing it if needed"""
+        if self.is_alive():
+            try:
+                self._proc.stdin.write('exit\n')
+                self._proc.stdin.close()
+            except IOError:
+                pass
+            t = time()
+            while self.is_alive() and time() - t < timeout:
+                sleep(0.05)
+            if self.is_alive():
+                self._proc.kill()
+                self._proc.wait()
+        for stream in [self._proc.stdin, self._proc.stdout,
+                       self._proc.stderr]:
+            try:
+                stream.close()
+            except IOError:
+                pass
+
+    def _send(self, code, cwd=None, timeout=None):
+        token = 'nipype_%s' % uuid4().hex
+        line = ''
+        if cwd:
+            line += 'cd(%s);' % _quote(cwd)
+        if code:
+            # code that fails to parse does not prevent writing the tokens
+            line += ('clear variables;try,eval(%s);catch ME,'
+                     'fprintf(2,\'MATLAB code threw an exception:\\n%%s\\n\','
+                     'ME.message);end;' % _quote(code))
+        line += ("fprintf(1,'\\n%s\\n');fprintf(2,'\\n%s\\n');"
+                 "if exist('OCTAVE_VERSION','builtin'),fflush(stdout);"
+                 "fflush(stderr);end\n" % (token, token))
+        try:
+            self._proc.stdin.write(line)
+            self._proc.stdin.flush()
+        except IOError, e:
+            raise SessionError('MATLAB session %d is not running: %s' %
+                               (self.pid, e))
+        rows = []
+        start = time()
+        for name in ['stdout', 'stderr']:
+            while True:
+                wait = None
+                if timeout is not None:
+                    wait = max(0, timeout - (time() - start))
+                try:
+                    row = self._queues[name].get(timeout=wait)
+                except Queue.Empty:
+                    raise SessionError('MATLAB session %d did not answer '
+                                       'within %g seconds' % (self.pid,
+                                                              timeout))
+                if row is None:
+                    self._queues[name].put(None)
+                    output = '\n'.join([row[2] for row in rows])
+                    raise SessionError('MATLAB session %d exited:\n%s' %
+                                       (self.pid, output))
+                if row[2].endswith(token):
+                    # keep anything printed without a final newline
+                    prefix = row[2][:-len(token)]
+                    if prefix.strip() and prefix.strip() != '>>':
+                        rows.append((row[0], name, prefix))
+                    break
+                rows.append(row)
+        # drop the empty line preceding the tokens
+        for name in ['stdout', 'stderr']:
+            idx = [i for i, row in enumerate(rows) if row[1] == name]
+            if idx and rows[idx[-1]][2] == '':
+                rows.pop(idx[-1])
+        return rows
+
+
+class MatlabSessionPool(object):
+    """Persistent MATLAB sessions, by command and environment
+
+    Parameters
+    ----------
+    max_jobs : int
+        number of jobs after which a session is replaced by a new one
+    timeout : float
+        number of seconds a session has to start or answer a health check
+
+    Examples
+    --------
+    >>> from nipype.utils.matlabpool import MatlabSessionPool
+    >>> pool = MatlabSessionPool(max_jobs=10)
+    >>> rows = pool.run('matlab -nodesktop -nosplash', 'a=1', os.getcwd()) # doctest: +SKIP
+    >>> pool.close()
+
+    """
+
+    def __init__(self, max_jobs=100, timeout=300.):
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def run(self, command, code, cwd, environ=None):
+        """Run a line of MATLAB code in a session started with command
+
+        Raises SessionError if no session could be started, or if the
+        session exited while running the code.
+        """
+        session = self._acquire(command, environ)
+        try:
+            rows = session.run(code, cwd=cwd)
+        except SessionError:
+            session.close()
+            raise
+        self._release(session)
+        return rows
+
+    def close(self):
+        """Exit all idle sessions"""
+        with self._lock:
+            sessions = [session for idle in self._idle.values()
+                        for session in idle]
+            self._idle = {}
+        for session in sessions:
+            session.close()
+
+    def _key(self, command, environ):
+        return (command, tuple(sorted((environ or {}).items())))
+
+    def _acquire(self, command, environ):
+        key = self._key(command, environ)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                session = idle.pop()
+            try:
+                if not session.is_alive():
+                    raise SessionError('MATLAB session %d exited' %
+                                       session.pid)
+                session.check(self.timeout)
+                return session
+            except SessionError, e:
+                iflogger.warn('Discarding MATLAB session: %s' % e)
+                session.close()
+        session = MatlabSession(command, environ=environ)
+        try:
+            # waits for MATLAB to start
+            session.check(self.timeout)
+        except SessionError:
+            session.close()
+            raise
+        session.key = key
+        return session
+
+    def _release(self, session):
+        if session.njobs >= self.max_jobs:
+            iflogger.debug('Recycling MATLAB session %d after %d jobs' %
+                           (session.pid, session.njobs))
+            session.close()
+            return
+        with self._lock:
+            self._idle.setdefault(session.key, []).append(session)
+
+
+_session_pool = None
+
+
+def get_session_pool():
+    """Return the MATLAB session pool of this process"""
+    global _session_pool
+    # sessions of a parent process cannot be shared with forked processes
+    if _session_pool is None or _session_pool.pid != os.getpid():
+        _session_pool = MatlabSessionPool(
+            max_jobs=int(config.get('execution', 'matlab_session_jobs')),
+            timeout=float(config.get('execution', 'matlab_session_timeout')))
+    return _session_pool
+
+
+def _close_session_pool():
+    if _session_pool is not None and _session_pool.pid == os.getpid():
+        _session_pool.close()
+
+atexit.register(_close_session_pool)
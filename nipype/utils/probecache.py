@@ -0,0 +1,136 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Memoization of toolkit probes
+
+Finding the version of a toolkit (e.g., running Matlab to ask SPM for its
+version) or whether an executable is in the path is repeated by every
+interface, in every process running nodes. The results of these probes are
+kept in memory and in the data file of the configuration
+(``~/.nipype/nipype.json``), keyed on the host name, the arguments of the
+probe and the environment variables it depends on. Changing one of these
+variables thus leads to probing again.
+
+Results saved on disk are trusted for ``probe_cache_age`` seconds (execution
+section of the configuration), so that toolkits updated in place are
+eventually noticed, and are then removed from the file. The cache is
+disabled by ``probe_cache = false``. Probes returning None (e.g., toolkit
+not found) are never cached.
+"""
+
+from functools import wraps
+import os
+from socket import gethostname
+import threading
+from time import time
+
+from .. import logging, config
+iflogger = logging.getLogger('interface')
+
+_probes = {}
+_lock = threading.Lock()
+
+
+def probe_key(args=(), kwargs=None, env_vars=()):
+    """Return the key of a probe given its arguments and environment"""
+    key = [gethostname()]
+    key.extend(['%s=%s' % (var, os.environ.get(var)) for var in env_vars])
+    key.extend([repr(arg) for arg in args])
+    key.extend(['%s=%r' % item for item in sorted((kwargs or {}).items())])
+    return key
+
+
+def cached_probe(name, probe, args=(), kwargs=None, env_vars=(),
+                 persistent=True):
+    """Return probe(*args, **kwargs), running the probe only on a cache miss
+
+    Parameters
+    ----------
+    name : str
+        identifies the probe
+    probe : callable
+        runs the probe
+    env_vars : list of str
+        names of the environment variables the result depends on
+    persistent : bool
+        whether the result is also saved on disk, where it is kept for
+        probe_cache_age seconds. It must then be json serializable.
+    """
+    if kwargs is None:
+        kwargs = {}
+    if not config.getboolean('execution', 'probe_cache'):
+        return probe(*args, **kwargs)
+    key = probe_key(args, kwargs, env_vars)
+    memkey = (name, tuple(key))
+    with _lock:
+        if memkey in _probes:
+            return _probes[memkey]
+    max_age = float(config.get('execution', 'probe_cache_age'))
+    persistent = persistent and max_age > 0
+    datakey = 'probe_%s' % name
+    entrykey = '\n'.join(key)
+    if persistent:
+        entry = _load_entries(datakey).get(entrykey)
+        if entry and time() - entry.get('time', 0) < max_age:
+            with _lock:
+                _probes[memkey] = entry['value']
+            return entry['value']
+    value = probe(*args, **kwargs)
+    if value is None:
+        return value
+    with _lock:
+        _probes[memkey] = value
+    if persistent:
+        # entries saved by other processes meanwhile are kept
+        entries = _load_entries(datakey)
+        for oldkey, entry in entries.items():
+            if time() - entry.get('time', 0) >= max_age:
+                del entries[oldkey]
+        entries[entrykey] = dict(value=value, time=time())
+        try:
+            config.save_data(datakey, entries)
+        except (IOError, OSError, TypeError, ValueError), e:
+            iflogger.debug('Could not save %s probe: %s' % (name, e))
+    return value
+
+
+def _load_entries(datakey):
+    try:
+        entries = config.get_data(datakey)
+    except (IOError, OSError, ValueError), e:
+        iflogger.debug('Could not read %s: %s' % (datakey, e))
+        entries = None
+    if not isinstance(entries, dict):
+        entries = {}
+    return entries
+
+
+def memoize_probe(name, env_vars=(), persistent=True):
+    """Decorator caching the results of a probe with cached_probe
+
+    The undecorated function is available as the `uncached` attribute of
+    the decorated one.
+
+    Examples
+    --------
+    >>> from nipype.utils.probecache import memoize_probe
+    >>> @memoize_probe('toolkit_version', ['TOOLKIT_HOME'], persistent=False)
+    ... def version():
+    ...     return '1.0'
+    >>> version()
+    '1.0'
+
+    """
+    def decorator(probe):
+        @wraps(probe)
+        def wrapper(*args, **kwargs):
+            return cached_probe(name, probe, args=args, kwargs=kwargs,
+                                env_vars=env_vars, persistent=persistent)
+        wrapper.uncached = probe
+        return wrapper
+    return decorator
+
+
+def clear_probe_cache():
+    """Forget the probes cached in memory by this process"""
+    with _lock:
+        _probes.clear()
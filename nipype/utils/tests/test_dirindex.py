@@ -0,0 +1,85 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import glob
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nipype.testing import assert_equal, assert_raises
+from nipype.utils.dirindex import DirectoryIndex
+
+
+def make_tree(tmpdir):
+    for subject in ['s1', 's2', '.hidden']:
+        for run in ['run1', 'run2']:
+            os.makedirs(os.path.join(tmpdir, subject, run))
+            for name in ['func.nii', 'func.mat', '.func.nii']:
+                open(os.path.join(tmpdir, subject, run, name), 'wt').close()
+    open(os.path.join(tmpdir, 's1', 'struct.nii'), 'wt').close()
+
+
+def test_glob():
+    tmpdir = mkdtemp()
+    make_tree(tmpdir)
+    index = DirectoryIndex(tmpdir)
+    try:
+        for pattern in ['*', '*/', 's1/*', 's*/run?/func.*', '*/*/.*',
+                        '.*/run1/*.nii', 's[12]/run1/', 's1/struct.nii',
+                        's1/run1', 's1//run1/func.nii', 's3/*', '*/*/*/*',
+                        's1/run1/../struct.nii']:
+            pattern = os.path.join(tmpdir, pattern)
+            yield (assert_equal, sorted(index.glob(pattern)),
+                   sorted(glob.glob(pattern)))
+        # each directory is listed once
+        yield assert_equal, index.listings, 9
+        yield assert_equal, index.glob('/'), glob.glob('/')
+        yield assert_raises, ValueError, DirectoryIndex, tmpdir, None, 'never'
+    finally:
+        rmtree(tmpdir)
+
+
+def test_refresh():
+    tmpdir = mkdtemp()
+    make_tree(tmpdir)
+    run = os.path.join(tmpdir, 's1', 'run1')
+    pattern = os.path.join(tmpdir, 's*', 'run1', '*.nii')
+    index = DirectoryIndex(tmpdir)
+    static = DirectoryIndex(tmpdir, refresh='none')
+    try:
+        static.scan()
+        yield assert_equal, static.listings, 10
+        yield assert_equal, len(index.glob(pattern)), 2
+        listings = index.listings
+        open(os.path.join(run, 'new.nii'), 'wt').close()
+        # modification times may not be finer than a second
+        os.utime(run, (1000000000, 1000000000))
+        yield assert_equal, len(index.glob(pattern)), 3
+        yield assert_equal, index.listings, listings + 1
+        yield assert_equal, len(static.glob(pattern)), 2
+        rmtree(os.path.join(tmpdir, 's2'))
+        yield assert_equal, len(index.glob(pattern)), 2
+    finally:
+        rmtree(tmpdir)
+
+
+def test_save_load():
+    tmpdir = mkdtemp()
+    make_tree(tmpdir)
+    # outside of the tree, not to change the modification time of its root
+    index_dir = mkdtemp()
+    index_file = os.path.join(index_dir, 'index.pklz')
+    pattern = os.path.join(tmpdir, 's*', 'run*', 'func.nii')
+    try:
+        index = DirectoryIndex(tmpdir, index_file=index_file)
+        files = index.glob(pattern)
+        index.save_if_changed()
+        index = DirectoryIndex(tmpdir, index_file=index_file)
+        yield assert_equal, index.glob(pattern), files
+        yield assert_equal, index.listings, 0
+        # indexes of other trees are ignored
+        index = DirectoryIndex(os.path.join(tmpdir, 's1'),
+                               index_file=index_file)
+        yield assert_equal, len(index._dirs), 0
+    finally:
+        rmtree(tmpdir)
+        rmtree(index_dir)
@@ -1,15 +1,19 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 import os
+from shutil import rmtree
 from tempfile import mkstemp, mkdtemp
 
-from nipype.testing import assert_equal, assert_true, assert_false
+from nipype.testing import (assert_equal, assert_true, assert_false,
+                            assert_raises)
 from nipype.utils.filemanip import (save_json, load_json, loadflat,
                                     fname_presuffix, fnames_presuffix,
                                     hash_rename, check_forhash,
                                     copyfile, copyfiles,
                                     filename_to_list, list_to_filename,
-                                    cleandir, split_filename)
+                                    cleandir, split_filename,
+                                    get_hash_object, hash_infile,
+                                    hash_sampled, hash_files, transfer_file)
 
 import numpy as np
 
@@ -94,6 +98,25 @@ def test_copyfile_true():
     os.unlink(orig_img)
     os.unlink(orig_hdr)
 
+def test_transfer_file():
+    orig_img, orig_hdr = _temp_analyze_files()
+    open(orig_img, 'wb').write('data')
+    pth, fname = os.path.split(orig_img)
+    new_img = os.path.join(pth, 'newfile.img')
+    new_hdr = os.path.join(pth, 'newfile.hdr')
+    # the companion header is transferred as well
+    transfers = transfer_file(orig_img, new_img, 'reflink')
+    yield assert_equal, [item[0] for item in transfers], [new_img, new_hdr]
+    # clones fall back to copies on file systems without copy-on-write
+    yield assert_true, transfers[0][1] in ['reflink', 'copy']
+    yield assert_equal, transfers[0][2], 4
+    yield assert_equal, open(new_img, 'rb').read(), 'data'
+    transfers = transfer_file(orig_img, new_img, 'hardlink')
+    yield assert_equal, [item[1] for item in transfers], ['unchanged'] * 2
+    yield assert_raises, ValueError, transfer_file, orig_img, new_img, 'move'
+    for f in [new_img, new_hdr, orig_img, orig_hdr]:
+        os.unlink(f)
+
 def test_copyfiles():
     orig_img1, orig_hdr1 = _temp_analyze_files()
     orig_img2, orig_hdr2 = _temp_analyze_files()
@@ -177,3 +200,38 @@ def test_loadflat():
     yield assert_true, isinstance(aloaded, dict)
     yield assert_equal, sorted(aloaded.items()), sorted(adict.items())
 
+
+
+def test_hash_algorithms():
+    yield assert_equal, get_hash_object('md5').hexdigest(), \
+        'd41d8cd98f00b204e9800998ecf8427e'
+    yield assert_equal, get_hash_object('sha1').hexdigest(), \
+        'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+    yield assert_raises, ValueError, get_hash_object, 'crc'
+
+def test_hash_files():
+    tmpdir = mkdtemp()
+    fnames = []
+    for i in range(5):
+        fnames.append(os.path.join(tmpdir, 'file%d.txt' % i))
+        open(fnames[-1], 'wt').write('data %d' % i)
+    hashes = hash_files(fnames + fnames[:2], 'content', 'sha1', num_threads=3)
+    yield assert_equal, sorted(hashes.keys()), fnames
+    for fname in fnames:
+        yield assert_equal, hashes[fname], hash_infile(fname, algorithm='sha1')
+    rmtree(tmpdir)
+
+def test_hash_sampled():
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'large.bin')
+    data = np.zeros(1024 * 1024, dtype=np.uint8)
+    data.tofile(fname)
+    small = hash_sampled(fname, 'md5', num_blocks=4, block_size=1024)
+    # files smaller than the samples are hashed entirely
+    yield assert_equal, hash_sampled(fname, 'md5', block_size=1024 * 1024), \
+        hash_infile(fname, algorithm='md5')
+    data[0] = 1
+    data.tofile(fname)
+    yield assert_true, hash_sampled(fname, 'md5', num_blocks=4,
+                                    block_size=1024) != small
+    rmtree(tmpdir)
@@ -0,0 +1,121 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nipype.testing import assert_equal, assert_true
+from nipype.utils.filemanip import hash_infile, _hash_file_content
+from nipype.utils.hashcache import FileHashCache, get_hash_cache
+from nipype import config
+from nipype.utils.config import NipypeConfig
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, afile):
+        self.count += 1
+        return _hash_file_content(afile)
+
+
+def _write(fname, content, mtime):
+    fp = open(fname, 'wt')
+    fp.write(content)
+    fp.close()
+    os.utime(fname, (mtime, mtime))
+
+
+def test_hash_cache():
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'data.txt')
+    _write(fname, 'some data', 1000000000)
+    dbfile = os.path.join(tmpdir, 'cache', 'hashes.sqlite')
+    cache = FileHashCache(filename=dbfile)
+    hashfunc = Counter()
+    hashval = cache.lookup(fname, 'md5', hashfunc)
+    yield assert_equal, hashval, _hash_file_content(fname)
+    yield assert_equal, cache.lookup(fname, 'md5', hashfunc), hashval
+    yield assert_equal, hashfunc.count, 1
+    # another process with the same configuration reuses the hash
+    othercache = FileHashCache(filename=dbfile)
+    yield assert_equal, othercache.lookup(fname, 'md5', hashfunc), hashval
+    yield assert_equal, hashfunc.count, 1
+    # hashes are stored per method
+    othercache.lookup(fname, 'sha1', hashfunc)
+    yield assert_equal, hashfunc.count, 2
+    # changing the file invalidates the entry
+    _write(fname, 'other data', 1000000001)
+    newhash = cache.lookup(fname, 'md5', hashfunc)
+    yield assert_equal, hashfunc.count, 3
+    yield assert_equal, newhash, _hash_file_content(fname)
+    yield assert_true, newhash != hashval
+    rmtree(tmpdir)
+
+
+def test_hash_cache_bounded():
+    tmpdir = mkdtemp()
+    dbfile = os.path.join(tmpdir, 'hashes.sqlite')
+    cache = FileHashCache(filename=dbfile, maxsize=10)
+    cache._prune_interval = 5
+    for i in range(30):
+        cache.set('key%d' % i, 'hash%d' % i)
+    yield assert_true, len(cache._memory) <= 10
+    # the most recently used entries are kept
+    yield assert_equal, cache.get('key29'), 'hash29'
+    count = cache._connect().execute(
+        'SELECT COUNT(*) FROM filehashes').fetchone()[0]
+    yield assert_equal, count, 10
+    cache.clear()
+    yield assert_equal, cache.get('key29'), None
+    rmtree(tmpdir)
+
+
+def test_hash_cache_touch():
+    tmpdir = mkdtemp()
+    dbfile = os.path.join(tmpdir, 'hashes.sqlite')
+    cache = FileHashCache(filename=dbfile)
+    cache._touch_interval = 3
+    for i in range(3):
+        cache.set('key%d' % i, 'hash%d' % i)
+    # hits in the database update the access times in batches
+    othercache = FileHashCache(filename=dbfile)
+    othercache._touch_interval = 3
+    othercache.get('key0')
+    othercache.get('key1')
+    yield assert_equal, sorted(othercache._touched.keys()), ['key0', 'key1']
+    othercache.get('key2')
+    yield assert_equal, othercache._touched, {}
+    atimes = othercache._connect().execute(
+        'SELECT key FROM filehashes ORDER BY atime').fetchall()
+    yield assert_equal, [str(row[0]) for row in atimes], \
+        ['key0', 'key1', 'key2']
+    rmtree(tmpdir)
+
+
+def test_hash_infile_cached():
+    tmpdir = mkdtemp()
+    hash_cache_file = config.get('execution', 'hash_cache_file')
+    config.set('execution', 'hash_cache_file',
+               os.path.join(tmpdir, 'hashes.sqlite'))
+    try:
+        fname = os.path.join(tmpdir, 'data.txt')
+        _write(fname, 'some data', 1000000000)
+        yield assert_equal, hash_infile(fname), _hash_file_content(fname)
+        yield assert_equal, hash_infile(fname), _hash_file_content(fname)
+        yield assert_equal, get_hash_cache().filename, \
+            os.path.join(tmpdir, 'hashes.sqlite')
+        yield (assert_equal, hash_infile(os.path.join(tmpdir, 'missing')),
+               None)
+    finally:
+        config.set('execution', 'hash_cache_file', hash_cache_file)
+    rmtree(tmpdir)
+
+
+def test_hash_cache_default():
+    # hashes are only cached in memory by default
+    defaults = NipypeConfig()
+    defaults.set_default_config()
+    yield assert_equal, defaults.get('execution', 'hash_cache_file'), ''
@@ -0,0 +1,86 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import nibabel as nb
+
+from nipype.testing import (assert_equal, assert_true, assert_false,
+                            assert_raises)
+from nipype.utils import imageheader
+from nipype.utils.imageheader import (ImageInfoCache, image_info,
+                                      image_shape)
+from nipype.interfaces.spm.base import (func_is_3d, scans_for_fname,
+                                        scans_for_fnames)
+
+
+def test_read_image_info():
+    tmpdir = mkdtemp()
+    affine = np.diag([2., 3., 4., 1.])
+    affine[:3, 3] = [10, 20, 30]
+    data = np.zeros((4, 5, 6, 7), dtype=np.int16)
+    for fname, klass in [('img.nii', nb.Nifti1Image),
+                         ('img.nii.gz', nb.Nifti1Image),
+                         ('pair.img', nb.Nifti1Pair),
+                         ('pairgz.img.gz', nb.Nifti1Pair),
+                         ('analyze.img', nb.AnalyzeImage)]:
+        fname = os.path.join(tmpdir, fname)
+        klass(data, affine).to_filename(fname)
+        img = nb.load(fname)
+        info = image_info(fname)
+        yield assert_equal, info.shape, img.get_shape()
+        yield assert_equal, info.zooms, img.get_header().get_zooms()
+        yield assert_true, np.allclose(info.affine, img.get_affine())
+        yield assert_equal, info.dtype, np.dtype(np.int16)
+    # both files of a pair give the same information
+    yield assert_equal, image_shape(os.path.join(tmpdir, 'pair.hdr')), \
+        (4, 5, 6, 7)
+    rmtree(tmpdir)
+
+
+def test_image_info_cache():
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'img.nii.gz')
+    nb.Nifti1Image(np.zeros((3, 3, 3, 5)), np.eye(4)).to_filename(fname)
+    os.utime(fname, (1000000000, 1000000000))
+    reads = []
+    read_image_info = imageheader.read_image_info
+
+    def counting_read(fname):
+        reads.append(fname)
+        return read_image_info(fname)
+    imageheader.read_image_info = counting_read
+    try:
+        cache = ImageInfoCache(maxsize=10)
+        info = cache.lookup(fname)
+        yield assert_equal, info.shape, (3, 3, 3, 5)
+        yield assert_equal, cache.lookup(fname), info
+        yield assert_equal, len(reads), 1
+        # the affine is shared and cannot be modified
+        yield assert_false, info.affine.flags.writeable
+        # the header is read again once the file has changed
+        nb.Nifti1Image(np.zeros((3, 3, 3, 8)), np.eye(4)).to_filename(fname)
+        yield assert_equal, cache.lookup(fname).shape, (3, 3, 3, 8)
+        yield assert_equal, len(reads), 2
+    finally:
+        imageheader.read_image_info = read_image_info
+    yield assert_raises, OSError, cache.lookup, os.path.join(tmpdir,
+                                                             'missing.nii')
+    rmtree(tmpdir)
+
+
+def test_spm_scans():
+    tmpdir = mkdtemp()
+    func4d = os.path.join(tmpdir, 'func4d.nii.gz')
+    func3d = os.path.join(tmpdir, 'func3d.nii')
+    nb.Nifti1Image(np.zeros((2, 2, 2, 3)), np.eye(4)).to_filename(func4d)
+    nb.Nifti1Image(np.zeros((2, 2, 2)), np.eye(4)).to_filename(func3d)
+    yield assert_false, func_is_3d(func4d)
+    yield assert_true, func_is_3d([func3d])
+    yield assert_equal, list(scans_for_fname(func4d)), \
+        ['%s,%d' % (func4d, i) for i in range(1, 4)]
+    yield assert_equal, list(scans_for_fname(func3d)), ['%s,1' % func3d]
+    yield assert_equal, len(scans_for_fnames([func4d, func4d])), 6
+    rmtree(tmpdir)
@@ -0,0 +1,90 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+
+from nipype.testing import (assert_equal, assert_true, assert_false,
+                            assert_raises)
+from nipype.utils.matlabpool import MatlabSessionPool, SessionError
+
+# stand-in for matlab: runs the (quoted) code of each line it reads as python,
+# then prints the tokens of the line
+INTERPRETER = r"""
+import os, re, sys
+for line in iter(sys.stdin.readline, ''):
+    if line.strip() == 'exit':
+        break
+    cwd = re.search(r"cd\('([^']*)'\)", line)
+    if cwd:
+        os.chdir(cwd.group(1))
+    code = re.search(r"eval\('((?:[^']|'')*)'\)", line)
+    if code:
+        try:
+            exec code.group(1).replace("''", "'")
+        except Exception, e:
+            sys.stderr.write('MATLAB code threw an exception:\n%s\n' % e)
+    for token in re.findall(r"fprintf\(1,'\\n(nipype_\w+)\\n'\)", line):
+        sys.stdout.write('\n%s\n' % token)
+        sys.stderr.write('\n%s\n' % token)
+    sys.stdout.flush()
+    sys.stderr.flush()
+"""
+
+
+def make_interpreter(tmpdir):
+    """Return the command running the stand-in matlab"""
+    filename = os.path.join(tmpdir, 'fake_matlab.py')
+    open(filename, 'wt').write(INTERPRETER)
+    return '%s %s' % (sys.executable, filename)
+
+
+def test_session_pool():
+    tmpdir = mkdtemp()
+    command = make_interpreter(tmpdir)
+    pool = MatlabSessionPool(max_jobs=3, timeout=30)
+    try:
+        rows = pool.run(command, "print 'pid', os.getpid()", tmpdir)
+        yield assert_equal, [row[1] for row in rows], ['stdout']
+        pid = rows[0][2]
+        rows = pool.run(command, "print 'cwd', os.getcwd()", tmpdir)
+        yield assert_equal, rows[0][2], 'cwd %s' % tmpdir
+        # errors are reported on stderr and the session is reused
+        rows = pool.run(command, "print 'pid', os.getpid(); 1/0", tmpdir)
+        yield assert_equal, rows[0][2], pid
+        yield assert_equal, rows[1][1], 'stderr'
+        yield assert_equal, rows[1][2], 'MATLAB code threw an exception:'
+        # the session is recycled after three jobs
+        rows = pool.run(command, "print 'pid', os.getpid()", tmpdir)
+        yield assert_false, rows[0][2] == pid
+        pid = rows[0][2]
+        # sessions that exit while running a job are discarded
+        yield (assert_raises, SessionError, pool.run, command,
+               'sys.exit(1)', tmpdir)
+        rows = pool.run(command, "print 'pid', os.getpid()", tmpdir)
+        yield assert_false, rows[0][2] == pid
+        # sessions are kept by command
+        yield assert_equal, len(pool._idle), 1
+        other = command + ' -nosplash'
+        pool.run(other, 'pass', tmpdir)
+        yield assert_equal, len(pool._idle), 2
+        # failure to start
+        yield (assert_raises, SessionError, pool.run, 'exit 1', 'pass',
+               tmpdir)
+    finally:
+        pool.close()
+        rmtree(tmpdir)
+    yield assert_equal, pool._idle, {}
+
+
+def test_session_timeout():
+    tmpdir = mkdtemp()
+    pool = MatlabSessionPool(timeout=0.5)
+    try:
+        # a command that never answers
+        yield (assert_raises, SessionError, pool.run, 'cat > /dev/null',
+               'pass', tmpdir)
+    finally:
+        pool.close()
+        rmtree(tmpdir)
@@ -0,0 +1,97 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nipype import config
+from nipype.testing import assert_equal, assert_true
+from nipype.interfaces.base import find_executable
+from nipype.utils.probecache import memoize_probe, clear_probe_cache
+
+probes = []
+
+
+@memoize_probe('test_version', ['NIPYPE_TEST_HOME'])
+def version(arg=None):
+    probes.append(arg)
+    home = os.environ.get('NIPYPE_TEST_HOME')
+    if home == 'missing':
+        return None
+    return '%s-%s' % (home, arg)
+
+
+def test_memoize_probe():
+    tmpdir = mkdtemp()
+    old_data_file = config.data_file
+    old_home = os.environ.get('NIPYPE_TEST_HOME')
+    config.data_file = os.path.join(tmpdir, 'nipype.json')
+    os.environ['NIPYPE_TEST_HOME'] = 'a'
+    clear_probe_cache()
+    try:
+        yield assert_equal, version(), 'a-None'
+        yield assert_equal, version(), 'a-None'
+        yield assert_equal, version(arg=1), 'a-1'
+        yield assert_equal, len(probes), 2
+        # probes are run again when the environment changes
+        os.environ['NIPYPE_TEST_HOME'] = 'b'
+        yield assert_equal, version(), 'b-None'
+        yield assert_equal, len(probes), 3
+        # and read from disk by other processes
+        clear_probe_cache()
+        yield assert_equal, version(), 'b-None'
+        os.environ['NIPYPE_TEST_HOME'] = 'a'
+        yield assert_equal, version(), 'a-None'
+        yield assert_equal, len(probes), 3
+        yield assert_equal, len(config.get_data('probe_test_version')), 3
+        # the data file is replaced atomically
+        yield assert_equal, os.listdir(tmpdir), ['nipype.json']
+        # missing toolkits are probed every time
+        os.environ['NIPYPE_TEST_HOME'] = 'missing'
+        version()
+        version()
+        yield assert_equal, len(probes), 5
+        # results on disk expire
+        os.environ['NIPYPE_TEST_HOME'] = 'a'
+        clear_probe_cache()
+        config.set('execution', 'probe_cache_age', '0.000001')
+        yield assert_equal, version(), 'a-None'
+        yield assert_equal, len(probes), 6
+        yield assert_equal, len(config.get_data('probe_test_version')), 1
+        config.set('execution', 'probe_cache', 'false')
+        version()
+        yield assert_equal, len(probes), 7
+    finally:
+        config.set('execution', 'probe_cache', 'true')
+        config.set('execution', 'probe_cache_age', '86400')
+        config.data_file = old_data_file
+        if old_home is None:
+            del os.environ['NIPYPE_TEST_HOME']
+        else:
+            os.environ['NIPYPE_TEST_HOME'] = old_home
+        clear_probe_cache()
+        rmtree(tmpdir)
+
+
+def test_find_executable():
+    tmpdir = mkdtemp()
+    old_data_file = config.data_file
+    old_path = os.environ['PATH']
+    config.data_file = os.path.join(tmpdir, 'nipype.json')
+    try:
+        os.environ['PATH'] = tmpdir
+        yield assert_equal, find_executable('nipype_test_cmd'), None
+        filename = os.path.join(tmpdir, 'nipype_test_cmd')
+        open(filename, 'wt').close()
+        # commands missing from the path are not cached
+        yield assert_equal, find_executable('nipype_test_cmd'), filename
+        os.remove(filename)
+        yield assert_equal, find_executable('nipype_test_cmd'), filename
+        os.environ['PATH'] = os.pathsep.join([tmpdir, tmpdir])
+        yield assert_equal, find_executable('nipype_test_cmd'), None
+        yield assert_true, config.get_data('probe_executable')
+    finally:
+        os.environ['PATH'] = old_path
+        config.data_file = old_data_file
+        clear_probe_cache()
+        rmtree(tmpdir)
@@ -10,11 +10,10 @@ import nipype.interfaces.fsl as fsl
 
 
 def tbss1_op_string(in_files):
-    import nibabel as nib
+    from nipype.utils.imageheader import image_shape
     op_strings = []
     for infile in in_files:
-        img = nib.load(infile)
-        dimtup = tuple([d - 2 for d in img.get_shape()])
+        dimtup = tuple([d - 2 for d in image_shape(infile)])
         op_str = '-min 1 -ero -roi 1 %d 1 %d 1 %d 0 1' % dimtup
         op_strings.append(op_str)
     return op_strings
@@ -17,20 +17,20 @@ def pickfirst(files):
         return files
 
 def pickmiddle(files):
-    from nibabel import load
+    from nipype.utils.imageheader import image_shape
     import numpy as np
     middlevol = []
     for f in files:
-        middlevol.append(int(np.ceil(load(f).get_shape()[3]/2)))
+        middlevol.append(int(np.ceil(image_shape(f)[3]/2)))
     return middlevol
 
 def pickvol(filenames, fileidx, which):
-    from nibabel import load
+    from nipype.utils.imageheader import image_shape
     import numpy as np
     if which.lower() == 'first':
         idx = 0
     elif which.lower() == 'middle':
-        idx = int(np.ceil(load(filenames[fileidx]).get_shape()[3]/2))
+        idx = int(np.ceil(image_shape(filenames[fileidx])[3]/2))
     else:
         raise Exception('unknown value for volume selection : %s'%which)
     return idx
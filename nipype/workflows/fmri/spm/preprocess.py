@@ -188,9 +188,10 @@ def create_vbm_preproc(name='vbmpreproc'):
     def compute_icv(class_images):
         from nibabel import load
         from numpy import prod
+        from nipype.utils.imageheader import image_info
         icv = []
         for session in class_images:
-            voxel_volume = prod(load(session[0][0]).get_header().get_zooms())
+            voxel_volume = prod(image_info(session[0][0]).zooms)
             img = load(session[0][0]).get_data() + \
                 load(session[1][0]).get_data() + \
                 load(session[2][0]).get_data()
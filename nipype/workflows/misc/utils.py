@@ -2,29 +2,26 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
 def get_vox_dims(volume):
-    import nibabel as nb
+    from nipype.utils.imageheader import image_info
     if isinstance(volume, list):
         volume = volume[0]
-    nii = nb.load(volume)
-    hdr = nii.get_header()
-    voxdims = hdr.get_zooms()
+    voxdims = image_info(volume).zooms
     return [float(voxdims[0]), float(voxdims[1]), float(voxdims[2])]
 
 
 def get_data_dims(volume):
-    import nibabel as nb
+    from nipype.utils.imageheader import image_info
     if isinstance(volume, list):
         volume = volume[0]
-    nii = nb.load(volume)
-    hdr = nii.get_header()
-    datadims = hdr.get_data_shape()
+    datadims = image_info(volume).shape
     return [int(datadims[0]), int(datadims[1]), int(datadims[2])]
 
 
 def get_affine(volume):
-    import nibabel as nb
-    nii = nb.load(volume)
-    return nii.get_affine()
+    import numpy as np
+    from nipype.utils.imageheader import image_info
+    # a copy, as the affine of image_info is shared
+    return np.array(image_info(volume).affine)
 
 
 def select_aparc(list_of_files):
@@ -27,12 +27,12 @@ def extract_noise_components(realigned_file, noise_mask_file, num_components):
 def select_volume(filename, which):
     """Return the middle index of a file
     """
-    from nibabel import load
+    from nipype.utils.imageheader import image_shape
     import numpy as np
     if which.lower() == 'first':
         idx = 0
     elif which.lower() == 'middle':
-        idx = int(np.ceil(load(filename).get_shape()[3]/2))
+        idx = int(np.ceil(image_shape(filename)[3]/2))
     else:
         raise Exception('unknown value for volume selection : %s'%which)
     return idx
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Measure the time needed to import nipype modules in a fresh interpreter
+
+Usage::
+
+  python tools/import_time.py [-n REPEATS] [MODULE ...]
+
+Each module (nipype.pipeline.engine by default) is imported REPEATS times,
+every time in a new python process, and the minimum, median and maximum
+import times are reported. Run it from the directory containing the nipype
+package to be measured.
+"""
+
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+
+TIMER = ('import time; t = time.time(); import %s; '
+         'print(time.time() - t)')
+
+
+def import_times(module, repeats=10):
+    """Return the import times of a module in fresh interpreters"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.getcwd()] +
+                                        [path for path in
+                                         [env.get('PYTHONPATH')] if path])
+    times = []
+    for _ in range(repeats):
+        proc = subprocess.Popen([sys.executable, '-c', TIMER % module],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env)
+        out, err = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError('Could not import %s:\n%s' % (module, err))
+        times.append(float(out.split()[-1]))
+    return sorted(times)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [MODULE ...]')
+    parser.add_option('-n', '--repeats', type='int', default=10,
+                      help='number of imports of each module')
+    options, modules = parser.parse_args()
+    for module in modules or ['nipype.pipeline.engine']:
+        times = import_times(module, options.repeats)
+        print('%-30s min %.3fs  median %.3fs  max %.3fs' %
+              (module, times[0], times[len(times) // 2], times[-1]))